@@ -17,10 +17,13 @@ from colors import color
 from dotmap import DotMap
 from configparser import ConfigParser
 
-from phm.dataset import VTD_Dataset, create_dual_point_cloud_dataset, create_mme_dataset, create_point_cloud_dataset, create_vtd_dataset
+from phm.dataset import VTD_Dataset, estimate_session_homography, create_dual_point_cloud_dataset, create_dual_point_cloud_stream, create_mme_dataset, create_point_cloud_dataset, create_vtd_dataset
 from phm.io.vtd import load_RGBDnT
-from phm.pipeline.core import ConvertToPC_Step, DoublePointCloudBatch, FilterDepthRange_Step, Pipeline, PointCloudSaver_Step, Preprocessing_Step, RGBDnTBatch, LoadBatch_Step
+from phm.pipeline.core import DoublePointCloudBatch, FrameToPC_Step, Pipeline, PointCloudSaver_Step, Preprocessing_Step, RGBDnTBatch, LoadBatch_Step, SequenceWindowBatcher, WindowedRegistration
 from phm.pipeline.o3d_pipeline import ColoredICPRegistar_Step, O3DRegistrationMetrics_Step
+from phm.pipeline.cache import StepCache
+from phm.pipeline.checkpoint import PipelineCheckpoint
+from phm.pipeline.profiling import PipelineProfiler
 from phm.pipeline.manual_pipeline import ManualRegistration_Step
 from phm.pipeline.probreg_pipeline import CPDRegistration_Step, FilterregRegistration_Step, GMMTreeRegistration_Step, SVRRegistration_Step
 from phm.visualization import VTD_Visualization, visualize_vtd
@@ -81,12 +84,101 @@ Repository: https://github.com/parham/lemanchot-fusion
             return
         self.__load_init_settings(__info_file)
     
+    @property
+    def sync_tolerance(self) -> int:
+        # Maximum timestamp difference (ms) between the paired modalities
+        return int(self.settings.modalities.sync_tolerance) if \
+            'sync_tolerance' in self.settings.modalities else 0
+
+    @property
+    def calib_samples(self) -> int:
+        # Number of frames sampled for the automatic homography estimation
+        return int(self.settings.calibration.calib_samples) if \
+            'calib_samples' in self.settings.calibration else 5
+
+    @property
+    def refine_homography(self) -> bool:
+        # Per-frame refinement of the calibration homography
+        return self.settings.calibration.refine_frames in ('1', 'true', 'True', 'yes') if \
+            'refine_frames' in self.settings.calibration else False
+
+    @property
+    def thermal_normalization(self) -> bool:
+        # Dataset-wide instead of per-frame thermal normalization
+        return self.settings.modalities.thermal_normalization in ('1', 'true', 'True', 'yes') if \
+            'thermal_normalization' in self.settings.modalities else False
+
+    @property
+    def undistort(self) -> bool:
+        # Lens undistortion using the distortion coefficients (D) of the camera parameters
+        return self.settings.modalities.undistort in ('1', 'true', 'True', 'yes') if \
+            'undistort' in self.settings.modalities else False
+
+    @property
+    def thermal_param_file(self) -> str:
+        return os.path.join(self.settings.root_dir, self.settings.modalities.thermal_param_file) if \
+            'thermal_param_file' in self.settings.modalities else None
+
+    @property
+    def cprofile_steps(self):
+        # Steps (class names separated by comma) profiled with cProfile
+        return [x.strip() for x in self.settings.profiling.cprofile.split(',') if x.strip()] if \
+            'cprofile' in self.settings.profiling else None
+
+    @property
+    def num_processes(self):
+        # Processes running the per-frame steps (None runs them in the main process)
+        return int(self.settings.processing.num_processes) if \
+            'num_processes' in self.settings.processing else None
+
+    @property
+    def step_cache(self):
+        # Opt-in memoization of the pipeline steps (the size limit is in MB)
+        csettings = self.settings.cache
+        if not ('enabled' in csettings and csettings.enabled in ('1', 'true', 'True', 'yes')):
+            return None
+        max_size = int(csettings.max_size) if 'max_size' in csettings else 4096
+        return StepCache(os.path.join(self.settings.root_dir, 'results', 'cache'), max_bytes=max_size * 1024 * 1024)
+
+    @property
+    def resume_checkpoint(self) -> bool:
+        # Interrupted runs restart from their last checkpoint
+        csettings = self.settings.checkpoint
+        return csettings.resume in ('1', 'true', 'True', 'yes') if 'resume' in csettings else False
+
+    def pipeline_checkpoint(self, name : str):
+        # Opt-in checkpoints of the pipeline steps (and of the registered frames)
+        csettings = self.settings.checkpoint
+        if not ('enabled' in csettings and csettings.enabled in ('1', 'true', 'True', 'yes')):
+            return None
+        return PipelineCheckpoint(os.path.join(self.settings.root_dir, 'results', 'checkpoints', name))
+
+    def on_estimate_homography(self):
+        vdt_dir = os.path.join(self.settings.root_dir, self.settings.modalities.vtd_dir)
+        h_fid = self.settings.calibration.calib_ref_id if \
+            'calib_ref_id' in self.settings.calibration else None
+        try:
+            report = estimate_session_homography(
+                root_dir = self.settings.root_dir,
+                calib_dir = vdt_dir,
+                calib_fids = [h_fid] if h_fid is not None else None,
+                calib_samples = self.calib_samples,
+                tolerance = self.sync_tolerance,
+                force = True
+            )
+        except ValueError as ex:
+            print(color(str(ex), fg='red'))
+            return
+        for key, value in report.items():
+            print(f'{key} : {value}')
+
     def on_create_mme_dataset(self):
         rgbdt_dir = os.path.join(self.settings.root_dir, self.settings.modalities.rgbdt_dir)
         create_mme_dataset(
             root_dir = self.settings.root_dir,
             res_dir = rgbdt_dir,
-            file_type = 'mat'
+            file_type = 'mat',
+            tolerance = self.sync_tolerance
         )
     
     def on_create_vtd_dataset(self):
@@ -100,7 +192,13 @@ Repository: https://github.com/parham/lemanchot-fusion
             target_dir=vdt_dir,
             depth_param_file=depth_param_file,
             in_type='mat', 
-            homography_fid=h_fid
+            homography_fid=h_fid,
+            calib_samples=self.calib_samples,
+            refine=self.refine_homography,
+            thermal_normalization=self.thermal_normalization,
+            undistort=self.undistort,
+            thermal_param_file=self.thermal_param_file,
+            num_workers=self.num_processes or 1
         )
     
     def on_create_point_cloud_dataset(self):
@@ -120,6 +218,30 @@ Repository: https://github.com/parham/lemanchot-fusion
             target_dir = pc_dir
         )
 
+    def on_create_dual_point_cloud_stream(self):
+        pc_dir = os.path.join(self.settings.root_dir, self.settings.modalities.dual_point_cloud_dir)
+        vdt_dir = os.path.join(self.settings.root_dir, self.settings.modalities.vtd_dir)
+        depth_param_file = os.path.join(self.settings.root_dir, self.settings.modalities.depth_param_file)
+        h_fid = self.settings.calibration.calib_ref_id if \
+            'calib_ref_id' in self.settings.calibration else None
+        # The homography is kept next to the VTD files, the VTD files themselves are optional
+        keep_vtd = self.settings.modalities.keep_vtd in ('1', 'true', 'True', 'yes') if \
+            'keep_vtd' in self.settings.modalities else False
+        create_dual_point_cloud_stream(
+            root_dir = self.settings.root_dir,
+            target_dir = pc_dir,
+            depth_param_file = depth_param_file,
+            vtd_dir = vdt_dir if keep_vtd else None,
+            calib_dir = vdt_dir,
+            homography_fid = h_fid,
+            tolerance = self.sync_tolerance,
+            calib_samples = self.calib_samples,
+            refine = self.refine_homography,
+            thermal_normalization = self.thermal_normalization,
+            undistort = self.undistort,
+            thermal_param_file = self.thermal_param_file
+        )
+
     def on_visualize_mm_point_cloud(self):
         pc_dir = os.path.join(self.settings.root_dir, self.settings.modalities.point_cloud_dir)
         fs = glob.glob(os.path.join(pc_dir, '*.ply'))
@@ -162,7 +284,8 @@ Repository: https://github.com/parham/lemanchot-fusion
         depth_param = load_pinhole(depth_param_file)
         # Input filenames
         vtd_files = glob.glob(os.path.join(vtd_dir,'*_*.mat'))
-        vtd_files = [os.path.basename(f) for f in vtd_files]
+        # The saved point clouds are numbered in the order of their timestamps
+        vtd_files = sorted([os.path.basename(f) for f in vtd_files])
         # Loading Dataset
         batch = RGBDnTBatch(
             root_dir = vtd_dir,
@@ -170,21 +293,58 @@ Repository: https://github.com/parham/lemanchot-fusion
         )
 
         pipeline = Pipeline([
-            FilterDepthRange_Step(),
-            ConvertToPC_Step(
-                depth_params_file = depth_param_file,
-                data_batch_key = 'prp_frames'),
-            Preprocessing_Step(data_pcs_key='pcs'),
+            # Depth range, deprojection and thermal validity in a single pass
+            FrameToPC_Step(depth_range=[1, 2.5]),
+            Preprocessing_Step(data_pcs_key='pcs', filter_thermal=False),
             PointCloudSaver_Step(
                 data_pcs_key='prp_pcs',
                 depth_param=depth_param,
                 result_dir=preprocessing_dir,
-                method_name='pc'
+                method_name='pc',
+                async_write=True
             )
-        ])
+        ], streaming=True, profiler=PipelineProfiler(
+            preprocessing_dir, name='preprocessing', cprofile=self.cprofile_steps),
+            cache=self.step_cache, num_processes=self.num_processes)
 
         res = pipeline(batch)
 
+    def _get_registration_step(self,
+        method_name : str,
+        depth_param,
+        iteration : int = None
+    ):
+        if method_name == 'filterreg':
+            return FilterregRegistration_Step(
+                voxel_size = 0.05,
+                data_pcs_key='pcs',
+                maxiter=iteration if iteration is not None else 40)
+        elif method_name == 'gmmtree':
+            return GMMTreeRegistration_Step(
+                voxel_size = 0.05,
+                data_pcs_key='pcs', 
+                maxiter=iteration if iteration is not None else 40)
+        elif method_name == 'svr':
+            return SVRRegistration_Step(
+                voxel_size = 0.05,
+                data_pcs_key='pcs', 
+                maxiter=iteration if iteration is not None else 40)
+        elif method_name == 'cpd':
+            return CPDRegistration_Step(
+                voxel_size = 0.05,
+                data_pcs_key='pcs',
+                maxiter=iteration if iteration is not None else 50)
+        elif method_name == 'manual':
+            return ManualRegistration_Step(
+                depth_params=depth_param,
+                data_pcs_key='pcs')
+        elif method_name == 'colored_icp':
+            maxiter = iteration if iteration is not None else 60
+            maxiter = [maxiter, int(maxiter / 2), int(maxiter / 4)]
+            return ColoredICPRegistar_Step(data_pcs_key='pcs', max_iter=maxiter)
+        else:
+            raise NotImplementedError(f'{method_name} is not supported!')
+
     def _get_pipeline(self, 
         method_name : str,
         final_result_dir : str,
@@ -199,70 +359,28 @@ Repository: https://github.com/parham/lemanchot-fusion
             data_pcs_key='aligned_pcs',
             depth_param=depth_param,
             result_dir=aligned_result_dir,
-            method_name=method_name
+            method_name=method_name,
+            async_write=True
         )
         fused_pc_saver = PointCloudSaver_Step(
             data_pcs_key='fused_pc',
             depth_param=depth_param,
             result_dir=final_result_dir,
             method_name=method_name,
-            disabled=fused_saver_disabled
+            disabled=fused_saver_disabled,
+            async_write=True
         )
         metrics_step = O3DRegistrationMetrics_Step(data_pcs_key='pcs')
-        if method_name == 'filterreg':
-            return Pipeline([
-                load_data,
-                FilterregRegistration_Step(
-                    voxel_size = 0.05,
-                    data_pcs_key='pcs',
-                    maxiter=iteration if iteration is not None else 40),
-                aligned_pc_saver, fused_pc_saver, metrics_step
-            ])
-        elif method_name == 'gmmtree':
-            return Pipeline([
-                load_data,
-                GMMTreeRegistration_Step(
-                    voxel_size = 0.05,
-                    data_pcs_key='pcs', 
-                    maxiter=iteration if iteration is not None else 40),
-                aligned_pc_saver, fused_pc_saver, metrics_step
-            ])
-        elif method_name == 'svr':
-            return Pipeline([
-                load_data,
-                SVRRegistration_Step(
-                    voxel_size = 0.05,
-                    data_pcs_key='pcs', 
-                    maxiter=iteration if iteration is not None else 40),
-                aligned_pc_saver, fused_pc_saver, metrics_step
-            ])
-        elif method_name == 'cpd':
-            return Pipeline([
-                load_data,
-                CPDRegistration_Step(
-                    voxel_size = 0.05,
-                    data_pcs_key='pcs',
-                    maxiter=iteration if iteration is not None else 50),
-                aligned_pc_saver, fused_pc_saver, metrics_step
-            ])
-        elif method_name == 'manual':
-            return Pipeline([
-                load_data,
-                ManualRegistration_Step(
-                    depth_params=depth_param,
-                    data_pcs_key='pcs'),
-                aligned_pc_saver, fused_pc_saver, metrics_step
-            ])
-        elif method_name == 'colored_icp':
-            maxiter = iteration if iteration is not None else 60
-            maxiter = [maxiter, int(maxiter / 2), int(maxiter / 4)]
-            return Pipeline([
-                load_data,
-                ColoredICPRegistar_Step(data_pcs_key='pcs', max_iter=maxiter),
-                aligned_pc_saver, fused_pc_saver, metrics_step
-            ])
-        else:
-            raise NotImplementedError(f'{method_name} is not supported!')
+        # The savers and the metrics only depend on the registration, so they run concurrently
+        return Pipeline([
+            load_data,
+            self._get_registration_step(method_name, depth_param, iteration),
+            aligned_pc_saver, fused_pc_saver, metrics_step
+        ], concurrent=True, keep=['fused_pc', 'metrics', 'transformations'],
+            profiler=PipelineProfiler(final_result_dir, name=method_name, cprofile=self.cprofile_steps),
+            cache=self.step_cache,
+            checkpoint=self.pipeline_checkpoint(method_name if iteration is None else f'{method_name}_{iteration}'),
+            resume=self.resume_checkpoint)
     
     def on_process_registration(self, method_name, iteration = 40):
         root_dir = self.settings.root_dir
@@ -304,6 +422,41 @@ Repository: https://github.com/parham/lemanchot-fusion
             res_pc, depth_param,
             f'Result of {method_name} technique', 1024, 768)
 
+    def on_process_windowed_registration(self, method_name, iteration = 40):
+        root_dir = self.settings.root_dir
+        final_result_dir = os.path.join(root_dir, 'results', 'windowed_pcs')
+        depth_param_file = os.path.join(root_dir, 'depth/camera_info.json')
+        depth_param = load_pinhole(depth_param_file)
+        dpc_dir = os.path.join(root_dir, 'preprocessing')
+        # Window settings
+        wsettings = self.settings.registration
+        window_size = int(wsettings.window_size) if 'window_size' in wsettings else 8
+        stride = int(wsettings.window_stride) if 'window_stride' in wsettings else window_size // 2
+        num_workers = int(wsettings.num_workers) if 'num_workers' in wsettings else 1
+        # Overlapping windows of consecutive frames
+        windows = SequenceWindowBatcher(dpc_dir, window_size=window_size, stride=stride)
+        print(f'{len(windows)} windows of {window_size} frames (stride : {stride})')
+        cache = self.step_cache
+        registration = WindowedRegistration(
+            lambda: Pipeline([
+                LoadBatch_Step('batch'),
+                self._get_registration_step(method_name, depth_param, iteration)
+            ], cache=cache),
+            num_workers=num_workers,
+            voxel_size=0.005
+        )
+        res = registration(windows)
+        res_pc = res['fused_pc']
+        PointCloudSaver_Step(
+            data_pcs_key='fused_pc',
+            depth_param=depth_param,
+            result_dir=final_result_dir,
+            method_name=method_name
+        )(**res)
+        visualize_vtd(
+            res_pc, depth_param,
+            f'Result of {method_name} technique (windowed)', 1024, 768)
+
     def on_process_iteration(self, method_name):
         root_dir = self.settings.root_dir
         depth_param_file = os.path.join(root_dir, 'depth/camera_info.json')
@@ -387,6 +540,9 @@ Repository: https://github.com/parham/lemanchot-fusion
         menu_create_mme_dataset = FunctionItem("Create RGBD&T Dataset (MME)", self.on_create_mme_dataset)
         submenu_create.append_item(menu_create_mme_dataset)
         
+        menu_estimate_homography = FunctionItem("Estimate Homography (Automatic)", self.on_estimate_homography)
+        submenu_create.append_item(menu_estimate_homography)
+
         menu_create_vtd_dataset = FunctionItem("Create VTD Dataset", self.on_create_vtd_dataset)
         submenu_create.append_item(menu_create_vtd_dataset)
         
@@ -396,6 +552,9 @@ Repository: https://github.com/parham/lemanchot-fusion
         menu_create_dual_pc_dataset = FunctionItem("Create Dual Point Cloud Dataset", self.on_create_dual_point_cloud_dataset)
         submenu_create.append_item(menu_create_dual_pc_dataset)
 
+        menu_create_dual_pc_stream = FunctionItem("Create Dual Point Cloud Dataset (Directly from Modalities)", self.on_create_dual_point_cloud_stream)
+        submenu_create.append_item(menu_create_dual_pc_stream)
+
         submenu_create_item = SubmenuItem('Create Multi-modal Data', submenu=submenu_create)
         submenu_create_item.set_menu(menu)
         menu.append_item(submenu_create_item)
@@ -436,6 +595,9 @@ Repository: https://github.com/parham/lemanchot-fusion
         menu_process_colored_icp = FunctionItem("Multi-modal Registration using Colored ICP", lambda: self.on_process_registration('colored_icp'))
         submenu_process.append_item(menu_process_colored_icp)
 
+        menu_process_windowed = FunctionItem("Windowed Registration of the Sequence using Colored ICP", lambda: self.on_process_windowed_registration('colored_icp'))
+        submenu_process.append_item(menu_process_windowed)
+
         #################
         menu_process_filterreg_itr = FunctionItem("IterationAnalysis (FilterReg)", lambda: self.on_process_iteration('filterreg'))
         submenu_process.append_item(menu_process_filterreg_itr)
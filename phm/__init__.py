@@ -5,7 +5,10 @@ __all__ = [
 
 from .data import *
 from .io import *
+from .cache import *
 from .control_point import *
 from .dataset import *
+from .journal import *
+from .summary import *
 from .utils import *
 from .visualization import *
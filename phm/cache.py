@@ -0,0 +1,163 @@
+
+import sys
+import threading
+import numpy as np
+import open3d as o3d
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+from phm.data import DualPointCloudPack, MMEContainer, MultiModalPointCloud, RGBDnT
+
+__default_cache_size__ = 512 * 1024 * 1024 # 512 MB
+
+def sizeof_frame(obj : Any) -> int:
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, RGBDnT):
+        return obj.data.nbytes
+    if isinstance(obj, MMEContainer):
+        return sum(sizeof_frame(e.data) for e in obj.get_entities())
+    if isinstance(obj, o3d.geometry.PointCloud):
+        # The o3d buffers are viewed without copy
+        return sum(np.asarray(x).nbytes for x in (obj.points, obj.colors, obj.normals))
+    if isinstance(obj, DualPointCloudPack):
+        return sizeof_frame(obj.visible_pointcloud) + sizeof_frame(obj.thermal_pointcloud)
+    if isinstance(obj, MultiModalPointCloud):
+        arrays = (obj.points, obj.colors, obj.thermal, obj.normals, obj.thermal_mask)
+        return sum(x.nbytes for x in arrays if x is not None)
+    if isinstance(obj, (tuple, list)):
+        return sum(sizeof_frame(x) for x in obj)
+    if isinstance(obj, dict):
+        return sum(sizeof_frame(x) for x in obj.values())
+    return sys.getsizeof(obj)
+
+class FrameCache:
+    __policies__ = ('lru', 'lfu')
+
+    def __init__(self,
+        max_bytes : int = __default_cache_size__,
+        policy : str = 'lru'
+    ) -> None:
+        if not policy in self.__policies__:
+            raise ValueError(f'{policy} eviction policy is not supported!')
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._lock = threading.RLock()
+        # (namespace, key) -> (value, size)
+        self._entries = OrderedDict()
+        self._frequency = {}
+        self._bytes = 0
+        self._stats = {}
+
+    def __getstate__(self):
+        # Only the settings are sent to the other processes, they start with an empty cache
+        return {'max_bytes' : self.max_bytes, 'policy' : self.policy}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _namespace_stats(self, namespace : str) -> Dict:
+        if not namespace in self._stats:
+            self._stats[namespace] = {'hits' : 0, 'misses' : 0, 'evictions' : 0}
+        return self._stats[namespace]
+
+    @property
+    def current_bytes(self) -> int:
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item):
+        return item in self._entries
+
+    def get(self, namespace : str, key : Hashable, default : Any = None) -> Any:
+        with self._lock:
+            ckey = (namespace, key)
+            if not ckey in self._entries:
+                self._namespace_stats(namespace)['misses'] += 1
+                return default
+            self._namespace_stats(namespace)['hits'] += 1
+            self._touch(ckey)
+            return self._entries[ckey][0]
+
+    def put(self, namespace : str, key : Hashable, value : Any):
+        size = sizeof_frame(value)
+        with self._lock:
+            ckey = (namespace, key)
+            if ckey in self._entries:
+                self._remove(ckey)
+            # Frames larger than the budget are never cached
+            if size > self.max_bytes:
+                return
+            while self._bytes + size > self.max_bytes and self._entries:
+                self._evict()
+            self._entries[ckey] = (value, size)
+            self._frequency[ckey] = 1
+            self._bytes += size
+
+    def get_or_load(self, namespace : str, key : Hashable, load_func : Callable) -> Any:
+        missing = object()
+        value = self.get(namespace, key, missing)
+        if value is missing:
+            # The lock is not held while loading so that loaders can run concurrently
+            value = load_func()
+            self.put(namespace, key, value)
+        return value
+
+    def invalidate(self, namespace : str = None):
+        with self._lock:
+            for ckey in [k for k in self._entries if namespace is None or k[0] == namespace]:
+                self._remove(ckey)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            namespaces = {}
+            for (ns, _) in self._entries.keys():
+                self._namespace_stats(ns)
+            for ns, st in self._stats.items():
+                namespaces[ns] = {**st, 'items' : 0, 'bytes' : 0}
+            for (ns, _), (_, size) in self._entries.items():
+                namespaces[ns]['items'] += 1
+                namespaces[ns]['bytes'] += size
+            return {
+                'policy' : self.policy,
+                'max_bytes' : self.max_bytes,
+                'bytes' : self._bytes,
+                'items' : len(self._entries),
+                'hits' : sum(x['hits'] for x in self._stats.values()),
+                'misses' : sum(x['misses'] for x in self._stats.values()),
+                'evictions' : sum(x['evictions'] for x in self._stats.values()),
+                'namespaces' : namespaces
+            }
+
+    def _touch(self, ckey):
+        self._frequency[ckey] += 1
+        self._entries.move_to_end(ckey)
+
+    def _remove(self, ckey):
+        _, size = self._entries.pop(ckey)
+        del self._frequency[ckey]
+        self._bytes -= size
+
+    def _evict(self):
+        if self.policy == 'lru':
+            ckey = next(iter(self._entries))
+        else:
+            # The least recently used entry is chosen among equally frequent ones
+            ckey = min(self._entries, key=self._frequency.__getitem__)
+        self._namespace_stats(ckey[0])['evictions'] += 1
+        self._remove(ckey)
+
+__frame_cache = None
+
+def get_frame_cache() -> FrameCache:
+    global __frame_cache
+    if __frame_cache is None:
+        __frame_cache = FrameCache()
+    return __frame_cache
+
+def set_frame_cache(cache : FrameCache):
+    global __frame_cache
+    __frame_cache = cache
@@ -0,0 +1,221 @@
+
+import os
+import cv2
+import json
+import time
+import logging
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+__homography_report__ = 'homography_report.json'
+
+def _create_detector(method : str, max_features : int):
+    if method == 'orb':
+        return cv2.ORB_create(nfeatures=max_features), cv2.NORM_HAMMING
+    elif method == 'sift':
+        return cv2.SIFT_create(nfeatures=max_features), cv2.NORM_L2
+    raise ValueError(f'{method} feature detector is not supported!')
+
+def normalize_modality(img : np.ndarray) -> np.ndarray:
+    # Robust min/max so that a few hot/saturated pixels do not flatten the image
+    if len(img.shape) > 2:
+        img = cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_RGB2GRAY)
+    img = img.astype(np.float32)
+    low, high = np.percentile(img, (1, 99))
+    if high <= low:
+        return np.zeros(img.shape, dtype=np.uint8)
+    return (np.clip((img - low) / (high - low), 0, 1) * 255.0).astype(np.uint8)
+
+def edge_image(img : np.ndarray, blur : int = 5) -> np.ndarray:
+    # Thermal and visible intensities are not related, but their edges mostly are (even with reversed contrast)
+    img = cv2.GaussianBlur(normalize_modality(img), (blur, blur), 0)
+    gx = cv2.Sobel(img, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(img, cv2.CV_32F, 0, 1)
+    mag = cv2.magnitude(gx, gy)
+    return cv2.normalize(mag, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+def match_features(
+    thermal : np.ndarray,
+    visible : np.ndarray,
+    method : str = 'sift',
+    max_features : int = 2000,
+    ratio : float = 0.8
+) -> Tuple[np.ndarray, np.ndarray]:
+    detector, norm = _create_detector(method, max_features)
+    kp_t, des_t = detector.detectAndCompute(edge_image(thermal), None)
+    kp_v, des_v = detector.detectAndCompute(edge_image(visible), None)
+    if des_t is None or des_v is None or len(kp_t) < 2 or len(kp_v) < 2:
+        return np.zeros((0, 2), np.float32), np.zeros((0, 2), np.float32)
+    matches = cv2.BFMatcher(norm).knnMatch(des_t, des_v, k=2)
+    # Lowe's ratio test
+    good = [m[0] for m in matches if len(m) == 2 and m[0].distance < ratio * m[1].distance]
+    source = np.float32([kp_t[m.queryIdx].pt for m in good]).reshape(-1, 2)
+    dest = np.float32([kp_v[m.trainIdx].pt for m in good]).reshape(-1, 2)
+    return source, dest
+
+def refine_homography(
+    thermal : np.ndarray,
+    visible : np.ndarray,
+    homography : np.ndarray,
+    max_iterations : int = 50,
+    epsilon : float = 1e-5,
+    blur : int = 5
+) -> Tuple[np.ndarray, float]:
+    """Refine a homography with ECC maximization on the edge images (raises cv2.error if it does not converge)."""
+    # The edges are blurred to widen the convergence basin
+    tedge = cv2.GaussianBlur(edge_image(thermal), (blur, blur), 0).astype(np.float32)
+    vedge = cv2.GaussianBlur(edge_image(visible), (blur, blur), 0).astype(np.float32)
+    # ECC warps the template (visible) coordinates to the input (thermal) coordinates
+    warp = np.linalg.inv(homography).astype(np.float32)
+    warp /= warp[2, 2]
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iterations, epsilon)
+    cc, warp = cv2.findTransformECC(vedge, tedge, warp, cv2.MOTION_HOMOGRAPHY, criteria, None, 1)
+    refined = np.linalg.inv(warp.astype(np.float64))
+    return refined / refined[2, 2], float(cc)
+
+def refine_homography_pyramid(
+    thermal : np.ndarray,
+    visible : np.ndarray,
+    homography : np.ndarray,
+    scale : float = 0.5,
+    levels : int = 2,
+    max_iterations : int = 20,
+    epsilon : float = 1e-4,
+    time_budget : float = None
+) -> Tuple[np.ndarray, Dict]:
+    """Coarse to fine ECC refinement on downscaled images, warm-started from the given homography.
+
+    The finest level is at the given scale and every level halves it. The time budget (seconds) is checked
+    before every level : a level is skipped if its expected cost (4 times the cost of the previous level,
+    which has half its resolution) does not fit in the remaining time. No level is run without budget.
+    """
+    start = time.perf_counter()
+    h = homography
+    cc = None
+    done = 0
+    expected = 0.0
+    for level in reversed(range(levels)):
+        if time_budget is not None and time.perf_counter() - start + expected > time_budget:
+            break
+        level_start = time.perf_counter()
+        s = scale / (2 ** level)
+        S = np.diag([s, s, 1.0])
+        t = cv2.resize(thermal, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+        v = cv2.resize(visible, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+        # The homography in the downscaled coordinates
+        hs, cc = refine_homography(t, v, S @ h @ np.linalg.inv(S), max_iterations, epsilon, blur=3)
+        h = np.linalg.inv(S) @ hs @ S
+        h /= h[2, 2]
+        done += 1
+        expected = 4 * (time.perf_counter() - level_start)
+    return h, {
+        'levels' : done,
+        'cc' : cc,
+        'time' : time.perf_counter() - start
+    }
+
+def homography_shift(h1 : np.ndarray, h2 : np.ndarray, shape) -> float:
+    # Maximum displacement (pixels) between the projections of the image corners
+    height, width = shape[:2]
+    corners = np.float32([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]]).reshape(-1, 1, 2)
+    return float(np.abs(cv2.perspectiveTransform(corners, h1) - cv2.perspectiveTransform(corners, h2)).max())
+
+def reprojection_errors(source : np.ndarray, dest : np.ndarray, homography : np.ndarray) -> np.ndarray:
+    # Distance (pixels) between the projected source points and their matches
+    proj = cv2.perspectiveTransform(source.reshape(-1, 1, 2).astype(np.float64), homography).reshape(-1, 2)
+    return np.linalg.norm(proj - dest.reshape(-1, 2), axis=1)
+
+def edge_correlation(thermal : np.ndarray, visible : np.ndarray, homography : np.ndarray) -> float:
+    # Normalized cross-correlation of the edges inside the thermal field of view
+    height, width = visible.shape[:2]
+    warped = cv2.warpPerspective(edge_image(thermal), homography, (width, height)).astype(np.float64)
+    fov = cv2.warpPerspective(np.full(thermal.shape[:2], 255, np.uint8), homography, (width, height)) == 255
+    vedge = edge_image(visible).astype(np.float64)
+    if np.count_nonzero(fov) < 2:
+        return 0.0
+    a = warped[fov] - warped[fov].mean()
+    b = vedge[fov] - vedge[fov].mean()
+    denom = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denom) if denom > 0 else 0.0
+
+def estimate_homography(
+    frames : List[Tuple[np.ndarray, np.ndarray]],
+    method : str = 'sift',
+    max_features : int = 2000,
+    ratio : float = 0.8,
+    ransac_threshold : float = 3.0,
+    min_inliers : int = 12,
+    refine : bool = True
+) -> Tuple[np.ndarray, Dict]:
+    """Estimate the thermal to visible homography from (thermal, visible) pairs.
+
+    The correspondences of all frames are pooled in one RANSAC estimation so that a sample of frames
+    covering different depths gives a more stable homography than a single frame. The result is then
+    refined on each frame's edges (ECC), and a refinement is only kept if it improves the edge correlation.
+    """
+    if len(frames) == 0:
+        raise ValueError('At least one calibration frame is required!')
+    sources, dests = [], []
+    for thermal, visible in frames:
+        src, dst = match_features(thermal, visible, method, max_features, ratio)
+        sources.append(src)
+        dests.append(dst)
+    source = np.concatenate(sources)
+    dest = np.concatenate(dests)
+    if len(source) < max(4, min_inliers):
+        raise ValueError(f'Not enough feature matches ({len(source)}) for homography estimation!')
+    homography, mask = cv2.findHomography(source, dest, cv2.RANSAC, ransac_threshold)
+    if homography is None:
+        raise ValueError('Homography estimation has failed!')
+    mask = mask.ravel().astype(bool)
+    inliers = int(np.count_nonzero(mask))
+    # Reprojection error of the RANSAC inliers
+    errors = reprojection_errors(source[mask], dest[mask], homography)
+    ransac_rmse = float(np.sqrt(np.mean(errors ** 2))) if inliers > 0 else float('nan')
+    correlation = float(np.mean([edge_correlation(t, v, homography) for t, v in frames]))
+    refined = False
+    if refine and inliers >= min_inliers:
+        for thermal, visible in frames:
+            try:
+                candidate, _ = refine_homography(thermal, visible, homography)
+            except cv2.error:
+                continue
+            candidate_correlation = float(np.mean([edge_correlation(t, v, candidate) for t, v in frames]))
+            if candidate_correlation > correlation:
+                homography, correlation, refined = candidate, candidate_correlation, True
+    # The inliers and the reprojection error of the returned homography (refined or not)
+    errors = reprojection_errors(source, dest, homography)
+    final_mask = errors <= ransac_threshold
+    final_inliers = int(np.count_nonzero(final_mask))
+    rmse = float(np.sqrt(np.mean(errors[final_mask] ** 2))) if final_inliers > 0 else float('nan')
+    report = {
+        'method' : method,
+        'frames' : len(frames),
+        'matches' : int(len(source)),
+        'inliers' : final_inliers,
+        'inlier_ratio' : final_inliers / len(source),
+        'rmse' : rmse,
+        'ransac_inliers' : inliers,
+        'ransac_rmse' : ransac_rmse,
+        'refined' : refined,
+        'edge_correlation' : correlation
+    }
+    if inliers < min_inliers:
+        raise ValueError(f'Homography is not reliable, only {inliers} inliers are found!')
+    # A mirrored mapping is not a valid rig configuration
+    if np.linalg.det(homography[:2, :2]) <= 0:
+        raise ValueError('Estimated homography is degenerate!')
+    logging.info(f'Homography is estimated : {report}')
+    return homography, report
+
+def save_calibration_report(target_dir : str, report : Dict):
+    with open(os.path.join(target_dir, __homography_report__), 'w') as fr:
+        json.dump(report, fr, indent=4)
+
+def load_calibration_report(target_dir : str):
+    file = os.path.join(target_dir, __homography_report__)
+    if not os.path.isfile(file):
+        return None
+    with open(file, 'r') as fr:
+        return json.load(fr)
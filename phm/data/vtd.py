@@ -1,13 +1,12 @@
 
 import copy
+import logging
 from multiprocessing.sharedctypes import Value
-import os
 import numpy as np
 import open3d as o3d
-import imageio
 
-from pathlib import Path
 from dataclasses import dataclass
+from typing import List, Optional
 
 __depth_scale__ = 1000
 
@@ -61,10 +60,13 @@ class RGBDnT(O3DPointCloudWrapper):
 
     data : np.ndarray # channels : X Y Z R G B & T
     fid : str = ''
+    # Raw thermal values mapped to the intensities 0 and 255 (None if they are unknown)
+    thermal_range : Optional[List[float]] = None
 
     @property
     def depth_image(self):
-        return np.asarray(self.data[:,:,2] * __depth_scale__, np.uint16)
+        # Rounded, since the scaled back depth is not always an exact integer
+        return np.asarray(np.rint(self.data[:,:,2] * __depth_scale__), np.uint16)
 
     @depth_image.setter
     def depth_image(self, depth):
@@ -123,14 +125,8 @@ class RGBDnT(O3DPointCloudWrapper):
             ])
 
     def _convert_img_o3d(self, img : np.ndarray, fname : str):
-        temp_dir = os.path.join(os.getcwd(),'tmp')
-        if not os.path.isdir(temp_dir):
-            Path(temp_dir).mkdir(parents=True, exist_ok=True)
-        temp_file = os.path.join(temp_dir, fname)
-        imageio.imwrite(temp_file, img)
-        o3d_img = o3d.io.read_image(temp_file)
-        os.unlink(temp_file)
-        return o3d_img
+        # Same image as the former PNG round trip (lossless), without the temporary file shared by the workers
+        return o3d.geometry.Image(np.ascontiguousarray(img))
 
     def to_visible_image_o3d(self):
         return self._convert_img_o3d(self.visible_image, '.visible.png')
@@ -233,3 +229,277 @@ class DualPointCloudPack(O3DPointCloudWrapper):
     
     def get_visible_point_cloud(self, **kwargs):
         return self.visible_pointcloud
+
+    def transform(self, transformation):
+        self.visible_pointcloud.transform(transformation)
+        self.thermal_pointcloud.transform(transformation)
+        return self
+
+    def transform_points(self, func):
+        # Point-wise transformation (e.g. non-rigid) of both point clouds
+        for pc in (self.visible_pointcloud, self.thermal_pointcloud):
+            pc.points = o3d.utility.Vector3dVector(np.asarray(func(np.asarray(pc.points)), dtype=np.float64))
+        return self
+
+    def voxel_down_sample(self, voxel_size : float):
+        return DualPointCloudPack(
+            self.visible_pointcloud.voxel_down_sample(voxel_size=voxel_size),
+            self.thermal_pointcloud.voxel_down_sample(voxel_size=voxel_size)
+        )
+
+    def __iadd__(self, other):
+        self.visible_pointcloud += other.get_visible_point_cloud()
+        self.thermal_pointcloud += other.get_thermal_point_cloud()
+        return self
+
+def match_points(points : np.ndarray, subset : np.ndarray) -> Optional[np.ndarray]:
+    """Index of every point of subset in points (None if some of them are not in points)."""
+    if len(points) == len(subset) and np.array_equal(points, subset):
+        return np.arange(len(points))
+    if len(points) == 0 or points.dtype != subset.dtype:
+        return None
+    # The points are compared as raw rows
+    row_type = np.dtype((np.void, points.dtype.itemsize * points.shape[1]))
+    rows = np.ascontiguousarray(points).view(row_type).ravel()
+    subset_rows = np.ascontiguousarray(subset).view(row_type).ravel()
+    order = np.argsort(rows, kind='stable')
+    index = order[np.minimum(np.searchsorted(rows[order], subset_rows), len(rows) - 1)]
+    return index if np.array_equal(rows[index], subset_rows) else None
+
+def _concat_attribute(packs : List, name : str) -> Optional[np.ndarray]:
+    # Same rule as o3d : an attribute is kept if both point clouds have it (or the first one is empty)
+    parts, count = [], 0
+    for pack in packs:
+        value = getattr(pack, name)
+        if value is None or (not parts and count > 0):
+            parts = []
+        else:
+            parts.append(value)
+        count += pack.point_count
+    return np.concatenate(parts) if parts else None
+
+class MultiModalPointCloud(O3DPointCloudWrapper):
+    """Dual point cloud sharing one geometry between the visible and the thermal modalities.
+
+    The positions and the normals are stored once, with a visible colour and a thermal value per point.
+    The thermal point cloud is made of the points in thermal_mask (all of them if it is None), so the pair
+    of a visible point cloud and a thermal point cloud whose points are a subset of the visible ones is
+    represented without loss. The o3d point clouds of both modalities are only built on demand.
+    """
+    def __init__(self,
+        points : np.ndarray,
+        colors : np.ndarray = None,
+        thermal : np.ndarray = None,
+        normals : np.ndarray = None,
+        thermal_mask : np.ndarray = None
+    ) -> None:
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        count = len(self.points)
+        self.colors = colors
+        # Grey level of the thermal point cloud (0 for the points without thermal value)
+        self.thermal = thermal if thermal is not None else np.zeros(count)
+        self.normals = normals
+        self.thermal_mask = thermal_mask
+        for name in ('colors', 'thermal', 'normals', 'thermal_mask'):
+            value = getattr(self, name)
+            if value is not None and len(value) != count:
+                raise ValueError(f'The {name} do not match the points ({len(value)} != {count})!')
+
+    @classmethod
+    def from_pair(cls, visible_pc : o3d.geometry.PointCloud, thermal_pc : o3d.geometry.PointCloud) -> 'MultiModalPointCloud':
+        points = np.array(visible_pc.points)
+        thermal_points = np.asarray(thermal_pc.points)
+        index = match_points(points, thermal_points)
+        # The thermal points are taken in the order of the visible ones
+        if index is None or np.any(np.diff(index) <= 0):
+            raise ValueError('The thermal points are not a subset of the visible points!')
+        thermal = np.zeros(len(points))
+        if len(index) > 0 and not thermal_pc.has_colors():
+            raise ValueError('The thermal point cloud has no values!')
+        if thermal_pc.has_colors():
+            tcolors = np.asarray(thermal_pc.colors)
+            if not np.array_equal(tcolors, tcolors[:, :1].repeat(3, axis=1)):
+                raise ValueError('The thermal colors are not grey levels!')
+            thermal[index] = tcolors[:, 0]
+        normals = np.array(visible_pc.normals) if visible_pc.has_normals() else None
+        if thermal_pc.has_normals() and (normals is None or not np.array_equal(normals[index], np.asarray(thermal_pc.normals))):
+            raise ValueError('The thermal normals do not match the visible normals!')
+        thermal_mask = None
+        if len(index) != len(points):
+            thermal_mask = np.zeros(len(points), dtype=bool)
+            thermal_mask[index] = True
+        return cls(
+            points,
+            np.array(visible_pc.colors) if visible_pc.has_colors() else None,
+            thermal, normals, thermal_mask
+        )
+
+    def __len__(self):
+        return 2
+
+    @property
+    def point_count(self) -> int:
+        return len(self.points)
+
+    @property
+    def thermal_point_count(self) -> int:
+        return self.point_count if self.thermal_mask is None else int(np.count_nonzero(self.thermal_mask))
+
+    def _select(self, mask : np.ndarray = None) -> 'MultiModalPointCloud':
+        if mask is None:
+            return self
+        return MultiModalPointCloud(
+            self.points[mask],
+            self.colors[mask] if self.colors is not None else None,
+            self.thermal[mask],
+            self.normals[mask] if self.normals is not None else None
+        )
+
+    def _to_o3d(self, colors : np.ndarray = None) -> o3d.geometry.PointCloud:
+        pc = o3d.geometry.PointCloud()
+        pc.points = o3d.utility.Vector3dVector(self.points)
+        if colors is not None:
+            pc.colors = o3d.utility.Vector3dVector(colors)
+        if self.normals is not None:
+            pc.normals = o3d.utility.Vector3dVector(self.normals)
+        return pc
+
+    def get_visible_point_cloud(self, **kwargs):
+        return self._to_o3d(self.colors)
+
+    def get_thermal_point_cloud(self, **kwargs):
+        pack = self._select(self.thermal_mask)
+        if 'remove_invalids' in kwargs and kwargs['remove_invalids']:
+            pack = pack._select(pack.thermal > 0)
+        return pack._to_o3d(np.repeat(pack.thermal[:, np.newaxis], 3, axis=1))
+
+    def get_fused_point_cloud(self, **kwargs):
+        # Visible colours replaced by the thermal values where they are available
+        colors = self.colors.copy() if self.colors is not None else np.zeros((self.point_count, 3))
+        valid = self.thermal > 0
+        if self.thermal_mask is not None:
+            valid &= self.thermal_mask
+        colors[valid, :] = self.thermal[valid, np.newaxis]
+        return self._to_o3d(colors)
+
+    @property
+    def visible_pointcloud(self) -> o3d.geometry.PointCloud:
+        return self.get_visible_point_cloud()
+
+    @property
+    def thermal_pointcloud(self) -> o3d.geometry.PointCloud:
+        return self.get_thermal_point_cloud()
+
+    def to_pair(self) -> DualPointCloudPack:
+        return DualPointCloudPack(self.get_visible_point_cloud(), self.get_thermal_point_cloud())
+
+    def transform(self, transformation):
+        # Same as o3d : homogeneous points, the normals are only rotated
+        transformation = np.asarray(transformation)
+        points = self.points @ transformation[:3, :3].T + transformation[:3, 3]
+        if not np.array_equal(transformation[3], [0, 0, 0, 1]):
+            points /= (self.points @ transformation[3, :3] + transformation[3, 3])[:, np.newaxis]
+        self.points = points
+        if self.normals is not None:
+            self.normals = self.normals @ transformation[:3, :3].T
+        return self
+
+    def transform_points(self, func):
+        # Point-wise transformation (e.g. non-rigid) of the shared geometry
+        self.points = np.asarray(func(self.points), dtype=np.float64).reshape(-1, 3)
+        return self
+
+    def voxel_down_sample(self, voxel_size : float) -> 'MultiModalPointCloud':
+        """Average of the points in every voxel, the thermal value is averaged over the thermal points only."""
+        if self.point_count == 0:
+            return MultiModalPointCloud(self.points)
+        # Same grid as o3d, its origin is half a voxel below the bounds
+        origin = self.points.min(axis=0) - voxel_size / 2
+        voxels = np.floor((self.points - origin) / voxel_size).astype(np.int64)
+        _, inverse, counts = np.unique(voxels, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        def _mean(values : np.ndarray, weights : np.ndarray = None, total : np.ndarray = counts):
+            values = values if weights is None else values * weights[:, np.newaxis]
+            sums = np.stack([np.bincount(inverse, weights=values[:, k], minlength=len(total)) for k in range(values.shape[1])], axis=1)
+            return sums / np.maximum(total, 1)[:, np.newaxis]
+
+        # The normals are averaged without normalization, as o3d does
+        normals = _mean(self.normals) if self.normals is not None else None
+        thermal_mask = None
+        if self.thermal_mask is None:
+            thermal = _mean(self.thermal[:, np.newaxis])[:, 0]
+        else:
+            thermal_counts = np.bincount(inverse, weights=self.thermal_mask, minlength=len(counts))
+            thermal = _mean(self.thermal[:, np.newaxis], self.thermal_mask.astype(np.float64), thermal_counts)[:, 0]
+            thermal_mask = thermal_counts > 0
+        return MultiModalPointCloud(
+            _mean(self.points),
+            _mean(self.colors) if self.colors is not None else None,
+            thermal, normals, thermal_mask
+        )
+
+    def __iadd__(self, other):
+        if not isinstance(other, MultiModalPointCloud):
+            try:
+                other = MultiModalPointCloud.from_pair(other[0], other[1])
+            except ValueError:
+                # The result falls back to a pair of point clouds
+                pair = self.to_pair()
+                pair += other
+                return pair
+        res = MultiModalPointCloud.concatenate([self, other])
+        self.points, self.colors, self.thermal = res.points, res.colors, res.thermal
+        self.normals, self.thermal_mask = res.normals, res.thermal_mask
+        return self
+
+    @classmethod
+    def concatenate(cls, packs : List['MultiModalPointCloud']) -> 'MultiModalPointCloud':
+        """Accumulation of the packs in a new one (same result as +=), every array is concatenated once."""
+        thermal_mask = None
+        if any(p.thermal_mask is not None for p in packs):
+            thermal_mask = np.concatenate([
+                p.thermal_mask if p.thermal_mask is not None else np.ones(p.point_count, dtype=bool)
+                for p in packs
+            ])
+        return cls(
+            np.concatenate([p.points for p in packs]),
+            _concat_attribute(packs, 'colors'),
+            np.concatenate([p.thermal for p in packs]),
+            _concat_attribute(packs, 'normals'),
+            thermal_mask
+        )
+
+def fuse_point_clouds(packs : List) -> O3DPointCloudWrapper:
+    """Accumulation of the packs in a new one, the shared geometry packs are concatenated at once."""
+    if all(isinstance(p, MultiModalPointCloud) for p in packs):
+        return MultiModalPointCloud.concatenate(packs)
+    fused = copy.deepcopy(packs[0])
+    for pack in packs[1:]:
+        fused += pack
+    return fused
+
+def pack_point_clouds(pairs : List, copy_packs : bool = False) -> List:
+    """Shared geometry packs of (visible, thermal) pairs.
+
+    DualPointCloudPack are returned if the geometry of some pair cannot be shared, so all the packs can be accumulated together.
+    """
+    packs = []
+    for pair in pairs:
+        if isinstance(pair, MultiModalPointCloud):
+            packs.append(copy.deepcopy(pair) if copy_packs else pair)
+            continue
+        try:
+            packs.append(MultiModalPointCloud.from_pair(pair[0], pair[1]))
+        except ValueError as ex:
+            logging.debug(f'Dual point clouds are kept : {ex}')
+            break
+    else:
+        return packs
+    # Fallback : two point clouds per frame
+    res = []
+    for pair in pairs:
+        visible_pc, thermal_pc = pair[0], pair[1]
+        if copy_packs:
+            visible_pc, thermal_pc = copy.deepcopy(visible_pc), copy.deepcopy(thermal_pc)
+        res.append(DualPointCloudPack(visible_pc, thermal_pc))
+    return res
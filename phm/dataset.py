@@ -6,53 +6,97 @@ import os
 import re
 
 from pathlib import Path
-from functools import lru_cache
-from typing import Callable
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Tuple, Union
 from progress.bar import Bar
 
+from phm.cache import FrameCache, get_frame_cache
 from phm.data import MMEContainer, MMERecord
 from phm.data.vtd import RGBDnT
 from phm.io import supported_modality_loaders, save_mme, load_entity
 from phm.io.mme import load_mme
 from phm.io.vtd import load_RGBDnT, save_RGBDnT, save_dual_point_cloud, save_point_cloud
-from phm.vtd import VTD_Alignment
+from phm.calibration import estimate_homography, load_calibration_report, save_calibration_report
+from phm.journal import BuildJournal, fingerprint_files
+from phm.normalization import ThermalNormalizer, __thermal_normalizer__
+from phm.summary import FrameSummaryIndex, summarize_frame
+from phm.transport import SharedBlock, share_tracker
+from phm.vtd import VTD_Alignment, save_homography
 from phm.utils import ftype_to_filext
 
 class Dataset:
-    def __init__(self) -> None:
-        super().__init__()
-        self.__index = 0
-
     def get(self, index : int):
         raise NotImplementedError()
-        
-    def reset(self):
-        self.__index = 0
 
-    def __getitem__(self, index : int):
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._view(range(len(self))[index])
         return self.get(index)
     
     def __len__(self):
         raise NotImplementedError()
 
     def __iter__(self):
-        return self
-    
-    def __next__(self):
-        data = self.get(self.__index)
-        self.__index += 1
-        return data
+        # Every loop has its own cursor
+        return (self.get(index) for index in range(len(self)))
+
+    def _view(self, indices):
+        return DatasetView(self, indices)
+
+    def select(self, indices : List[int]):
+        return self._view(list(indices))
+
+    def shard(self, index : int, count : int, contiguous : bool = False):
+        if count <= 0 or index < 0 or index >= count:
+            raise ValueError(f'Shard {index} of {count} is invalid!')
+        indices = range(len(self))
+        if contiguous:
+            return self._view(indices[(len(self) * index) // count : (len(self) * (index + 1)) // count])
+        return self._view(indices[index::count])
+
+class DatasetView(Dataset):
+    def __init__(self, dataset : Dataset, indices) -> None:
+        super().__init__()
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get(self, index : int):
+        return self.dataset.get(self.indices[index])
+
+    def _view(self, indices):
+        # Views of views refer directly to the original dataset
+        if isinstance(self.indices, range) and isinstance(indices, range):
+            start, step = self.indices.start, self.indices.step
+            return DatasetView(self.dataset, range(
+                start + step * indices.start, 
+                start + step * indices.stop, 
+                step * indices.step))
+        return DatasetView(self.dataset, [self.indices[i] for i in indices])
+
+    @property
+    def data(self):
+        return [self.dataset.data[i] for i in self.indices]
 
 class Dataset_LoadableFunc(Dataset):
     def __init__(self, 
         in_dir : str,
         file_type : str,
-        load_func : Callable
+        load_func : Callable,
+        cache : FrameCache = None
     ) -> None:
         super().__init__()
         self.in_dir = in_dir
         self.file_type = file_type
         self._load_func = load_func
+        # Frames are cached only once (by fid) in the process-wide cache,
+        # datasets loading the same files differently never share their frames
+        self.cache = cache if cache is not None else get_frame_cache()
+        loader = getattr(load_func, '__qualname__', type(load_func).__qualname__)
+        self.namespace = f'{os.path.abspath(in_dir)}:{file_type}:{getattr(load_func, "__module__", "")}.{loader}'
         self.__init()
 
     def __init(self):
@@ -69,117 +113,354 @@ class Dataset_LoadableFunc(Dataset):
                 continue
             self.data.append((ptn[0], f))
         self.data.sort(key=lambda x : x[0])
+        self._fid_index = {fid : index for index, (fid, _) in enumerate(self.data)}
         print(f'Found {len(self.data)} {self.file_type} items.')
 
     def __len__(self):
         return len(self.data)
+
+    def __getstate__(self):
+        # The process-wide cache is not sent, workers attach to their own
+        state = self.__dict__.copy()
+        if self.cache is get_frame_cache():
+            state['cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cache is None:
+            self.cache = get_frame_cache()
     
-    @lru_cache(maxsize=10)
+    def _load(self, file : str):
+        return self._load_func(file, self.file_type)
+
     def get_by_fid(self, fid : str):
-        index = 0
-        try:
-            index = [x[0] for x in self.data].index(fid)
-            return self.get(index)
-        except ValueError as ex:
-            logging.exception(ex)
+        if not fid in self._fid_index:
             raise ValueError(f'fid ({fid}) does not exist!')
+        return self.get(self._fid_index[fid])
+
+    def select_fids(self, fids : List[str]):
+        return self.select(sorted(self._fid_index[fid] for fid in fids if fid in self._fid_index))
 
-    @lru_cache(maxsize=10)
     def get(self, index : int):
         if index >= len(self):
-            raise StopIteration
+            raise IndexError(f'Index ({index}) is out of range!')
         fid, file = self.data[index]
-        return (fid, self._load_func(file, self.file_type))
+        # A rewritten file is never served from the cache
+        st = os.stat(file)
+        key = (fid, st.st_mtime_ns, st.st_size)
+        return (fid, self.cache.get_or_load(self.namespace, key, lambda: self._load(file)))
 
 class VTD_Dataset(Dataset_LoadableFunc):
-    def __init__(self, in_dir: str) -> None:
-        super().__init__(in_dir, 'mat', load_RGBDnT)
+    def __init__(self, in_dir: str, cache : FrameCache = None) -> None:
+        super().__init__(in_dir, 'mat', load_RGBDnT, cache=cache)
 
-    @lru_cache(maxsize=10)
-    def get(self, index : int):
-        if index >= len(self):
-            raise StopIteration
-        fid, file = self.data[index]
-        return (fid, self._load_func(file))
+    def _load(self, file : str):
+        return self._load_func(file)
 
-def create_mme_dataset(
-    root_dir : str, 
-    res_dir : str,
-    file_type : str
-):
+def extract_fid(fname : str):
+    ptn = re.findall(r'\d{12}\d+', fname)
+    return ptn[0] if ptn else None
+
+def list_modality_files(dtype_dir : str, file_extension : str = 'png') -> Dict[str, str]:
+    # List the folder only once and index the files by their fid
+    files = {}
+    with os.scandir(dtype_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.' + file_extension) or not entry.is_file():
+                continue
+            fid = extract_fid(entry.name)
+            if fid is None:
+                logging.warning(f'{entry.name} does not follow the supported naming!')
+                continue
+            files[fid] = entry.path
+    return files
+
+def find_modality_folders(root_dir : str, *exclude_dirs : str) -> Dict[str, str]:
     # Check the validity of root directory
     if root_dir is None or not os.path.isdir(root_dir):
         raise ValueError(f'{root_dir} is an invalid directory path!')
     # Find directories associated with the data types
+    exclude_dirs = [os.path.abspath(x) for x in exclude_dirs if x is not None]
     sub_folders = {}
     for dtype in supported_modality_loaders():
         dtype_dir = os.path.join(root_dir, str(dtype))
-        if os.path.isdir(dtype_dir):
+        # The result directories are not source modalities
+        if os.path.isdir(dtype_dir) and not os.path.abspath(dtype_dir) in exclude_dirs:
             sub_folders[dtype] = dtype_dir
 
     if not sub_folders:
         raise ValueError('No supported modalities has been found!')
-    
-    existing_types = tuple(sub_folders.keys())
-    # Create the result directory
-    file_extension = file_type
-    Path(res_dir).mkdir(parents=True, exist_ok=True)
     # List all visible images
-    if not 'visible' in existing_types:
+    if not 'visible' in sub_folders:
         raise ValueError('Visible modality does not found!')
-    
-    vfiles = glob.glob(os.path.join(sub_folders['visible'], '*.png'))
-    vfiles.sort(key=os.path.getmtime)
-    # Extract file ids
-    file_ids = []
-    for x in vfiles:
-        fname = os.path.basename(x)
-        ptn = re.findall(r'\d{12}\d+', fname)
-        if not ptn:
-            logging.warning(f'{fname} does not follow the supported naming!')
+    return sub_folders
+
+def index_modalities(sub_folders : Dict[str, str]) -> Dict[str, Dict[str, str]]:
+    # Index every modality folder with one directory listing
+    return {dtype : list_modality_files(dfolder) for dtype, dfolder in sub_folders.items()}
+
+def _closest_frame(others : List[Tuple[int, str]], start : int, stop : int, ts : int, tolerance : int) -> int:
+    # Index of the closest frame to ts within the tolerance among others[start:stop] (None if there is none)
+    best = None
+    k = start
+    while k < stop and others[k][0] <= ts + tolerance:
+        if others[k][0] >= ts - tolerance and \
+           (best is None or abs(others[k][0] - ts) < abs(others[best][0] - ts)):
+            best = k
+        k += 1
+    return best
+
+def match_modalities(
+    indexed : Dict[str, Dict[str, str]],
+    tolerance : int = 0
+) -> List[Tuple[str, Dict[str, str]]]:
+    # Every modality is sorted once, then paired with the visible frames through a linear merge
+    ref = sorted(indexed['visible'].items(), key=lambda x : int(x[0]))
+    ref_ts = [int(fid) for fid, _ in ref]
+    matched = {fid : {'visible' : fpath} for fid, fpath in ref}
+    for dtype, files in indexed.items():
+        if dtype == 'visible':
             continue
-        file_ids.append(ptn[0])
-    # Generate the files
-    matched = 0
-
-    with Bar('Creating MME Dataset', max=len(file_ids)) as bar:
-        for ptn in file_ids:
-            container = MMEContainer(cid=ptn)
-            # Check if find all modalities
-            modalities = {}
-            for (dtype, dfolder) in sub_folders.items():
-                fname = f'{str(dtype)}_{ptn}.png'
-                full_path = os.path.join(dfolder, fname)
-                if not os.path.isfile(full_path):
-                    # logging.warning(f'{fname} does not exist!')
+        others = sorted((int(fid), fpath) for fid, fpath in files.items())
+        j = 0
+        for index, ts in enumerate(ref_ts):
+            # Skip the frames that are too old for the current timestamp
+            while j < len(others) and others[j][0] < ts - tolerance:
+                j += 1
+            best = _closest_frame(others, j, len(others), ts, tolerance)
+            if best is None:
+                continue
+            # The frame is left to the next timestamp only if they are mutually the closest,
+            # the current timestamp then takes the closest of the earlier frames
+            if index + 1 < len(ref_ts) and \
+               abs(others[best][0] - ref_ts[index + 1]) < abs(others[best][0] - ts) and \
+               _closest_frame(others, j, len(others), ref_ts[index + 1], tolerance) == best:
+                best = _closest_frame(others, j, best, ts, tolerance)
+                if best is None:
                     continue
-                modalities[dtype] = full_path
-
-            if len(modalities) == len(existing_types):
-                matched += 1        
-                # Add modalities to the container
-                for (dtype, fpath) in modalities.items():
-                    container.add_entity(MMERecord(
-                        type=dtype,
-                        file=fpath,
-                        data=load_entity(dtype, fpath)
-                    ))
-                # Save the container
-                save_mme(
-                    os.path.join(res_dir, f'mme_{ptn}.{file_extension}'),
-                    record=container,
-                    file_type=file_type
-                )
+            matched[ref[index][0]][dtype] = others[best][1]
+            # Each frame is paired only once
+            j = best + 1
+    return [(fid, modalities) for fid, modalities in matched.items() if len(modalities) == len(indexed)]
+
+def load_mme_container(fid : str, modalities : Dict[str, str]) -> MMEContainer:
+    container = MMEContainer(cid=fid)
+    # Add modalities to the container
+    for (dtype, fpath) in modalities.items():
+        container.add_entity(MMERecord(
+            type=dtype,
+            file=fpath,
+            data=load_entity(dtype, fpath)
+        ))
+    return container
+
+def sample_calibration_fids(fids : List[str], sample_size : int = 5) -> List[str]:
+    # The samples are spread over the sequence so that they cover different parts of the scene
+    if len(fids) <= sample_size:
+        return list(fids)
+    step = len(fids) / sample_size
+    return [fids[int(index * step + step / 2)] for index in range(sample_size)]
+
+def estimate_session_homography(
+    root_dir : str,
+    calib_dir : str,
+    calib_fids : List[str] = None,
+    calib_samples : int = 5,
+    tolerance : int = 0,
+    force : bool = False,
+    **kwargs
+) -> Dict:
+    homography_file = os.path.join(calib_dir, 'homography.mat')
+    if not force and os.path.isfile(homography_file):
+        return load_calibration_report(calib_dir)
+    matched = match_modalities(index_modalities(find_modality_folders(root_dir, calib_dir)), tolerance)
+    lookup = dict(matched)
+    fids = [fid for fid in calib_fids if fid in lookup] if calib_fids else \
+        sample_calibration_fids([fid for fid, _ in matched], calib_samples)
+    if len(fids) == 0:
+        raise ValueError(f'No calibration frame is available in {root_dir}!')
+    frames = [load_mme_container(fid, lookup[fid]) for fid in fids]
+    homography, report = estimate_homography(
+        [(data['thermal'].data, data['visible'].data) for data in frames], **kwargs)
+    report['fids'] = fids
+    Path(calib_dir).mkdir(parents=True, exist_ok=True)
+    save_homography(homography_file, homography)
+    save_calibration_report(calib_dir, report)
+    return report
+
+def calibrate_sessions(
+    sessions : List[Tuple[str, str]],
+    num_workers : int = None,
+    **kwargs
+) -> Dict[str, Dict]:
+    """Estimate the homography of multiple sessions, given as (root_dir, calib_dir) pairs."""
+    reports = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(estimate_session_homography, root_dir, calib_dir, **kwargs) : root_dir
+            for root_dir, calib_dir in sessions
+        }
+        for future in as_completed(futures):
+            root_dir = futures[future]
+            # A failed session does not stop the others
+            try:
+                reports[root_dir] = future.result()
+            except ValueError as ex:
+                logging.error(f'Calibration of {root_dir} has failed : {ex}')
+                reports[root_dir] = {'error' : str(ex)}
+    return reports
+
+def _compute_thermal_normalizer(
+    files : List[str],
+    load_thermal : Callable,
+    target_dir : str,
+    low_percentile : float = 0.0,
+    high_percentile : float = 100.0,
+    force : bool = False
+) -> ThermalNormalizer:
+    # Streaming pass over the thermal images of the files, the saved statistics are reused while the files are unchanged
+    files = sorted(files)
+    fingerprint = fingerprint_files(files, low_percentile, high_percentile)
+    if not force and ThermalNormalizer.exists(target_dir):
+        normalizer = ThermalNormalizer.load(target_dir)
+        if normalizer.fingerprint == fingerprint:
+            return normalizer
+        logging.info('Thermal inputs have changed, the thermal statistics are computed again')
+
+    normalizer = ThermalNormalizer(low_percentile, high_percentile)
+    normalizer.fingerprint = fingerprint
+    with Bar('Computing Thermal Statistics', max=len(files)) as bar:
+        for file in files:
+            normalizer.update(load_thermal(file))
             bar.next()
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    normalizer.save(target_dir)
+    logging.info(f'Thermal statistics : {normalizer.get_stats()}')
+    return normalizer
+
+def create_thermal_normalizer(
+    root_dirs : Union[str, List[str]],
+    target_dir : str,
+    low_percentile : float = 0.0,
+    high_percentile : float = 100.0,
+    force : bool = False
+) -> ThermalNormalizer:
+    """Streaming pass over the thermal images of one session (per-session) or several sessions (global)."""
+    root_dirs = [root_dirs] if isinstance(root_dirs, str) else root_dirs
+    files = []
+    for root_dir in root_dirs:
+        sub_folders = find_modality_folders(root_dir, target_dir)
+        if not 'thermal' in sub_folders:
+            raise ValueError(f'Thermal modality does not found in {root_dir}!')
+        files.extend(list_modality_files(sub_folders['thermal']).values())
+    return _compute_thermal_normalizer(files, lambda f: load_entity('thermal', f), 
+        target_dir, low_percentile, high_percentile, force)
+
+def _write_mme_container(
+    fid : str,
+    modalities : Dict[str, str],
+    file : str,
+    file_type : str
+):
+    container = load_mme_container(fid, modalities)
+    # Save the container
+    save_mme(file, record=container, file_type=file_type)
+    return fid
 
-    print(f'Total : {len(file_ids)}, Matched : {matched}')
+def create_mme_dataset(
+    root_dir : str, 
+    res_dir : str,
+    file_type : str,
+    num_workers : int = None,
+    force : bool = False,
+    tolerance : int = 0
+):
+    sub_folders = find_modality_folders(root_dir, res_dir)
+    # Create the result directory
+    file_extension = file_type
+    Path(res_dir).mkdir(parents=True, exist_ok=True)
+    
+    indexed = index_modalities(sub_folders)
+    matched = match_modalities(indexed, tolerance)
+    # Skip the containers that are up-to-date
+    journal = BuildJournal(res_dir, f'mme_{file_type}')
+    if force:
+        journal.reset()
+    pending = []
+    for fid, modalities in matched:
+        file = os.path.join(res_dir, f'mme_{fid}.{file_extension}')
+        fingerprint = fingerprint_files(sorted(modalities.values()), file_type)
+        if not journal.is_done(fid, fingerprint, [file]):
+            pending.append((fid, modalities, file, fingerprint))
+    # Generate the files
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    with Bar('Creating MME Dataset', max=len(pending)) as bar:
+        if not num_workers or num_workers <= 1:
+            for fid, modalities, file, fingerprint in pending:
+                _write_mme_container(fid, modalities, file, file_type)
+                journal.mark_done(fid, fingerprint)
+                bar.next()
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = {
+                    executor.submit(_write_mme_container, fid, modalities, file, file_type) : (fid, fingerprint)
+                    for fid, modalities, file, fingerprint in pending
+                }
+                for future in as_completed(futures):
+                    future.result()
+                    journal.mark_done(*futures[future])
+                    bar.next()
+
+    print(f'Total : {len(indexed["visible"])}, Matched : {len(matched)}, Skipped : {len(matched) - len(pending)}')
+
+def _alignment_options(refine : bool, undistort : bool):
+    # Only the enabled options enter the fingerprints, so the existing builds remain valid
+    return tuple(name for name, enabled in (('refine', refine), ('undistort', undistort)) if enabled)
+
+__vtd_align = None
+__vtd_dataset = None
+
+def _init_vtd_worker(align : VTD_Alignment, dataset : Dataset):
+    global __vtd_align, __vtd_dataset
+    __vtd_align = align
+    __vtd_dataset = dataset
+
+def _align_vtd_frame(index : int) -> Tuple[str, SharedBlock]:
+    # The aligned frame is returned in shared memory instead of being pickled
+    fid, data = __vtd_dataset.get(index)
+    block = SharedBlock.create(__vtd_align.compute(data))
+    return fid, block.disown()
+
+def _map_aligned_frames(executor : ProcessPoolExecutor, indexes : List[int], max_pending : int):
+    # Aligned frames in the order of the indexes, at most max_pending of them are in flight
+    pending = deque()
+    try:
+        for index in indexes:
+            pending.append((index, executor.submit(_align_vtd_frame, index)))
+            if len(pending) >= max_pending:
+                yield pending[0][0], pending.popleft()[1].result()
+        while pending:
+            yield pending[0][0], pending.popleft()[1].result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+            if not future.cancelled() and future.exception() is None:
+                future.result()[1].adopt().release()
 
 def create_vtd_dataset(
     in_dir : str,
     target_dir : str,
     depth_param_file : str,
     in_type : str,
-    homography_fid : str = None):
+    homography_fid : str = None,
+    force : bool = False,
+    calib_samples : int = 5,
+    refine : bool = False,
+    thermal_normalization : bool = False,
+    undistort : bool = False,
+    thermal_param_file : str = None,
+    num_workers : int = 1):
     
     if not os.path.isdir(in_dir):
         raise ValueError('Data directory does not exist!')
@@ -188,54 +469,256 @@ def create_vtd_dataset(
 
     align = VTD_Alignment(
         target_dir=target_dir,
-        depth_param_file=depth_param_file
+        depth_param_file=depth_param_file,
+        refine=refine,
+        undistort=undistort,
+        thermal_param_file=thermal_param_file
     )
-    dataset = Dataset_LoadableFunc(in_dir, in_type, load_mme)
+    # Every frame is loaded once (here or in a worker), so the frames are not cached
+    dataset = Dataset_LoadableFunc(in_dir, in_type, load_mme, cache=FrameCache(max_bytes=0))
     # Estimate Alignment Parameters
     if homography_fid is not None:
         align.estimate_alignment_params(dataset.get_by_fid(homography_fid))
+    elif align.homography is None:
+        fids = sample_calibration_fids([fid for fid, _ in dataset.data], calib_samples)
+        align.estimate_alignment_params([dataset.get_by_fid(fid) for fid in fids])
+    # Dataset-wide thermal statistics (one extra pass over the containers)
+    if thermal_normalization:
+        align.thermal_normalizer = _compute_thermal_normalizer([file for _, file in dataset.data], 
+            lambda f: load_mme(f, in_type)['thermal'].data, target_dir)
 
-    with Bar('Creating VTD Dataset', max=len(dataset)) as bar:
-        for x in dataset:
-            fid = x[0]
-            data = x[1]
-            res = align.compute(data)
-            save_RGBDnT(os.path.join(target_dir, f'vtd_{fid}.mat'), res)
+    journal = BuildJournal(target_dir, 'vtd')
+    if force:
+        journal.reset()
+    # The outputs depend on the alignment parameters as well
+    def _fingerprint(file):
+        files = [file, depth_param_file]
+        normalizer_file = os.path.join(target_dir, __thermal_normalizer__) if thermal_normalization else None
+        for f in (align.homography_file, normalizer_file, thermal_param_file):
+            if f is not None and os.path.isfile(f):
+                files.append(f)
+        # The refined/undistorted frames differ from the ones aligned by the global homography
+        return fingerprint_files(files, *_alignment_options(refine, undistort))
+    pending = []
+    for index, (fid, file) in enumerate(dataset.data):
+        if not journal.is_done(fid, _fingerprint(file), [os.path.join(target_dir, f'vtd_{fid}.mat')]):
+            pending.append(index)
+
+    summary = FrameSummaryIndex.open(target_dir)
+    def _write(index, fid, res):
+        save_RGBDnT(os.path.join(target_dir, f'vtd_{fid}.mat'), res)
+        summary.add(fid, summarize_frame(res))
+        journal.mark_done(fid, _fingerprint(dataset.data[index][1]))
+
+    with Bar('Creating VTD Dataset', max=len(pending)) as bar:
+        if not num_workers or num_workers <= 1:
+            for index in pending:
+                fid, data = dataset.get(index)
+                _write(index, fid, align.compute(data))
+                bar.next()
+        else:
+            # The workers align the frames, this process writes them
+            share_tracker()
+            with ProcessPoolExecutor(max_workers=num_workers,
+                initializer=_init_vtd_worker, initargs=(align, dataset)) as executor:
+                for index, (fid, block) in _map_aligned_frames(executor, pending, 2 * num_workers):
+                    block.adopt()
+                    try:
+                        with block.open() as res:
+                            _write(index, fid, res)
+                    finally:
+                        block.release()
+                    bar.next()
+
+    print(f'Total : {len(dataset)}, Skipped : {len(dataset) - len(pending)}')
+    # The refinement statistics of the workers are not gathered
+    if refine and (not num_workers or num_workers <= 1):
+        logging.info(f'Homography refinement : {align.refine_stats}')
+
+def build_summary_index(in_dir : str, force : bool = False) -> FrameSummaryIndex:
+    if not os.path.isdir(in_dir):
+        raise ValueError('RGBD&T directory does not exist!')
+    
+    dataset = VTD_Dataset(in_dir, cache=FrameCache(max_bytes=0))
+    summary = FrameSummaryIndex.open(in_dir)
+    pending = [index for index, (fid, _) in enumerate(dataset.data) if force or not fid in summary]
+
+    with Bar('Indexing VTD Dataset', max=len(pending)) as bar:
+        for index in pending:
+            fid, data = dataset.get(index)
+            summary.add(fid, summarize_frame(data))
             bar.next()
+    return summary
 
 def create_point_cloud_dataset(
     in_dir : str,
     target_dir : str,
-    file_type : str
+    file_type : str,
+    force : bool = False
 ):
     if not os.path.isdir(in_dir):
         raise ValueError('RGBD&T directory does not exist!')
     
     Path(target_dir).mkdir(parents=True, exist_ok=True)
-    dataset = VTD_Dataset(in_dir)
+    dataset = VTD_Dataset(in_dir, cache=FrameCache(max_bytes=0))
     file_extension = ftype_to_filext(file_type)
 
-    with Bar('Creating Point Cloud Dataset', max=len(dataset)) as bar:
-        for x in dataset:
-            fid = x[0]
-            data = x[1]
+    journal = BuildJournal(target_dir, f'pcs_{file_type}')
+    if force:
+        journal.reset()
+    pending = []
+    for index, (fid, file) in enumerate(dataset.data):
+        if not journal.is_done(fid, fingerprint_files([file], file_type), 
+            [os.path.join(target_dir, f'pcs_{fid}.{file_extension}')]):
+            pending.append(index)
+
+    with Bar('Creating Point Cloud Dataset', max=len(pending)) as bar:
+        for index in pending:
+            fid, data = dataset.get(index)
             save_point_cloud(
                 file=os.path.join(target_dir,f'pcs_{fid}.{file_extension}'),
                 data=data,
                 file_type=file_type
             )
+            journal.mark_done(fid, fingerprint_files([dataset.data[index][1]], file_type))
             bar.next()
 
-def create_dual_point_cloud_dataset(in_dir : str, target_dir : str):
+    print(f'Total : {len(dataset)}, Skipped : {len(dataset) - len(pending)}')
+
+def create_dual_point_cloud_dataset(in_dir : str, target_dir : str, force : bool = False):
     if not os.path.isdir(in_dir):
         raise ValueError('RGBD&T directory does not exist!')
     
     Path(target_dir).mkdir(parents=True, exist_ok=True)
-    dataset = VTD_Dataset(in_dir)
+    dataset = VTD_Dataset(in_dir, cache=FrameCache(max_bytes=0))
+
+    journal = BuildJournal(target_dir, 'dual_pcs')
+    if force:
+        journal.reset()
+    pending = []
+    for index, (fid, file) in enumerate(dataset.data):
+        outputs = [
+            os.path.join(target_dir, f'thermal_{fid}.ply'),
+            os.path.join(target_dir, f'visible_{fid}.ply')
+        ]
+        if not journal.is_done(fid, fingerprint_files([file]), outputs):
+            pending.append(index)
 
-    with Bar('Processing', max=len(dataset)) as bar:
-        for x in dataset:
-            fid = x[0]
-            data = x[1]
+    with Bar('Processing', max=len(pending)) as bar:
+        for index in pending:
+            fid, data = dataset.get(index)
             save_dual_point_cloud(data, fid, target_dir)
-            bar.next()
\ No newline at end of file
+            journal.mark_done(fid, fingerprint_files([dataset.data[index][1]]))
+            bar.next()
+
+    print(f'Total : {len(dataset)}, Skipped : {len(dataset) - len(pending)}')
+
+__stream_align = None
+
+def _init_stream_worker(align : VTD_Alignment):
+    global __stream_align
+    __stream_align = align
+
+def _stream_dual_point_cloud(
+    fid : str,
+    modalities : Dict[str, str],
+    target_dir : str,
+    vtd_dir : str = None
+):
+    # Raw modalities -> aligned RGBD&T -> dual point clouds, all in memory
+    data = __stream_align.compute(load_mme_container(fid, modalities))
+    data.fid = fid
+    if vtd_dir is not None:
+        save_RGBDnT(os.path.join(vtd_dir, f'vtd_{fid}.mat'), data)
+    save_dual_point_cloud(data, fid, target_dir)
+    return fid, summarize_frame(data)
+
+def create_dual_point_cloud_stream(
+    root_dir : str,
+    target_dir : str,
+    depth_param_file : str,
+    vtd_dir : str = None,
+    calib_dir : str = None,
+    homography_fid : str = None,
+    num_workers : int = None,
+    force : bool = False,
+    tolerance : int = 0,
+    calib_samples : int = 5,
+    refine : bool = False,
+    thermal_normalization : bool = False,
+    undistort : bool = False,
+    thermal_param_file : str = None
+):
+    sub_folders = find_modality_folders(root_dir, target_dir, vtd_dir)
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    # Intermediate RGBD&T files are only written on demand
+    if vtd_dir is not None:
+        Path(vtd_dir).mkdir(parents=True, exist_ok=True)
+    calib_dir = calib_dir if calib_dir is not None else \
+        (vtd_dir if vtd_dir is not None else target_dir)
+    Path(calib_dir).mkdir(parents=True, exist_ok=True)
+
+    align = VTD_Alignment(
+        target_dir=calib_dir,
+        depth_param_file=depth_param_file,
+        refine=refine,
+        undistort=undistort,
+        thermal_param_file=thermal_param_file
+    )
+    matched = match_modalities(index_modalities(sub_folders), tolerance)
+    # Estimate Alignment Parameters (before the workers receive a copy of them)
+    if align.homography is None:
+        lookup = dict(matched)
+        if homography_fid is not None and not homography_fid in lookup:
+            raise ValueError(f'Calibration frame ({homography_fid}) does not exist!')
+        fids = [homography_fid] if homography_fid is not None else \
+            sample_calibration_fids([fid for fid, _ in matched], calib_samples)
+        align.estimate_alignment_params([(fid, load_mme_container(fid, lookup[fid])) for fid in fids])
+    if thermal_normalization:
+        align.thermal_normalizer = create_thermal_normalizer(root_dir, calib_dir)
+
+    journal = BuildJournal(target_dir, 'stream_dual_pcs')
+    if force:
+        journal.reset()
+    normalizer_file = os.path.join(calib_dir, __thermal_normalizer__) if thermal_normalization else None
+    def _fingerprint(modalities):
+        files = sorted(modalities.values()) + [depth_param_file, align.homography_file]
+        for f in (normalizer_file, thermal_param_file):
+            if f is not None and os.path.isfile(f):
+                files.append(f)
+        return fingerprint_files(files, *_alignment_options(refine, undistort))
+    pending = []
+    for fid, modalities in matched:
+        outputs = [
+            os.path.join(target_dir, f'thermal_{fid}.ply'),
+            os.path.join(target_dir, f'visible_{fid}.ply')
+        ]
+        if vtd_dir is not None:
+            outputs.append(os.path.join(vtd_dir, f'vtd_{fid}.mat'))
+        if not journal.is_done(fid, _fingerprint(modalities), outputs):
+            pending.append((fid, modalities))
+
+    summary = FrameSummaryIndex.open(target_dir)
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    with Bar('Streaming Dual Point Cloud Dataset', max=len(pending)) as bar:
+        if not num_workers or num_workers <= 1:
+            _init_stream_worker(align)
+            for fid, modalities in pending:
+                _, fsummary = _stream_dual_point_cloud(fid, modalities, target_dir, vtd_dir)
+                summary.add(fid, fsummary)
+                journal.mark_done(fid, _fingerprint(modalities))
+                bar.next()
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers, 
+                initializer=_init_stream_worker, initargs=(align,)) as executor:
+                futures = {
+                    executor.submit(_stream_dual_point_cloud, fid, modalities, target_dir, vtd_dir) : modalities
+                    for fid, modalities in pending
+                }
+                for future in as_completed(futures):
+                    fid, fsummary = future.result()
+                    summary.add(fid, fsummary)
+                    journal.mark_done(fid, _fingerprint(futures[future]))
+                    bar.next()
+
+    print(f'Total : {len(matched)}, Skipped : {len(matched) - len(pending)}')
@@ -12,15 +12,19 @@ from phm.data.vtd import DualPointCloudPack
 
 __rgbdt__ = 'rgbdt'
 __fid__ = 'fid'
+__thermal_range__ = 'thermal_range'
 
 def save_RGBDnT(file : str, record : RGBDnT):
     if record.data is None:
         raise ValueError('RGBD&T data is missing or corrupted!')
     
-    savemat(file, {
+    mat = {
         __rgbdt__ : record.data,
         __fid__ : record.fid
-    }, do_compression=True)
+    }
+    if record.thermal_range is not None:
+        mat[__thermal_range__] = np.asarray(record.thermal_range, dtype=np.float64)
+    savemat(file, mat, do_compression=True)
 
 def load_RGBDnT(file : str) -> RGBDnT:
     if not os.path.isfile(file):
@@ -33,8 +37,9 @@ def load_RGBDnT(file : str) -> RGBDnT:
     rgbdt = obj[__rgbdt__]
 
     fid = obj[__fid__] if __fid__ in obj else 'unknown'
+    thermal_range = obj[__thermal_range__].ravel().tolist() if __thermal_range__ in obj else None
 
-    return RGBDnT(fid=fid, data=rgbdt)
+    return RGBDnT(fid=fid, data=rgbdt, thermal_range=thermal_range)
 
 __pcloud_exporters = {}
 
@@ -0,0 +1,65 @@
+
+import os
+import json
+import hashlib
+import logging
+
+from typing import Dict, List
+
+def fingerprint_files(files : List[str], *params) -> str:
+    # The fingerprint only relies on the file stats so that checking a frame never reads it
+    hobj = hashlib.sha1()
+    for f in files:
+        st = os.stat(f)
+        hobj.update(f'{os.path.basename(f)}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    for p in params:
+        hobj.update(f'{p};'.encode())
+    return hobj.hexdigest()
+
+class BuildJournal:
+    def __init__(self, target_dir : str, name : str) -> None:
+        self.file = os.path.join(target_dir, f'.{name}.journal')
+        self._entries : Dict[str, str] = {}
+        self.__load()
+
+    def __load(self):
+        if not os.path.isfile(self.file):
+            return
+        lines = 0
+        with open(self.file, 'r') as fj:
+            for line in fj:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last record can be partially written if the build was interrupted
+                    logging.warning(f'Corrupted record in {self.file} is ignored!')
+                    continue
+                self._entries[record['fid']] = record['fingerprint']
+        # Remove the outdated records
+        if lines > 2 * len(self._entries):
+            self.compact()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_done(self, fid : str, fingerprint : str, outputs : List[str] = ()) -> bool:
+        return self._entries.get(fid) == fingerprint and \
+            all(os.path.isfile(f) for f in outputs)
+
+    def mark_done(self, fid : str, fingerprint : str):
+        self._entries[fid] = fingerprint
+        with open(self.file, 'a') as fj:
+            fj.write(json.dumps({'fid' : fid, 'fingerprint' : fingerprint}) + '\n')
+
+    def compact(self):
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, 'w') as fj:
+            for fid, fingerprint in self._entries.items():
+                fj.write(json.dumps({'fid' : fid, 'fingerprint' : fingerprint}) + '\n')
+        os.replace(tmp_file, self.file)
+
+    def reset(self):
+        self._entries = {}
+        if os.path.isfile(self.file):
+            os.unlink(self.file)
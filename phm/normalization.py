@@ -0,0 +1,105 @@
+
+import os
+import json
+import numpy as np
+
+from typing import Dict
+
+__thermal_normalizer__ = 'thermal_normalizer.json'
+__thermal_levels__ = 65536 # 16 bits radiometric thermal images
+
+class ThermalNormalizer:
+    """Dataset-wide thermal normalization.
+
+    The histogram of the raw thermal values is accumulated over the frames (update), and the raw values
+    are mapped to uint8 by a lookup table built from the global range (apply). Unlike the per-frame
+    min-max normalization, a temperature is mapped to the same intensity in all frames.
+    """
+    def __init__(self, low_percentile : float = 0.0, high_percentile : float = 100.0) -> None:
+        self.low_percentile = low_percentile
+        self.high_percentile = high_percentile
+        self.histogram = np.zeros(__thermal_levels__, dtype=np.int64)
+        self.frames = 0
+        # Fingerprint of the thermal inputs, so that the statistics are computed again when they change
+        self.fingerprint = None
+        self._lut = None
+
+    def __check(self, thermal : np.ndarray):
+        if thermal.dtype.kind != 'u' or thermal.dtype.itemsize > 2:
+            raise ValueError(f'Thermal images of type {thermal.dtype} are not supported!')
+
+    def update(self, thermal : np.ndarray):
+        self.__check(thermal)
+        self.histogram += np.bincount(thermal.ravel(), minlength=__thermal_levels__)
+        self.frames += 1
+        self._lut = None
+
+    def merge(self, other : 'ThermalNormalizer'):
+        # Combines the statistics of multiple sessions
+        self.histogram += other.histogram
+        self.frames += other.frames
+        self._lut = None
+
+    def __percentile(self, q : float) -> int:
+        cdf = np.cumsum(self.histogram)
+        if cdf[-1] == 0:
+            raise ValueError('Thermal statistics are empty!')
+        return int(np.searchsorted(cdf, cdf[-1] * q / 100.0, side='left' if q > 0 else 'right'))
+
+    @property
+    def low(self) -> int:
+        return self.__percentile(self.low_percentile)
+
+    @property
+    def high(self) -> int:
+        return self.__percentile(self.high_percentile)
+
+    @property
+    def lut(self) -> np.ndarray:
+        if self._lut is None:
+            low, high = self.low, self.high
+            levels = np.arange(__thermal_levels__, dtype=np.float32)
+            scale = np.float32(255.0) / np.float32(max(high - low, 1))
+            self._lut = (np.clip(levels - low, 0, high - low) * scale).astype(np.uint8)
+        return self._lut
+
+    def apply(self, thermal : np.ndarray) -> np.ndarray:
+        self.__check(thermal)
+        return self.lut[thermal]
+
+    def get_stats(self) -> Dict:
+        values = np.nonzero(self.histogram)[0]
+        return {
+            'frames' : self.frames,
+            'min' : int(values[0]) if len(values) > 0 else None,
+            'max' : int(values[-1]) if len(values) > 0 else None,
+            'low' : self.low,
+            'high' : self.high
+        }
+
+    def save(self, target_dir : str):
+        values = np.nonzero(self.histogram)[0]
+        with open(os.path.join(target_dir, __thermal_normalizer__), 'w') as fn:
+            json.dump({
+                'low_percentile' : self.low_percentile,
+                'high_percentile' : self.high_percentile,
+                'stats' : self.get_stats(),
+                'fingerprint' : self.fingerprint,
+                # Sparse histogram : [value, count]
+                'histogram' : [[int(v), int(self.histogram[v])] for v in values]
+            }, fn)
+
+    @staticmethod
+    def exists(target_dir : str) -> bool:
+        return os.path.isfile(os.path.join(target_dir, __thermal_normalizer__))
+
+    @staticmethod
+    def load(target_dir : str) -> 'ThermalNormalizer':
+        with open(os.path.join(target_dir, __thermal_normalizer__), 'r') as fn:
+            record = json.load(fn)
+        normalizer = ThermalNormalizer(record['low_percentile'], record['high_percentile'])
+        for value, count in record['histogram']:
+            normalizer.histogram[value] = count
+        normalizer.frames = record['stats']['frames']
+        normalizer.fingerprint = record.get('fingerprint')
+        return normalizer
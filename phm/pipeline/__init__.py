@@ -1,9 +1,15 @@
 
 
 __all__ = [
+    "cache",
+    "checkpoint",
     "core",
-    "o3d_pipeline"
+    "o3d_pipeline",
+    "profiling"
 ]
 
+from .cache import *
+from .checkpoint import *
 from .core import *
-from .o3d_pipeline import *
\ No newline at end of file
+from .o3d_pipeline import *
+from .profiling import *
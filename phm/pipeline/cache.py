@@ -0,0 +1,197 @@
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import numpy as np
+import open3d as o3d
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple
+
+from phm.transport import load_value, save_value
+
+__step_cache_manifest__ = 'manifest.json'
+__step_cache_version__ = 1
+__default_step_cache_size__ = 4 * 1024 * 1024 * 1024 # 4 GB
+# Number of stores between two writes of the manifest
+__step_cache_manifest_interval__ = 64
+
+def fingerprint(*tokens) -> str:
+    hobj = hashlib.sha1()
+    for t in tokens:
+        hobj.update(f'{t};'.encode())
+    return hobj.hexdigest()
+
+def param_token(value) -> str:
+    # Stable textual representation of a step parameter
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    if isinstance(value, np.generic):
+        return repr(value.item())
+    if isinstance(value, np.ndarray):
+        return f'array:{value.dtype}:{value.shape}:{hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(param_token(x) for x in value) + ']'
+    if isinstance(value, dict):
+        return '{' + ','.join(f'{k}:{param_token(value[k])}' for k in sorted(value, key=str)) + '}'
+    if isinstance(value, o3d.camera.PinholeCameraIntrinsic):
+        return f'pinhole:{value.width}:{value.height}:{param_token(np.asarray(value.intrinsic_matrix))}'
+    if hasattr(value, '__dict__'):
+        return f'{type(value).__name__}:{param_token(vars(value))}'
+    return type(value).__name__
+
+class StepCache:
+    """On-disk memoization of the pipeline step outputs.
+
+    The entries are addressed by a hash of the step parameters and of the fingerprints of its inputs, so
+    a changed parameter or input file only invalidates the steps depending on it. Every entry is an
+    uncompressed npz file, and the least recently used entries are evicted beyond max_bytes. The manifest
+    is written every few stores and on flush, the entries missing from it are dropped on the next load.
+    """
+    def __init__(self, cache_dir : str, max_bytes : int = __default_step_cache_size__) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        # key -> {step, bytes, created, accessed} from the least to the most recently used
+        self._entries : Dict[str, Dict] = OrderedDict()
+        self._bytes = 0
+        self._unsaved = 0
+        self._stats = {'hits' : 0, 'misses' : 0, 'evictions' : 0}
+        self.__load()
+
+    @property
+    def manifest_file(self) -> str:
+        return os.path.join(self.cache_dir, __step_cache_manifest__)
+
+    def _file(self, key : str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def __load(self):
+        entries = {}
+        if os.path.isfile(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r') as fm:
+                    record = json.load(fm)
+                if record.get('version') == __step_cache_version__:
+                    entries = record['entries']
+            except json.JSONDecodeError:
+                logging.warning(f'Corrupted manifest {self.manifest_file} is ignored!')
+        # The entries without file and the files without entry (interrupted writes) are dropped
+        self._entries = OrderedDict(sorted(
+            ((k, e) for k, e in entries.items() if os.path.isfile(self._file(k))),
+            key=lambda x: x[1]['accessed']
+        ))
+        self._bytes = sum(e['bytes'] for e in self._entries.values())
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.tmp') or (f.endswith('.npz') and f[:-len('.npz')] not in self._entries):
+                os.unlink(os.path.join(self.cache_dir, f))
+
+    def _save_manifest(self):
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as fm:
+            json.dump({'version' : __step_cache_version__, 'entries' : self._entries}, fm)
+        os.replace(tmp_file, self.manifest_file)
+        self._unsaved = 0
+
+    @property
+    def current_bytes(self) -> int:
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key : str):
+        return key in self._entries
+
+    def load(self, key : str) -> Tuple[bool, Any]:
+        with self._lock:
+            if not key in self._entries:
+                self._stats['misses'] += 1
+                return False, None
+        try:
+            value = load_value(self._file(key))
+        except (OSError, ValueError, KeyError) as ex:
+            logging.warning(f'Cache entry {key} cannot be loaded : {ex}')
+            with self._lock:
+                self._remove(key)
+                self._stats['misses'] += 1
+            return False, None
+        with self._lock:
+            self._stats['hits'] += 1
+            if key in self._entries:
+                self._entries[key]['accessed'] = time.time()
+                self._entries.move_to_end(key)
+        return True, value
+
+    def store(self, key : str, value : Any, name : str = '') -> bool:
+        file = self._file(key)
+        try:
+            # Entries larger than the budget are never cached
+            if not save_value(file, value, self.max_bytes):
+                return False
+        except TypeError as ex:
+            logging.warning(f'{name} outputs are not cached : {ex}')
+            return False
+        now = time.time()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old['bytes']
+            self._entries[key] = {
+                'step' : name,
+                'bytes' : os.path.getsize(file),
+                'created' : now,
+                'accessed' : now
+            }
+            self._bytes += self._entries[key]['bytes']
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._evict(key)
+            self._unsaved += 1
+            if self._unsaved >= __step_cache_manifest_interval__:
+                self._save_manifest()
+        return True
+
+    def get_or_compute(self, key : str, compute_func : Callable, name : str = '') -> Any:
+        found, value = self.load(key)
+        if not found:
+            value = compute_func()
+            self.store(key, value, name)
+        return value
+
+    def flush(self):
+        # The entries and their access times are saved every few stores or here
+        with self._lock:
+            self._save_manifest()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self._remove(key)
+            self._save_manifest()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self._stats,
+                'max_bytes' : self.max_bytes,
+                'bytes' : self.current_bytes,
+                'items' : len(self._entries)
+            }
+
+    def _remove(self, key : str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry['bytes']
+        if os.path.isfile(self._file(key)):
+            os.unlink(self._file(key))
+
+    def _evict(self, current : str):
+        key = next(k for k in self._entries if k != current)
+        self._stats['evictions'] += 1
+        self._remove(key)
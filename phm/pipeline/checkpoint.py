@@ -0,0 +1,159 @@
+
+import os
+import json
+import logging
+import threading
+
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from phm.transport import load_value, save_value
+
+__checkpoint_manifest__ = 'checkpoint.json'
+__checkpoint_version__ = 1
+
+class StepCheckpoint:
+    """Checkpoints of the frames processed by one step, e.g. the registered frames of a registration step.
+
+    The frames are saved in their own files, so a checkpoint does not rewrite the previous ones.
+    """
+    def __init__(self, checkpoint_dir : str, index : int) -> None:
+        self.checkpoint_dir = checkpoint_dir
+        self.index = index
+
+    def _file(self, frame : int) -> str:
+        return os.path.join(self.checkpoint_dir, f'step_{self.index}_frame_{frame}.npz')
+
+    def save_frame(self, frame : int, value : Any) -> bool:
+        try:
+            save_value(self._file(frame), value)
+        except TypeError as ex:
+            # The following frames cannot be resumed either
+            logging.warning(f'Frame {frame} is not checkpointed : {ex}')
+            return False
+        return True
+
+    def load_frames(self, start : int = 0, stop : int = None) -> List:
+        # Values of the consecutive frames saved from start
+        frames = []
+        frame = start
+        while (stop is None or frame < stop) and os.path.isfile(self._file(frame)):
+            try:
+                frames.append(load_value(self._file(frame)))
+            except (OSError, ValueError, KeyError) as ex:
+                logging.warning(f'Checkpoint of frame {frame} cannot be loaded : {ex}')
+                break
+            frame += 1
+        return frames
+
+    def clear(self):
+        prefix = f'step_{self.index}_frame_'
+        for f in os.listdir(self.checkpoint_dir):
+            if f.startswith(prefix):
+                os.unlink(os.path.join(self.checkpoint_dir, f))
+
+class PipelineCheckpoint:
+    """Outputs of the completed steps of a pipeline run, so an interrupted run can be resumed.
+
+    Every completed step writes its outputs in an uncompressed npz file and is recorded in the manifest,
+    together with the signature of the run (steps, parameters and input fingerprints). A resumed run with
+    the same signature takes the outputs of the completed steps from the checkpoint instead of running
+    them again, any other run starts from an empty checkpoint.
+    """
+    def __init__(self, checkpoint_dir : str) -> None:
+        self.checkpoint_dir = checkpoint_dir
+        Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.signature = None
+        # index -> {step, keys, stored}
+        self._steps : Dict[int, Dict] = {}
+
+    @property
+    def manifest_file(self) -> str:
+        return os.path.join(self.checkpoint_dir, __checkpoint_manifest__)
+
+    def _file(self, index : int) -> str:
+        return os.path.join(self.checkpoint_dir, f'step_{index}.npz')
+
+    def _save_manifest(self):
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as fm:
+            json.dump({
+                'version' : __checkpoint_version__,
+                'signature' : self.signature,
+                'steps' : {str(k) : v for k, v in self._steps.items()}
+            }, fm, indent=4)
+        os.replace(tmp_file, self.manifest_file)
+
+    def _read_manifest(self) -> Dict:
+        if not os.path.isfile(self.manifest_file):
+            return None
+        try:
+            with open(self.manifest_file, 'r') as fm:
+                record = json.load(fm)
+        except json.JSONDecodeError:
+            logging.warning(f'Corrupted checkpoint {self.manifest_file} is ignored!')
+            return None
+        return record if record.get('version') == __checkpoint_version__ else None
+
+    def begin(self, signature : str, resume : bool = False) -> List[int]:
+        """Start a run, returns the indexes of the steps restored from the checkpoint."""
+        with self._lock:
+            record = self._read_manifest() if resume else None
+            if record is not None and record['signature'] != signature:
+                logging.warning('The checkpoint belongs to another pipeline or input, the run starts over!')
+                record = None
+            self.signature = signature
+            if record is None:
+                self.clear()
+            else:
+                self._steps = {
+                    int(k) : v for k, v in record['steps'].items()
+                    if not v['stored'] or os.path.isfile(self._file(int(k)))
+                }
+            self._save_manifest()
+            return sorted(k for k, v in self._steps.items() if v['stored'])
+
+    def clear(self):
+        self._steps = {}
+        for f in os.listdir(self.checkpoint_dir):
+            if f.endswith('.npz') or f.endswith('.tmp'):
+                os.unlink(os.path.join(self.checkpoint_dir, f))
+
+    def step(self, index : int) -> StepCheckpoint:
+        return StepCheckpoint(self.checkpoint_dir, index)
+
+    def store_step(self, index : int, name : str, outputs : Dict) -> bool:
+        stored = True
+        try:
+            save_value(self._file(index), outputs)
+        except TypeError as ex:
+            # The step is run again by a resumed run
+            logging.warning(f'{name} outputs are not checkpointed : {ex}')
+            stored = False
+        with self._lock:
+            self._steps[index] = {
+                'step' : name,
+                'keys' : sorted(outputs.keys()) if outputs is not None else [],
+                'stored' : stored
+            }
+            self._save_manifest()
+        if stored:
+            # The frames of the step are no longer needed
+            self.step(index).clear()
+        return stored
+
+    def load_step(self, index : int) -> Tuple[bool, Dict]:
+        with self._lock:
+            entry = self._steps.get(index)
+        if entry is None or not entry['stored']:
+            return False, None
+        try:
+            return True, load_value(self._file(index))
+        except (OSError, ValueError, KeyError) as ex:
+            logging.warning(f'Checkpoint of step {index} cannot be loaded : {ex}')
+            return False, None
+
+    def completed(self) -> List[int]:
+        with self._lock:
+            return sorted(self._steps.keys())
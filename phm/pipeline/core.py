@@ -1,19 +1,33 @@
 
 import copy
+import logging
 import os
+import queue
+import re
+import threading
+import time
 from sys import prefix
 
-from typing import Dict, List, Tuple
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import GeneratorType
+from typing import Callable, Dict, List, Tuple
 from progress.bar import Bar
 from pathlib import Path
 
+import numpy as np
 import open3d as o3d
 
 from phm.data import RGBDnT
 from phm.io import load_RGBDnT
-from phm.data.vtd import DualPointCloudPack, __depth_scale__, filter_out_zero_thermal
+from phm.data.vtd import DualPointCloudPack, O3DPointCloudWrapper, __depth_scale__, filter_out_zero_thermal, fuse_point_clouds, match_points, pack_point_clouds
 from phm.io.vtd import load_dual_point_cloud
+from phm.journal import fingerprint_files
 from phm.vtd import load_pinhole
+from phm.pipeline.cache import StepCache, fingerprint, param_token
+from phm.pipeline.checkpoint import PipelineCheckpoint
+from phm.pipeline.parallel import ProcessItemPool
+from phm.pipeline.profiling import PipelineProfiler
 
 class RGBDnTBatch:
     def __init__(self, root_dir : str, filenames : List[str]):
@@ -33,6 +47,16 @@ class RGBDnTBatch:
     def count(self):
         return len(self.files)
 
+    @property
+    def fingerprints(self) -> List[str]:
+        return [fingerprint_files([fx]) for fx in self.files]
+
+    def get(self, index : int) -> RGBDnT:
+        return load_RGBDnT(self.files[index])
+
+    def item_loader(self, index : int) -> Tuple[Callable, Tuple]:
+        return load_RGBDnT, (self.files[index],)
+
     def __call__(self):
         return (load_RGBDnT(fx) for fx in self.files)
 
@@ -53,113 +77,359 @@ class DoublePointCloudBatch:
     def count(self):
         return len(self.files)
 
+    @property
+    def fingerprints(self) -> List[str]:
+        return [fingerprint_files(list(fx)) for fx in self.files]
+
+    def get(self, index : int) -> DualPointCloudPack:
+        return load_dual_point_cloud(*self.files[index])
+
+    def item_loader(self, index : int) -> Tuple[Callable, Tuple]:
+        return load_dual_point_cloud, tuple(self.files[index])
+
     def __call__(self):
         return (load_dual_point_cloud(fx[0], fx[1]) for fx in self.files)
 
+def sliding_windows(fids : List[str], window_size : int, stride : int) -> List[List[str]]:
+    if window_size < 2:
+        raise ValueError('Window size should be at least 2!')
+    if stride < 1 or stride >= window_size:
+        raise ValueError('Stride should be positive and smaller than the window size so that windows overlap!')
+    # Consecutive frames are ordered by their timestamp
+    fids = sorted(fids, key=int)
+    if len(fids) <= window_size:
+        return [fids]
+    windows = [fids[i:i + window_size] for i in range(0, len(fids) - window_size + 1, stride)]
+    # The last window always ends at the last frame
+    if windows[-1][-1] != fids[-1]:
+        windows.append(fids[-window_size:])
+    return windows
+
+class SequenceWindowBatcher:
+    def __init__(self, 
+        source,
+        window_size : int = 8,
+        stride : int = 4,
+        method_name : str = 'pc'
+    ) -> None:
+        self.window_size = window_size
+        self.stride = stride
+        if isinstance(source, str):
+            # Dual point clouds of the preprocessing directory
+            if not os.path.isdir(source):
+                raise FileNotFoundError(f'{source} does not exist!')
+            self.root_dir = source
+            self._files = {}
+            # Files of PointCloudSaver_Step, the others are ignored
+            pattern = re.compile(rf'{re.escape(method_name)}_visible_(\d+)\.ply')
+            fnames = set(os.listdir(source))
+            for f in fnames:
+                match = pattern.fullmatch(f)
+                if match is not None and f'{method_name}_thermal_{match.group(1)}.ply' in fnames:
+                    fid = match.group(1)
+                    self._files[fid] = (f, f'{method_name}_thermal_{fid}.ply')
+        else:
+            # RGBD&T frames of a VTD dataset (or a view of it)
+            self.root_dir = None
+            self._files = {fid : file for fid, file in source.data}
+        self.windows = sliding_windows(list(self._files.keys()), window_size, stride)
+
+    def __len__(self):
+        return len(self.windows)
+
+    def get(self, index : int):
+        fids = self.windows[index]
+        if self.root_dir is None:
+            files = [self._files[fid] for fid in fids]
+            return fids, RGBDnTBatch(os.path.dirname(files[0]), [os.path.basename(f) for f in files])
+        return fids, DoublePointCloudBatch(self.root_dir, [self._files[fid] for fid in fids])
+
+    def __iter__(self):
+        return (self.get(index) for index in range(len(self)))
+
+class _LazyItem:
+    # Item of a batch that is only loaded if its result is not cached.
+    # It only refers to the files of the item, so the workers do not receive the whole batch.
+    def __init__(self, batch, index : int) -> None:
+        self.index = index
+        self._load, self._args = batch.item_loader(index) if hasattr(batch, 'item_loader') else (batch.get, (index,))
+
+    def load(self):
+        return self._load(*self._args)
+
 class PipelineStep:
+    # Per-item steps map every item of one input (item_arg) to one item of their output (item_output),
+    # they can be streamed. Steps without output item (item_output = None) are sinks.
+    per_item = False
+    item_arg = None
+    item_output = None
+    # Steps with side effects (or depending on user interaction) are never cached
+    cacheable = True
+    # Per-item steps whose items only depend on their input item can run on a process pool
+    parallel = False
+    # Called with (index, item, result, elapsed time) after every item, e.g. by the profiler
+    item_observer = None
+    # (StepCache, item key function) set by the pipeline for the cached per-item steps
+    item_cache = None
+    # ProcessItemPool set by the pipeline for the parallel steps
+    item_pool = None
+    # StepCheckpoint set by the pipeline, for the steps saving their progress (e.g. per registered frame)
+    step_checkpoint = None
+    _hooks = ('item_observer', 'item_cache', 'item_pool', 'step_checkpoint')
+
     def __init__(self, key_arg_map : Dict[str,str]):
         self.key_map = key_arg_map
 
     def _generate_args(self, **kwargs):
-        if not all(x in kwargs.keys() for x in self.key_map.keys()):
+        if not all(x in kwargs.keys() for x in self.key_map.values()):
             raise ValueError('Required data is not provided!')
         res = {}
         for arg, key in self.key_map.items():
             res[arg] = kwargs[key]
         return res
 
+    @property
+    def consumes(self) -> List[str]:
+        return list(self.key_map.values())
+
+    @property
+    def produces(self) -> List[str]:
+        # None if the step does not declare its outputs (it is then ordered with respect to all steps)
+        if self.per_item:
+            return [self.item_output] if self.item_output is not None else []
+        return None
+
+    @property
+    def cache_params(self) -> Dict:
+        # Parameters entering the cache keys (private attributes and pipeline hooks are not parameters)
+        return {k : v for k, v in vars(self).items() 
+            if not k.startswith('_') and not k in self._hooks}
+
+    def __getstate__(self):
+        # The pipeline hooks stay in the pipeline process
+        return {k : v for k, v in vars(self).items() if not k in self._hooks}
+
+    def _iter_items(self, data):
+        if (self.item_cache is not None or self.item_pool is not None) and \
+           hasattr(data, 'get') and hasattr(data, 'count'):
+            # The cached items are not even loaded, the others are loaded by the workers if any
+            return (_LazyItem(data, i) for i in range(data.count))
+        # Batches are loaded lazily
+        return data() if callable(data) else data
+
+    def _impl_item(self, item, index : int):
+        raise NotImplementedError('_impl_item is not implemented!')
+
+    def _process_item(self, item, index : int):
+        if self.item_observer is None:
+            return self._cached_item(item, index)
+        start = time.perf_counter()
+        res = self._cached_item(item, index)
+        self.item_observer(index, item, res, time.perf_counter() - start)
+        return res
+
+    def _cached_item(self, item, index : int):
+        def _compute():
+            return self._impl_item(item.load() if isinstance(item, _LazyItem) else item, index)
+        if self.item_cache is None:
+            return _compute()
+        cache, item_key = self.item_cache
+        return cache.get_or_compute(item_key(index), _compute, type(self).__name__)
+
+    def _map_items(self, items):
+        if self.item_pool is not None:
+            return self.item_pool.map(self, items)
+        return (self._process_item(x, i) for i, x in enumerate(items))
+
     def _impl_func(self, **kwargs):
+        if self.per_item:
+            res = list(self._map_items(self._iter_items(kwargs[self.item_arg])))
+            return {self.item_output : res} if self.item_output is not None else None
+
+    def _finalize(self):
+        # Called by the pipeline once all the steps are done (e.g. to wait for background work and raise its errors)
         pass
 
+    @property
+    def _pending_work(self) -> bool:
+        # True while the step has background work that only _finalize completes
+        return False
+
     def __call__(self, **kwargs):
         return self._impl_func(**self._generate_args(**kwargs))
 
 class PointCloudSaver_Step(PipelineStep):
+    per_item = True
+    item_arg = 'pcs'
+    cacheable = False
+
     def __init__(self, 
         data_pcs_key : str,
         result_dir : str,
         depth_param,
         method_name : str = 'pc',
-        disabled : bool = False):
+        disabled : bool = False,
+        async_write : bool = False,
+        num_writers : int = 2,
+        max_pending : int = None):
         super().__init__({'pcs' : data_pcs_key})
         self.result_dir = result_dir
         self.method_name = method_name
         self.depth_param = depth_param
         self.disabled = disabled
+        # In async mode, the point clouds are written in the background and the writes are joined by _finalize
+        self.async_write = async_write
+        self.num_writers = num_writers
+        self.max_pending = max_pending if max_pending is not None else 2 * num_writers
+        self._executor = None
+        self._slots = None
+        self._pending = []
         # Make the directory if not exist!
         Path(result_dir).mkdir(parents=True, exist_ok=True)
 
     def _impl_func(self, **kwargs):
         if not self.disabled:
-            batch = kwargs['pcs']
-            pcs = batch if isinstance(batch, list) else [batch]
-            index = 1
+            pcs = self._as_batch(kwargs['pcs'])
             print(f'\nTotal Number of Point Clouds : {len(pcs)}')
-            for pc in pcs:
-                fname_viz = f'{self.method_name}_visible_{index}.ply'
-                file_viz = os.path.join(self.result_dir, fname_viz)
-                fname_th = f'{self.method_name}_thermal_{index}.ply'
-                file_th = os.path.join(self.result_dir, fname_th)
-                print(f'Saving {fname_viz} (Visible) ...')
-                o3d.io.write_point_cloud(file_viz, 
-                    pc.get_visible_point_cloud(intrinsic=self.depth_param), 
-                    write_ascii = True, print_progress = True)
-                print(f'Saving {fname_th} (Thermal) ...')
-                o3d.io.write_point_cloud(file_th, 
-                    pc.get_thermal_point_cloud(intrinsic=self.depth_param), 
-                    write_ascii = True, print_progress = True)
-                index += 1
+            return super()._impl_func(pcs=pcs)
+
+    @staticmethod
+    def _as_batch(data):
+        # A single pack (e.g. the fused point cloud) is saved as a batch of one
+        return [data] if isinstance(data, (O3DPointCloudWrapper, tuple)) else data
+
+    def _iter_items(self, data):
+        # Also called on the input of the streamed saver
+        return super()._iter_items(self._as_batch(data))
+
+    def _write(self, file : str, pc, print_progress : bool = True):
+        if not o3d.io.write_point_cloud(file, pc, write_ascii = True, print_progress = print_progress):
+            raise IOError(f'{file} cannot be written!')
+
+    def _write_snapshot(self, snapshot : List[Tuple]):
+        for file, pc in snapshot:
+            self._write(file, pc, print_progress=False)
+
+    def _impl_item(self, pc, index : int):
+        if self.disabled:
+            return
+        index += 1
+        fname_viz = f'{self.method_name}_visible_{index}.ply'
+        file_viz = os.path.join(self.result_dir, fname_viz)
+        fname_th = f'{self.method_name}_thermal_{index}.ply'
+        file_th = os.path.join(self.result_dir, fname_th)
+        if self.async_write:
+            # The writers own a copy, so the next steps can change the point clouds in the meantime
+            self._submit([
+                (file_viz, o3d.geometry.PointCloud(pc.get_visible_point_cloud(intrinsic=self.depth_param))),
+                (file_th, o3d.geometry.PointCloud(pc.get_thermal_point_cloud(intrinsic=self.depth_param)))
+            ])
+            return
+        print(f'Saving {fname_viz} (Visible) ...')
+        self._write(file_viz, pc.get_visible_point_cloud(intrinsic=self.depth_param))
+        print(f'Saving {fname_th} (Thermal) ...')
+        self._write(file_th, pc.get_thermal_point_cloud(intrinsic=self.depth_param))
+
+    def _submit(self, snapshot : List[Tuple]):
+        # A failed write stops the saving as soon as it is noticed
+        for future in self._pending:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_writers)
+            self._slots = threading.BoundedSemaphore(self.max_pending)
+        # The pending snapshots are bounded, so the memory does not grow with the batch
+        self._slots.acquire()
+        future = self._executor.submit(self._write_snapshot, snapshot)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+
+    @property
+    def _pending_work(self) -> bool:
+        return self._executor is not None
+
+    def _finalize(self):
+        if self._executor is None:
+            return
+        executor, pending = self._executor, self._pending
+        self._executor, self._pending = None, []
+        executor.shutdown(wait=True)
+        for future in pending:
+            future.result()
+        print(f'{2 * len(pending)} point clouds are saved in {self.result_dir}')
 
 class AbstractRegistration_Step(PipelineStep):
     def __init__(self, data_pcs_key : str):
         super().__init__({'pcs' : data_pcs_key})
         self.pcs_key = data_pcs_key
+
+    @property
+    def produces(self) -> List[str]:
+        return ['aligned_pcs', self.pcs_key, 'fused_pc', 'transformations']
     
     def _impl_func(self, **kwargs):
-        batch = kwargs['pcs']
+        # Both modalities share one geometry, so every frame is transformed once (in place)
+        batch = pack_point_clouds(kwargs['pcs'])
 
-        pcs = list([DualPointCloudPack(batch[0][0], batch[0][1])])
-        res_pc = list(copy.deepcopy(batch[0]))
-        for index in range(1,len(batch)):
-            source = batch[index][0]
-            target = res_pc[0]
+        transformations = [np.identity(4)]
+        # The target is the visible point cloud of the registered frames, it is only appended to
+        target = copy.deepcopy(batch[0].get_visible_point_cloud())
+        start = 1
+        if self.step_checkpoint is not None:
+            # The frames registered before an interruption
+            for pack, transformation in self.step_checkpoint.load_frames(start, len(batch)):
+                batch[start] = pack
+                transformations.append(transformation)
+                target += pack.get_visible_point_cloud()
+                start += 1
+        for index in range(start,len(batch)):
+            source = batch[index].get_visible_point_cloud()
             current_transformation = self._register(source, target)
             batch[index] = self._transform_point_cloud(batch[index], current_transformation)
+            transformations.append(self._transformation_matrix(current_transformation))
 
-            res_pc[0] += batch[index][0]
-            res_pc[1] += batch[index][1]
-            pcs.append(DualPointCloudPack(batch[index][0], batch[index][1]))
+            target += batch[index].get_visible_point_cloud()
+            if self.step_checkpoint is not None:
+                self.step_checkpoint.save_frame(index, (batch[index], transformations[-1]))
 
         return {
-            'aligned_pcs' : pcs,
+            'aligned_pcs' : list(batch),
             f'{self.pcs_key}' : batch,
-            'fused_pc' : DualPointCloudPack(res_pc[0], res_pc[1])
+            'fused_pc' : fuse_point_clouds(batch),
+            'transformations' : transformations
         }
     
-    def _transform_point_cloud(self, data : Tuple, transformation):
-        # Transform Visible Pointcloud
-        data[0].transform(transformation)
-        # Transform Thermal Pointcloud
-        data[1].transform(transformation)
-        return data
+    def _transform_point_cloud(self, data, transformation):
+        # Transform the visible and thermal point clouds
+        return data.transform(transformation)
+
+    def _transformation_matrix(self, transformation):
+        # 4x4 homogeneous matrix of the estimated transformation (None if it is not linear)
+        return np.asarray(transformation)
 
     def _register(self, src, tgt):
         pass
 
 class LoadBatch_Step(PipelineStep):
+    per_item = True
+    item_arg = 'batch'
+    item_output = 'pcs'
+
     def __init__(self, data_batch_key : str = 'batch'):
         super().__init__({
             'batch' : data_batch_key
         })
     
-    def _impl_func(self, **kwargs):
-        batch = kwargs['batch']
-        return {
-            'pcs' : list(batch())
-        }
+    def _impl_item(self, item, index : int):
+        return item
 
 
 class FilterDepthRange_Step(PipelineStep):
+    per_item = True
+    parallel = True
+    item_arg = 'batch'
+    item_output = 'prp_frames'
+
     def __init__(self, depth_range = [1, 2.5], data_batch_key : str = 'batch'):
         super().__init__({
             'batch' : data_batch_key
@@ -176,13 +446,15 @@ class FilterDepthRange_Step(PipelineStep):
 
         return frame
 
-    def _impl_func(self, **kwargs):
-        batch = kwargs['batch']
-        return {
-            'prp_frames' : list(map(lambda x : self.__apply_depth_range(x), batch()))
-        }
+    def _impl_item(self, frame : RGBDnT, index : int):
+        return self.__apply_depth_range(frame)
 
 class ConvertToPC_Step(PipelineStep):
+    per_item = True
+    parallel = True
+    item_arg = 'batch'
+    item_output = 'pcs'
+
     def __init__(self,
         depth_params_file : str,
         data_batch_key : str = 'batch'):
@@ -190,42 +462,177 @@ class ConvertToPC_Step(PipelineStep):
             'batch' : data_batch_key
         })
         self.depth_params = load_pinhole(depth_params_file)
+
+    def __getstate__(self):
+        # o3d intrinsics cannot be pickled
+        state = super().__getstate__()
+        p = self.depth_params
+        state['depth_params'] = (p.width, p.height, np.asarray(p.intrinsic_matrix).tolist())
+        return state
+
+    def __setstate__(self, state):
+        width, height, K = state['depth_params']
+        state['depth_params'] = o3d.camera.PinholeCameraIntrinsic(
+            width=width, height=height, fx=K[0][0], fy=K[1][1], cx=K[0][2], cy=K[1][2])
+        self.__dict__.update(state)
     
-    def _impl_func(self, **kwargs):
-        data = kwargs['batch']
-        return {
-            'pcs': list(map(self.__convert_pc, data))
-        }
-    
-    def __convert_pc(self, data : RGBDnT):
+    def _impl_item(self, data : RGBDnT, index : int):
         return (
             data.to_point_cloud_visible_o3d(self.depth_params, False),
             data.to_point_cloud_thermal_o3d(self.depth_params, False)
         )
 
+__intensity_weights__ = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+def frame_to_point_arrays(
+    frame : RGBDnT,
+    depth_range = None,
+    depth_trunc : float = 5.0,
+    rgb_to_intensity : bool = True
+) -> Dict[str, np.ndarray]:
+    """Single pass conversion of an RGBD&T frame to compact point arrays.
+
+    The depth range, the depth validity and the thermal masks are applied on the stored XYZ channels,
+    so the frame is neither re-encoded as images nor deprojected again. The result is what the
+    depth range filter, the o3d RGBD conversion and the zero thermal filter produce together.
+    """
+    data = frame.data
+    Z = data[:,:,2]
+    low, high = (0, depth_trunc) if depth_range is None else \
+        (depth_range[0], min(depth_range[1], depth_trunc))
+    with np.errstate(invalid='ignore'):
+        mask = (Z > 0) & (Z >= low) & (Z <= high)
+    # One gather of the valid pixels : X Y Z R G B T
+    points = data[mask]
+    colors = points[:, 3:6].astype(np.float32) / np.float32(255.0)
+    if rgb_to_intensity:
+        # Same as o3d RGBD images (convert_rgb_to_intensity)
+        colors = np.repeat((colors @ __intensity_weights__)[:, np.newaxis], 3, axis=1)
+    thermal_mask = points[:, 6] > 0
+    return {
+        'points' : points[:, :3],
+        'colors' : colors,
+        'thermal_points' : points[thermal_mask, :3],
+        'thermal' : points[thermal_mask, 6].astype(np.float32) / np.float32(255.0)
+    }
+
+def point_arrays_to_o3d(arrays : Dict[str, np.ndarray]) -> Tuple:
+    visible_pc = o3d.geometry.PointCloud()
+    visible_pc.points = o3d.utility.Vector3dVector(arrays['points'].astype(np.float64))
+    visible_pc.colors = o3d.utility.Vector3dVector(arrays['colors'].astype(np.float64))
+    thermal_pc = o3d.geometry.PointCloud()
+    thermal_pc.points = o3d.utility.Vector3dVector(arrays['thermal_points'].astype(np.float64))
+    thermal_pc.colors = o3d.utility.Vector3dVector(
+        np.repeat(arrays['thermal'][:, np.newaxis], 3, axis=1).astype(np.float64))
+    return visible_pc, thermal_pc
+
+class FrameToPC_Step(PipelineStep):
+    """Replaces FilterDepthRange_Step, ConvertToPC_Step and the zero thermal filter of Preprocessing_Step"""
+    per_item = True
+    parallel = True
+    item_arg = 'batch'
+    item_output = 'pcs'
+
+    def __init__(self, 
+        depth_range = [1, 2.5], 
+        depth_trunc : float = 5.0,
+        data_batch_key : str = 'batch'):
+        super().__init__({
+            'batch' : data_batch_key
+        })
+        self.depth_range = depth_range
+        self.depth_trunc = depth_trunc
+
+    def _impl_item(self, frame : RGBDnT, index : int):
+        return point_arrays_to_o3d(frame_to_point_arrays(frame, self.depth_range, self.depth_trunc))
+
 class Preprocessing_Step(PipelineStep):
-    def __init__(self, data_pcs_key : str):
+    """Statistical outlier removal of the dual point clouds.
+
+    Both clouds are deprojected from the same depth image, so the outliers are computed once on the
+    visible cloud and the thermal points keep the inlier status of their visible counterparts. The
+    thermal cloud is processed on its own when its points are not a subset of the visible ones.
+    """
+    per_item = True
+    parallel = True
+    item_arg = 'pcs'
+    item_output = 'prp_pcs'
+
+    def __init__(self, data_pcs_key : str, filter_thermal : bool = True):
         super().__init__({'pcs' : data_pcs_key})
+        # The point clouds of FrameToPC_Step have no zero thermal points
+        self.filter_thermal = filter_thermal
 
-    def _impl_func(self, **kwargs):
-        batch = kwargs['pcs']
-        pcs = []
-        for index in range(len(batch)):
-            visible_pc = batch[index][0]
-            thermal_pc = batch[index][1]
-
-            visible_pc,_ = visible_pc.remove_statistical_outlier(nb_neighbors=8, std_ratio=0.005, print_progress=True)
-            thermal_pc,_ = thermal_pc.remove_statistical_outlier(nb_neighbors=8, std_ratio=0.005, print_progress=True)
+    @staticmethod
+    def __remove_outliers(pc):
+        return pc.remove_statistical_outlier(nb_neighbors=8, std_ratio=0.005, print_progress=True)
+
+    def _impl_item(self, pcs, index : int):
+        visible_pc = pcs[0]
+        thermal_pc = pcs[1]
+
+        thermal_index = match_points(np.asarray(visible_pc.points), np.asarray(thermal_pc.points))
+        visible_pc, inliers = self.__remove_outliers(visible_pc)
+        if thermal_index is None:
+            thermal_pc,_ = self.__remove_outliers(thermal_pc)
+        else:
+            mask = np.zeros(len(pcs[0].points), dtype=bool)
+            mask[inliers] = True
+            thermal_pc = thermal_pc.select_by_index(np.flatnonzero(mask[thermal_index]))
+        if self.filter_thermal:
             thermal_pc = filter_out_zero_thermal(thermal_pc)
-            pcs.append(DualPointCloudPack(visible_pc, thermal_pc))
+        return DualPointCloudPack(visible_pc, thermal_pc)
 
-        return {'prp_pcs' : pcs}
+class _StreamCancelled(Exception):
+    # Raised in the consumers of a stream once the streaming run is cancelled
+    pass
 
+# Last item of a stream
+_end_of_stream = object()
+__stream_poll__ = 0.1
 
 class Pipeline(object):
 
-    def __init__(self, steps : List[PipelineStep] = None):
+    def __init__(self, 
+        steps : List[PipelineStep] = None,
+        streaming : bool = False,
+        queue_size : int = 4,
+        concurrent : bool = False,
+        num_workers : int = None,
+        keep : List[str] = None,
+        profiler : PipelineProfiler = None,
+        cache : StepCache = None,
+        num_processes : int = None,
+        process_context : str = None,
+        checkpoint : PipelineCheckpoint = None,
+        resume : bool = False
+    ):
         self.steps = steps if steps is not None else []
+        # In streaming mode, the per-item steps run concurrently and pass their items through bounded queues
+        self.streaming = streaming
+        self.queue_size = queue_size
+        # In concurrent mode, the steps form a graph (by their consumed/produced keys) and independent steps run in parallel
+        if streaming and concurrent:
+            raise ValueError('Streaming and concurrent modes cannot be combined!')
+        self.concurrent = concurrent
+        self.num_workers = num_workers
+        # Results that are returned, the others are dropped once no remaining step needs them (None keeps all)
+        self.keep = keep
+        # Per step instrumentation, the profile is written in the result directory of the profiler
+        self.profiler = profiler
+        # Opt-in memoization of the step outputs, the fingerprints identify the content of the data keys
+        self.cache = cache
+        self._fingerprints = {}
+        # The parallel per-item steps run on a pool of num_processes processes (None runs them in this process)
+        self.num_processes = num_processes
+        self.process_context = process_context
+        # The outputs of the completed steps are saved, so an interrupted run can be resumed (not in streaming mode)
+        if streaming and checkpoint is not None:
+            raise ValueError('Checkpoints are not supported in streaming mode!')
+        self.checkpoint = checkpoint
+        self.resume = resume
+        # Completed steps with background work, they are checkpointed once their _finalize has succeeded
+        self._unfinalized = {}
     
     @property
     def steps_count(self):
@@ -235,13 +642,405 @@ class Pipeline(object):
         # Check data availability
         if batch.count == 0:
             return None
-        
+        # Batches of files are identified by the file stats (one fingerprint per item)
+        self._fingerprints = {'batch' : getattr(batch, 'fingerprints', None)}
+        pool = None
+        if self.num_processes is not None and any(s.per_item and s.parallel for s in self.steps):
+            pool = ProcessItemPool(self.num_processes, context=self.process_context)
+            for step in self.steps:
+                if step.per_item and step.parallel:
+                    step.item_pool = pool
+        if self.checkpoint is not None:
+            restored = self.checkpoint.begin(self._signature(batch), self.resume)
+            if restored:
+                logging.info(f'Resuming the pipeline, {len(restored)} steps are restored from the checkpoint')
+            for index, step in enumerate(self.steps):
+                step.step_checkpoint = self.checkpoint.step(index)
+        if self.profiler is None and self.cache is None and pool is None and self.checkpoint is None:
+            return self._run(batch)
+
+        if self.profiler is not None:
+            for index, step in enumerate(self.steps):
+                if step.per_item:
+                    step.item_observer = self.profiler.item_observer(index, step)
+        try:
+            if self.profiler is None:
+                return self._run(batch)
+            with self.profiler.run():
+                return self._run(batch)
+        finally:
+            for step in self.steps:
+                step.item_observer = None
+                step.item_cache = None
+                step.item_pool = None
+                step.step_checkpoint = None
+            if pool is not None:
+                pool.shutdown()
+            if self.cache is not None:
+                self.cache.flush()
+
+    def _signature(self, batch : RGBDnTBatch) -> str:
+        # Identifies the steps, their parameters and the input of a run
+        steps = [f'{type(s).__module__}.{type(s).__qualname__}:{param_token(s.cache_params)}' for s in self.steps]
+        return fingerprint(*steps, batch.count, param_token(getattr(batch, 'fingerprints', None)))
+
+    def _run(self, batch : RGBDnTBatch):
+        try:
+            res = self._run_steps(batch)
+        except BaseException:
+            # The original error is raised, not the ones of the interrupted background work
+            self._finalize(raise_errors=False)
+            raise
+        self._finalize()
+        return res
+
+    def _finalize(self, raise_errors : bool = True):
+        errors = []
+        unfinalized, self._unfinalized = self._unfinalized, {}
+        for index, step in enumerate(self.steps):
+            try:
+                if self.profiler is None:
+                    step._finalize()
+                else:
+                    with self.profiler.measure(index, step):
+                        step._finalize()
+            except BaseException as ex:
+                errors.append(ex)
+                continue
+            if index in unfinalized:
+                self.checkpoint.store_step(index, *unfinalized[index])
+        if errors and raise_errors:
+            raise errors[0]
+
+    def _run_steps(self, batch : RGBDnTBatch):
+        if self.streaming:
+            return self._release(self._stream(batch), [])
+        if self.concurrent:
+            return self._run_graph(batch)
+
         res = {'batch' : batch}
         with Bar('Processing using pipeline steps', max=self.steps_count) as bar:
-            for step in self.steps:
-                d_res = step(**res)
+            for index, step in enumerate(self.steps):
+                d_res = self._execute(index, res)
                 if d_res is not None:
                     res = {**res, **d_res}
+                res = self._release(res, self.steps[index + 1:])
                 bar.next()
         
-        return res
\ No newline at end of file
+        return res
+
+    def _execute(self, index : int, res : Dict):
+        step = self.steps[index]
+        key = self._prepare_cache(step)
+        # The completed steps of an interrupted run are not run again
+        restored, d_res = self.checkpoint.load_step(index) if self.checkpoint is not None else (False, None)
+        if not restored:
+            if self.profiler is None:
+                d_res = self._compute(step, key, res)
+            else:
+                with self.profiler.measure(index, step, step._generate_args(**res)) as outputs:
+                    outputs['result'] = d_res = self._compute(step, key, res)
+            if self.checkpoint is not None:
+                if step._pending_work:
+                    # e.g. the point clouds of an async saver are not written yet
+                    self._unfinalized[index] = (type(step).__name__, d_res)
+                else:
+                    self.checkpoint.store_step(index, type(step).__name__, d_res)
+        if self.cache is not None and not step.per_item and d_res is not None:
+            for k in d_res.keys():
+                self._fingerprints[k] = fingerprint(key, k) if key is not None else None
+        return d_res
+
+    def _compute(self, step : PipelineStep, key : str, res : Dict):
+        if key is None:
+            return step(**res)
+        return self.cache.get_or_compute(key, lambda: step(**res), type(step).__name__)
+
+    def _prepare_cache(self, step : PipelineStep) -> str:
+        # Cache key of the step outputs, None if they are not cached.
+        # The per-item steps are cached per item, their items are keyed by the item fingerprints of their input.
+        if self.cache is None:
+            return None
+        def _whole(fp):
+            return fingerprint(*fp) if isinstance(fp, list) else fp
+        others = [self._fingerprints.get(k) for arg, k in step.key_map.items() if not step.per_item or arg != step.item_arg]
+        key = None
+        if step.cacheable and all(x is not None for x in others):
+            key = fingerprint(type(step).__module__, type(step).__qualname__, 
+                param_token(step.cache_params), *[_whole(x) for x in others])
+        if not step.per_item:
+            return key
+        if step.item_output is None:
+            return None
+        data = self._fingerprints.get(step.key_map[step.item_arg])
+        if key is None or data is None:
+            self._fingerprints[step.item_output] = None
+        elif isinstance(data, list):
+            items = [fingerprint(key, x) for x in data]
+            step.item_cache = (self.cache, items.__getitem__)
+            self._fingerprints[step.item_output] = items
+        else:
+            step.item_cache = (self.cache, lambda i: fingerprint(key, data, i))
+            self._fingerprints[step.item_output] = fingerprint(key, data)
+        return None
+
+    def _release(self, res : Dict, remaining : List[PipelineStep]) -> Dict:
+        if self.keep is None:
+            return res
+        needed = set(self.keep)
+        for step in remaining:
+            needed.update(step.consumes)
+        return {k : v for k, v in res.items() if k in needed}
+
+    def _dependencies(self) -> List[set]:
+        # A step waits for the previous steps that produce what it consumes, consume what it produces
+        # or produce the same keys, so every step sees the same data as in the sequential order
+        deps = []
+        for j, step in enumerate(self.steps):
+            consumes = set(step.consumes)
+            produces = step.produces
+            current = set()
+            for i in range(j):
+                prev = self.steps[i]
+                if prev.produces is None or produces is None or \
+                   set(prev.produces) & consumes or \
+                   set(prev.consumes) & set(produces) or \
+                   set(prev.produces) & set(produces):
+                    current.add(i)
+            deps.append(current)
+        return deps
+
+    def _run_graph(self, batch : RGBDnTBatch):
+        res = {'batch' : batch}
+        deps = self._dependencies()
+        pending = list(range(self.steps_count))
+        running = {}
+        with Bar('Processing using pipeline steps', max=self.steps_count) as bar, \
+             ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            while pending or running:
+                unfinished = set(pending) | set(running.values())
+                for index in [i for i in pending if not deps[i] & unfinished]:
+                    running[executor.submit(self._execute, index, res)] = index
+                    pending.remove(index)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    d_res = future.result()
+                    if d_res is not None:
+                        res = {**res, **d_res}
+                    bar.next()
+                res = self._release(res, [self.steps[i] for i in set(pending) | set(running.values())])
+        return res
+
+    def _is_streamed(self, index : int) -> bool:
+        # An output is streamed only if a single per-item step consumes it, otherwise it is a barrier
+        step = self.steps[index]
+        consumers = [s for s in self.steps[index + 1:] if step.item_output in s.key_map.values()]
+        return len(consumers) == 1 and consumers[0].per_item and \
+            consumers[0].key_map[consumers[0].item_arg] == step.item_output and \
+            len(consumers[0].key_map) == 1
+
+    def _run_stage(self, index : int, source, output : queue.Queue, errors : List, cancel : threading.Event):
+        step = self.steps[index]
+        if self.profiler is None:
+            return self._stream_items(step, source, output, errors, cancel)
+        # The stage lasts as long as its thread
+        with self.profiler.measure(index, step):
+            self._stream_items(step, source, output, errors, cancel)
+
+    def _put(self, output : queue.Queue, item, cancel : threading.Event) -> bool:
+        # The consumer may be gone once the run is cancelled, so the stage does not wait for it
+        while not cancel.is_set():
+            try:
+                output.put(item, timeout=__stream_poll__)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _stream_items(self, step : PipelineStep, source, output : queue.Queue, errors : List, cancel : threading.Event):
+        items = step._map_items(source)
+        try:
+            for res in items:
+                if output is not None and not self._put(output, res, cancel):
+                    break
+        except _StreamCancelled:
+            # Another stage (or the pipeline) has failed
+            pass
+        except BaseException as ex:
+            errors.append(ex)
+            cancel.set()
+        finally:
+            if isinstance(items, GeneratorType):
+                # Releases the items in flight (e.g. in the process pool)
+                items.close()
+            if output is not None:
+                self._put(output, _end_of_stream, cancel)
+
+    def _drain(self, output : queue.Queue, cancel : threading.Event):
+        while True:
+            if cancel.is_set():
+                raise _StreamCancelled()
+            try:
+                item = output.get(timeout=__stream_poll__)
+            except queue.Empty:
+                continue
+            if item is _end_of_stream:
+                return
+            yield item
+
+    def _stream(self, batch : RGBDnTBatch):
+        stages = []
+        errors = []
+        # Set on the first failure, so that every stage stops instead of waiting for its consumer
+        cancel = threading.Event()
+        try:
+            res = self._stream_steps(batch, stages, errors, cancel)
+        except _StreamCancelled:
+            # The error of the failed stage is raised below
+            res = None
+        except BaseException:
+            cancel.set()
+            raise
+        finally:
+            if errors:
+                cancel.set()
+            for stage in stages:
+                stage.join()
+        if errors:
+            raise errors[0]
+        # The intermediate streams have been consumed
+        return {k : v for k, v in res.items() if not isinstance(v, GeneratorType)}
+
+    def _stream_steps(self, batch : RGBDnTBatch, stages : List[threading.Thread], errors : List, cancel : threading.Event):
+        res = {'batch' : batch}
+        sinks = []
+        with Bar('Processing using pipeline steps', max=self.steps_count) as bar:
+            for index, step in enumerate(self.steps):
+                if step.per_item and len(step.key_map) == 1:
+                    self._prepare_cache(step)
+                    source = step._iter_items(res[step.key_map[step.item_arg]])
+                    output = queue.Queue(maxsize=self.queue_size) if step.item_output is not None else None
+                    stage = threading.Thread(target=self._run_stage, args=(index, source, output, errors, cancel), daemon=True)
+                    stages.append(stage)
+                    if output is None:
+                        sinks.append((stage, step.key_map[step.item_arg]))
+                    else:
+                        res[step.item_output] = self._drain(output, cancel)
+                    stage.start()
+                    # Only the outputs needed by a barrier or by the caller are gathered
+                    if step.item_output is not None and not self._is_streamed(index):
+                        res[step.item_output] = list(res[step.item_output])
+                else:
+                    # The sinks still reading what the step changes have to finish first
+                    for stage, key in sinks:
+                        if step.produces is None or key in step.produces:
+                            stage.join()
+                    if errors:
+                        raise _StreamCancelled()
+                    d_res = self._execute(index, res)
+                    if d_res is not None:
+                        res = {**res, **d_res}
+                bar.next()
+            for stage, _ in sinks:
+                stage.join()
+        return res
+
+class WindowedRegistration:
+    def __init__(self,
+        pipeline_factory : Callable,
+        num_workers : int = 1,
+        voxel_size : float = None,
+        keep_aligned : bool = False
+    ) -> None:
+        # Each window is processed by its own pipeline that should contain a registration step
+        self.pipeline_factory = pipeline_factory
+        self.num_workers = max(1, num_workers)
+        self.voxel_size = voxel_size
+        self.keep_aligned = keep_aligned
+
+    def _register_window(self, batch):
+        res = self.pipeline_factory()(batch)
+        if res is None or not 'aligned_pcs' in res:
+            raise ValueError('The window pipeline does not provide the aligned point clouds!')
+        return res['aligned_pcs'], res.get('transformations', [None] * len(res['aligned_pcs']))
+
+    def _transform(self, pack, transformation):
+        return pack.transform(transformation)
+
+    def _estimate_window_transformation(self, local_pack, global_pack):
+        # Fallback for non-linear registrations : rigid fit between the two poses of the shared frame
+        source = local_pack.get_visible_point_cloud()
+        target = global_pack.get_visible_point_cloud()
+        if len(source.points) != len(target.points):
+            raise ValueError('The shared frame of the consecutive windows cannot be matched!')
+        corr = np.tile(np.arange(len(source.points)), (2, 1)).T
+        p2p = o3d.pipelines.registration.TransformationEstimationPointToPoint()
+        return p2p.compute_transformation(source, target, o3d.utility.Vector2iVector(corr))
+
+    def _windows_results(self, windows):
+        if self.num_workers == 1:
+            for fids, batch in windows:
+                yield fids, self._register_window(batch)
+            return
+        # Keep at most num_workers windows in flight so that the memory stays bounded
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque()
+            for fids, batch in windows:
+                pending.append((fids, executor.submit(self._register_window, batch)))
+                if len(pending) >= self.num_workers:
+                    fids, future = pending.popleft()
+                    yield fids, future.result()
+            while pending:
+                fids, future = pending.popleft()
+                yield fids, future.result()
+
+    def __call__(self, windows : SequenceWindowBatcher):
+        poses = {} # fid -> global transformation (None if it is not linear)
+        shared = {} # fid -> globally aligned point clouds of the last window
+        aligned = {}
+        contributions = []
+        with Bar('Registering windows', max=len(windows)) as bar:
+            for fids, (pcs, transformations) in self._windows_results(windows):
+                # The first frame is the reference of the window, its global pose places the whole window
+                ref = fids[0]
+                if not poses:
+                    window_pose = np.identity(4)
+                elif not ref in poses:
+                    raise ValueError(f'Window starting at {ref} does not overlap with the previous window!')
+                elif poses[ref] is not None:
+                    window_pose = poses[ref]
+                else:
+                    window_pose = self._estimate_window_transformation(pcs[0], shared[ref])
+
+                current = {}
+                new_packs = []
+                for index, fid in enumerate(fids):
+                    if fid in poses:
+                        # Frames of the overlap are kept from the previous windows
+                        current[fid] = shared[fid]
+                        continue
+                    pack = self._transform(pcs[index], window_pose)
+                    local = transformations[index]
+                    poses[fid] = window_pose @ local if local is not None else None
+                    current[fid] = pack
+                    new_packs.append(pack)
+                    if self.keep_aligned:
+                        aligned[fid] = pack
+                shared = current
+
+                if new_packs:
+                    # Only the new frames are down-sampled, the points of the previous windows are not averaged again
+                    contribution = fuse_point_clouds(new_packs)
+                    if self.voxel_size is not None:
+                        contribution = contribution.voxel_down_sample(voxel_size=self.voxel_size)
+                    contributions.append(contribution)
+                bar.next()
+
+        res = {
+            'fused_pc' : fuse_point_clouds(contributions) if contributions else DualPointCloudPack(o3d.geometry.PointCloud(), o3d.geometry.PointCloud()),
+            'transformations' : poses
+        }
+        if self.keep_aligned:
+            res['aligned_pcs'] = [aligned[fid] for fid in sorted(aligned, key=int)]
+        return res
@@ -8,6 +8,9 @@ from phm.visualization import pick_points_point_cloud
 
 
 class ManualRegistration_Step(AbstractRegistration_Step):
+    # The control points are picked by the user
+    cacheable = False
+
     def __init__(self, 
         depth_params,
         data_pcs_key : str = 'pcs'):
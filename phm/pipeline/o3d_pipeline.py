@@ -1,8 +1,9 @@
 
+import copy
 import numpy as np
 import open3d as o3d
 
-from phm.data.vtd import DualPointCloudPack, __depth_scale__
+from phm.data.vtd import __depth_scale__, fuse_point_clouds, pack_point_clouds
 from phm.pipeline.core import AbstractRegistration_Step, PipelineStep
 
 class O3DRegistrationMetrics_Step(PipelineStep):
@@ -14,6 +15,15 @@ class O3DRegistrationMetrics_Step(PipelineStep):
         self.initial_transformation = initial_transformation
         self.__reset_metrics()
 
+    @property
+    def produces(self):
+        return ['metrics']
+
+    @property
+    def cache_params(self):
+        # The metrics of the last run are not parameters
+        return {k : v for k, v in super().cache_params.items() if k != 'metrics'}
+
     def __reset_metrics(self):
         self.metrics = {
             'inlier_rmse' : [], # RMSE of all inlier correspondences. Lower is better.
@@ -21,11 +31,8 @@ class O3DRegistrationMetrics_Step(PipelineStep):
         }
 
     def _transform_point_cloud(self, data, transformation):
-        # Transform Visible Pointcloud
-        data[0].transform(transformation)
-        # Transform Thermal Pointcloud
-        data[1].transform(transformation)
-        return data
+        # Transform the visible and thermal point clouds
+        return data.transform(transformation)
 
     def _register(self, src, tgt):
         source = src
@@ -56,16 +63,17 @@ class O3DRegistrationMetrics_Step(PipelineStep):
         self.__reset_metrics()
         batch = kwargs['pcs']
 
-        pcs = list()
-        res_pc = list(batch[0])
-        for index in range(1,len(batch)):
-            source = batch[index][0]
-            target = res_pc[0]
+        # The point clouds are shared with the other steps (which may run concurrently), so they are copied
+        packs = pack_point_clouds(batch, copy_packs=True)
+        # The target is the visible point cloud of the registered frames, it is only appended to
+        target = copy.deepcopy(packs[0].get_visible_point_cloud())
+        for index in range(1,len(packs)):
+            current = packs[index]
+            source = current.get_visible_point_cloud()
             res_transformation = self._register(source, target)
-            batch[index] = self._transform_point_cloud(batch[index], res_transformation.transformation)
+            current = self._transform_point_cloud(current, res_transformation.transformation)
 
-            res_pc[0] += batch[index][0]
-            res_pc[1] += batch[index][1]
+            target += current.get_visible_point_cloud()
 
             self.metrics['inlier_rmse'].append(res_transformation.inlier_rmse)
             self.metrics['fitness'].append(res_transformation.fitness)
@@ -128,19 +136,15 @@ class Easy_MultiModalPCFusion_Step(PipelineStep):
         super().__init__({
             'pcs' : data_pcs_key
         })
+
+    @property
+    def produces(self):
+        return ['fused_pc']
     
     def _impl_func(self, **kwargs):
-        batch = kwargs['pcs']
-        vfused = o3d.geometry.PointCloud()
-        tfused = o3d.geometry.PointCloud()
-        for vpc, thpc in batch:
-            vfused += vpc
-            tfused += thpc
+        fused = fuse_point_clouds(pack_point_clouds(kwargs['pcs']))
         
-        fusedpc = DualPointCloudPack(
-            vfused.voxel_down_sample(voxel_size=0.005), 
-            tfused.voxel_down_sample(voxel_size=0.005)
-        )
+        fusedpc = fused.voxel_down_sample(voxel_size=0.005)
 
         return {
             'fused_pc' : fusedpc
@@ -0,0 +1,115 @@
+
+import time
+import logging
+import multiprocessing as mp
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
+from typing import Iterable, Tuple
+
+from phm.transport import SharedBlock, share_tracker
+
+def _run_item(step, index : int, block : SharedBlock, lazy_item) -> Tuple[SharedBlock, float]:
+    # Runs in the worker, the input arrays are not copied
+    with (block.open() if lazy_item is None else nullcontext(lazy_item.load())) as item:
+        start = time.perf_counter()
+        res = step._impl_item(item, index)
+        elapsed = time.perf_counter() - start
+        # The result is copied before the input block is closed, since it may be a view on it
+        res = SharedBlock.create(res)
+    # The block is handed over to the parent process
+    return res.disown(), elapsed
+
+class _Task:
+    def __init__(self, future : Future, item, index : int, block : SharedBlock = None, cached : bool = False) -> None:
+        self.future = future
+        self.item = item
+        self.index = index
+        # Block of the input item (None if it is loaded by the worker)
+        self.block = block
+        self.cached = cached
+        self.start = time.perf_counter()
+
+class ProcessItemPool:
+    """Runs the items of per-item steps on a pool of processes.
+
+    The items and the results are handed over in shared memory blocks, only the block descriptors and the step are pickled.
+    At most max_pending items are in flight, and the results are returned in the order of the items.
+    """
+    def __init__(self, num_processes : int, max_pending : int = None, context : str = None) -> None:
+        self.num_processes = num_processes
+        self.max_pending = max_pending if max_pending is not None else 2 * num_processes
+        share_tracker()
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_processes,
+            mp_context=mp.get_context(context) if context is not None else None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, step, item, index : int) -> _Task:
+        from phm.pipeline.core import _LazyItem
+        if step.item_cache is not None:
+            cache, item_key = step.item_cache
+            found, value = cache.load(item_key(index))
+            if found:
+                future = Future()
+                future.set_result(value)
+                return _Task(future, item, index, cached=True)
+        if isinstance(item, _LazyItem):
+            # The worker loads the item itself
+            return _Task(self._executor.submit(_run_item, step, index, None, item), item, index)
+        block = SharedBlock.create(item)
+        try:
+            future = self._executor.submit(_run_item, step, index, block, None)
+        except BaseException:
+            block.release()
+            raise
+        return _Task(future, item, index, block)
+
+    def _result(self, step, task : _Task):
+        try:
+            res = task.future.result()
+        finally:
+            if task.block is not None:
+                task.block.release()
+        if task.cached:
+            value = res
+        else:
+            block = res[0].adopt()
+            try:
+                value = block.load()
+            finally:
+                block.release()
+            if step.item_cache is not None:
+                cache, item_key = step.item_cache
+                cache.store(item_key(task.index), value, type(step).__name__)
+        if step.item_observer is not None:
+            step.item_observer(task.index, task.item, value, time.perf_counter() - task.start)
+        return value
+
+    def _discard(self, pending : deque):
+        # Frees the blocks of the items in flight after a failure
+        for task in pending:
+            try:
+                res = task.future.result()
+                if not task.cached:
+                    res[0].adopt().release()
+            except BaseException as ex:
+                logging.debug(f'Discarded item has failed : {ex}')
+            if task.block is not None:
+                task.block.release()
+
+    def map(self, step, items : Iterable) -> Iterable:
+        pending = deque()
+        try:
+            for index, item in enumerate(items):
+                pending.append(self._submit(step, item, index))
+                if len(pending) >= self.max_pending:
+                    yield self._result(step, pending.popleft())
+            while pending:
+                yield self._result(step, pending.popleft())
+        except BaseException:
+            self._discard(pending)
+            raise
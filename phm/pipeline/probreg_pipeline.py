@@ -1,13 +1,13 @@
 
 
 import copy
-from typing import Tuple
 import numpy as np
 
 from probreg import cpd
 from probreg import l2dist_regs
 from probreg import gmmtree
 from probreg import filterreg
+from probreg.transformation import AffineTransformation, RigidTransformation
 
 from phm.data.vtd import DualPointCloudPack
 from phm.pipeline.core import AbstractRegistration_Step
@@ -17,13 +17,23 @@ class AbstractProbregRegistration_Step(AbstractRegistration_Step):
     def __init__(self, data_pcs_key: str):
         super().__init__(data_pcs_key)
     
-    def _transform_point_cloud(self, data : Tuple, trans):
-        transformation = trans.transformation
-        # Transform Visible Pointcloud
-        data[0].points = transformation.transform(data[0].points)
-        # Transform Thermal Pointcloud
-        data[1].points = transformation.transform(data[1].points)
-        return data
+    def _transform_point_cloud(self, data, trans):
+        # The visible and thermal point clouds share their points
+        return data.transform_points(trans.transformation.transform)
+
+    def _transformation_matrix(self, trans):
+        transformation = trans.transformation if hasattr(trans, 'transformation') else trans
+        res = np.identity(4)
+        if isinstance(transformation, RigidTransformation):
+            res[:3, :3] = transformation.scale * transformation.rot
+            res[:3, 3] = transformation.t
+        elif isinstance(transformation, AffineTransformation):
+            res[:3, :3] = transformation.b
+            res[:3, 3] = transformation.t
+        else:
+            # Non-rigid transformations cannot be expressed as a matrix
+            return None
+        return res
 
 class FilterregRegistration_Step(AbstractProbregRegistration_Step):
     def __init__(self, 
@@ -123,12 +133,9 @@ class SVRRegistration_Step(AbstractProbregRegistration_Step):
 
         return current_transformation
 
-    def _transform_point_cloud(self, data : Tuple, trans):
-        # Transform Visible Pointcloud
-        data[0].points = trans.transform(data[0].points)
-        # Transform Thermal Pointcloud
-        data[1].points = trans.transform(data[1].points)
-        return data
+    def _transform_point_cloud(self, data, trans):
+        # The visible and thermal point clouds share their points
+        return data.transform_points(trans.transform)
 
 class CPDRegistration_Step(AbstractProbregRegistration_Step):
     def __init__(self, 
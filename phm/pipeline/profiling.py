@@ -0,0 +1,201 @@
+
+import os
+import csv
+import json
+import time
+import cProfile
+import logging
+import threading
+
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Union
+
+import open3d as o3d
+
+from phm.data.vtd import DualPointCloudPack, MultiModalPointCloud
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the memory is then not recorded
+    resource = None
+
+__profile_fields__ = [
+    'index', 'step', 'wall_time', 'cpu_time', 'rss_peak_delta',
+    'items', 'points_in', 'points_out', 'items_per_second', 'points_per_second'
+]
+
+def count_points(data) -> int:
+    # Number of points of the point clouds in the data (other data types are not counted)
+    if isinstance(data, o3d.geometry.PointCloud):
+        return len(data.points)
+    if isinstance(data, MultiModalPointCloud):
+        # Same count as the pair of point clouds
+        return data.point_count + data.thermal_point_count
+    if isinstance(data, DualPointCloudPack):
+        return count_points(data.visible_pointcloud) + count_points(data.thermal_pointcloud)
+    if isinstance(data, (list, tuple)):
+        return sum(count_points(x) for x in data)
+    if isinstance(data, dict):
+        return sum(count_points(x) for x in data.values())
+    return 0
+
+def count_items(data) -> int:
+    if isinstance(data, list):
+        return len(data)
+    if hasattr(data, 'count') and isinstance(data.count, int):
+        # Lazy batches
+        return data.count
+    return 1
+
+def peak_rss() -> int:
+    # Peak resident set size of the process (bytes)
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+@dataclass
+class StepProfile:
+    index : int
+    step : str
+    wall_time : float = 0.0
+    cpu_time : float = 0.0
+    rss_peak_delta : int = 0
+    items : int = 0
+    points_in : int = 0
+    points_out : int = 0
+    frames : List[Dict] = field(default_factory=list)
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.wall_time if self.wall_time > 0 else 0.0
+
+    @property
+    def points_per_second(self) -> float:
+        return max(self.points_in, self.points_out) / self.wall_time if self.wall_time > 0 else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            **asdict(self),
+            'items_per_second' : self.items_per_second,
+            'points_per_second' : self.points_per_second
+        }
+
+class PipelineProfiler:
+    """Per step wall time, CPU time, peak RSS increase and processed items/points of a pipeline.
+
+    The per-item steps also record the time and the points of every frame. The CPU time and the
+    memory are measured for the whole process, so they include the steps running at the same time
+    in the streaming and concurrent modes. The steps listed in cprofile (class names, or True for all
+    steps) are also profiled with cProfile and their statistics are dumped in the result directory.
+    """
+    def __init__(self,
+        result_dir : str = None,
+        name : str = 'pipeline',
+        cprofile : Union[bool, List[str]] = None
+    ) -> None:
+        self.result_dir = result_dir
+        self.name = name
+        self.cprofile = cprofile
+        self.records : Dict[int, StepProfile] = {}
+        self.wall_time = 0.0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self.records = {}
+        self.wall_time = 0.0
+
+    def _record(self, index : int, step) -> StepProfile:
+        with self._lock:
+            if not index in self.records:
+                self.records[index] = StepProfile(index, type(step).__name__)
+            return self.records[index]
+
+    def _cprofile_enabled(self, step) -> bool:
+        if not self.cprofile:
+            return False
+        return self.cprofile is True or type(step).__name__ in self.cprofile
+
+    @contextmanager
+    def run(self):
+        # Whole pipeline execution
+        self.reset()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.wall_time = time.perf_counter() - start
+            if self.result_dir is not None:
+                self.save(self.result_dir)
+
+    @contextmanager
+    def measure(self, index : int, step, inputs : Dict = None):
+        record = self._record(index, step)
+        profiler = None
+        if self._cprofile_enabled(step):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as ex:
+                # Only one profiler can be active at a time with sys.monitoring (Python >= 3.12)
+                logging.warning(f'{record.step} cannot be profiled : {ex}')
+                profiler = None
+        rss = peak_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        outputs = {}
+        try:
+            yield outputs
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            if profiler is not None:
+                profiler.disable()
+                if self.result_dir is not None:
+                    os.makedirs(self.result_dir, exist_ok=True)
+                    profiler.dump_stats(os.path.join(self.result_dir, f'{self.name}_{index}_{record.step}.prof'))
+            with self._lock:
+                record.wall_time += wall
+                record.cpu_time += cpu
+                record.rss_peak_delta = max(record.rss_peak_delta, peak_rss() - rss)
+                # The per-item steps count their frames themselves
+                if not step.per_item:
+                    if inputs:
+                        record.items += max(count_items(x) for x in inputs.values())
+                    record.points_in += count_points(inputs)
+                    record.points_out += count_points(outputs.get('result'))
+
+    def item_observer(self, index : int, step):
+        def _observe(item_index : int, item, result, elapsed : float):
+            record = self._record(index, step)
+            frame = {
+                'index' : item_index,
+                'wall_time' : elapsed,
+                'points_in' : count_points(item),
+                'points_out' : count_points(result)
+            }
+            with self._lock:
+                record.frames.append(frame)
+                record.items += 1
+                record.points_in += frame['points_in']
+                record.points_out += frame['points_out']
+        return _observe
+
+    def summary(self) -> List[Dict]:
+        return [self.records[i].to_dict() for i in sorted(self.records)]
+
+    def save(self, result_dir : str):
+        os.makedirs(result_dir, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(result_dir, f'{self.name}_profile.json'), 'w') as fp:
+            json.dump({
+                'name' : self.name,
+                'wall_time' : self.wall_time,
+                'steps' : summary
+            }, fp, indent=4)
+        with open(os.path.join(result_dir, f'{self.name}_profile.csv'), 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=__profile_fields__, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(summary)
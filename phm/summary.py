@@ -0,0 +1,137 @@
+
+import os
+import json
+import logging
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+from phm.data import RGBDnT
+
+__summary_index__ = 'summary_index.jsonl'
+__thermal_bins__ = 16
+
+def _raw_scale(thermal_range) -> Tuple[float, float]:
+    # Raw value of the intensity v : low + v * scale (intensities are kept as they are without range)
+    if thermal_range is None:
+        return 0.0, 1.0
+    low, high = thermal_range
+    return float(low), (float(high) - float(low)) / 255.0
+
+def summarize_frame(data : RGBDnT, bins : int = __thermal_bins__) -> Dict:
+    frame = data.data
+    depth = frame[:,:,2]
+    valid = np.isfinite(depth) & (depth > 0)
+    points = frame[valid][:, :3]
+    # Zero thermal values are outside of the thermal field of view
+    thermal = frame[:,:,-1][valid]
+    thermal = thermal[thermal > 0]
+    # The histogram is computed on the intensities, the statistics are given in raw thermal values
+    hist, _ = np.histogram(thermal, bins=bins, range=(0, 256))
+    low, scale = _raw_scale(data.thermal_range)
+    return {
+        'bbox_min' : points.min(axis=0).tolist() if len(points) > 0 else None,
+        'bbox_max' : points.max(axis=0).tolist() if len(points) > 0 else None,
+        'valid_points' : int(len(points)),
+        'thermal_points' : int(len(thermal)),
+        'thermal_min' : low + scale * float(thermal.min()) if len(thermal) > 0 else None,
+        'thermal_max' : low + scale * float(thermal.max()) if len(thermal) > 0 else None,
+        'thermal_mean' : low + scale * float(thermal.mean()) if len(thermal) > 0 else None,
+        'thermal_range' : list(data.thermal_range) if data.thermal_range is not None else None,
+        'thermal_histogram' : hist.tolist()
+    }
+
+class FrameSummaryIndex:
+    def __init__(self, file : str = None) -> None:
+        self.file = file
+        self.frames : Dict[str, Dict] = {}
+        self._arrays = None
+        if file is not None and os.path.isfile(file):
+            self.__load()
+
+    @staticmethod
+    def open(target_dir : str):
+        return FrameSummaryIndex(os.path.join(target_dir, __summary_index__))
+
+    def __load(self):
+        with open(self.file, 'r') as fj:
+            for line in fj:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f'Corrupted record in {self.file} is ignored!')
+                    continue
+                self.frames[record['fid']] = record['summary']
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, fid : str):
+        return fid in self.frames
+
+    def __getitem__(self, fid : str) -> Dict:
+        return self.frames[fid]
+
+    @property
+    def fids(self) -> List[str]:
+        return sorted(self.frames.keys())
+
+    def add(self, fid : str, summary : Dict):
+        self.frames[fid] = summary
+        self._arrays = None
+        # The records are appended so that an interrupted build keeps its summaries
+        if self.file is not None:
+            with open(self.file, 'a') as fj:
+                fj.write(json.dumps({'fid' : fid, 'summary' : summary}) + '\n')
+
+    def __get_arrays(self):
+        if self._arrays is None:
+            fids = self.fids
+            def _column(key, size = None):
+                return np.array([
+                    self.frames[fid][key] if self.frames[fid][key] is not None else \
+                        ([np.nan] * size if size is not None else np.nan)
+                    for fid in fids
+                ], dtype=np.float64)
+            self._arrays = {
+                'fids' : np.array(fids),
+                'bbox_min' : _column('bbox_min', 3).reshape(-1, 3),
+                'bbox_max' : _column('bbox_max', 3).reshape(-1, 3),
+                'valid_points' : _column('valid_points'),
+                'thermal_min' : _column('thermal_min'),
+                'thermal_max' : _column('thermal_max'),
+                'thermal_mean' : _column('thermal_mean'),
+                # Raw value of the intensity v : low + v * scale
+                'thermal_scale' : np.array([_raw_scale(self.frames[fid].get('thermal_range')) for fid in fids], 
+                    dtype=np.float64).reshape(-1, 2),
+                'thermal_histogram' : np.array([self.frames[fid]['thermal_histogram'] for fid in fids]) \
+                    if fids else np.zeros((0, __thermal_bins__))
+            }
+        return self._arrays
+
+    def query_box(self, box_min, box_max, min_points : int = 1) -> List[str]:
+        # Frames whose bounding box intersects the given box
+        arr = self.__get_arrays()
+        box_min = np.asarray(box_min, dtype=np.float64)
+        box_max = np.asarray(box_max, dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            mask = np.all(arr['bbox_min'] <= box_max, axis=1) & \
+                   np.all(arr['bbox_max'] >= box_min, axis=1) & \
+                   (arr['valid_points'] >= min_points)
+        return arr['fids'][mask].tolist()
+
+    def query_thermal_above(self, value : float, statistic : str = 'max', min_points : int = 1) -> List[str]:
+        arr = self.__get_arrays()
+        key = f'thermal_{statistic}'
+        if not statistic in ('min', 'max', 'mean'):
+            raise ValueError(f'{statistic} thermal statistic is not supported!')
+        with np.errstate(invalid='ignore'):
+            mask = arr[key] > value
+        if min_points > 1:
+            # Only the histogram bins lying completely above the value are counted
+            hist = arr['thermal_histogram']
+            edges = np.linspace(0, 256, hist.shape[1] + 1)
+            low, scale = arr['thermal_scale'][:, :1], arr['thermal_scale'][:, 1:]
+            above = (low + scale * edges[np.newaxis, :-1]) > value
+            mask &= (hist * above).sum(axis=1) >= min_points
+        return arr['fids'][mask].tolist()
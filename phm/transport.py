@@ -0,0 +1,219 @@
+
+import os
+import json
+import threading
+import weakref
+import numpy as np
+import open3d as o3d
+
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, Tuple
+
+from phm.data import RGBDnT
+from phm.data.vtd import DualPointCloudPack, MultiModalPointCloud
+
+__shm_alignment__ = 64
+
+def encode_value(value, arrays : Dict[str, np.ndarray]) -> Dict:
+    """Split a value into its arrays (added to arrays) and a JSON serializable spec of its structure."""
+    def _array(arr : np.ndarray) -> str:
+        if arr.dtype.hasobject:
+            raise TypeError('Object arrays are not supported!')
+        name = f'a{len(arrays)}'
+        arrays[name] = arr
+        return name
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {'t' : 'value', 'v' : value}
+    if isinstance(value, np.generic):
+        return {'t' : 'value', 'v' : value.item()}
+    if isinstance(value, np.ndarray):
+        return {'t' : 'array', 'k' : _array(value)}
+    if isinstance(value, o3d.geometry.PointCloud):
+        spec = {'t' : 'pc', 'points' : _array(np.asarray(value.points))}
+        if value.has_colors():
+            spec['colors'] = _array(np.asarray(value.colors))
+        if value.has_normals():
+            spec['normals'] = _array(np.asarray(value.normals))
+        return spec
+    if isinstance(value, DualPointCloudPack):
+        return {'t' : 'dual', 'v' : [encode_value(value.visible_pointcloud, arrays), encode_value(value.thermal_pointcloud, arrays)]}
+    if isinstance(value, MultiModalPointCloud):
+        spec = {'t' : 'mm', 'points' : _array(value.points), 'thermal' : _array(value.thermal)}
+        for name in ('colors', 'normals', 'thermal_mask'):
+            if getattr(value, name) is not None:
+                spec[name] = _array(getattr(value, name))
+        return spec
+    if isinstance(value, RGBDnT):
+        return {'t' : 'rgbdnt', 'k' : _array(value.data), 'fid' : encode_value(value.fid, arrays), 'range' : value.thermal_range}
+    if isinstance(value, (list, tuple)):
+        return {'t' : type(value).__name__, 'v' : [encode_value(x, arrays) for x in value]}
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {'t' : 'dict', 'v' : {k : encode_value(x, arrays) for k, x in value.items()}}
+    raise TypeError(f'{type(value).__name__} is not supported!')
+
+def decode_value(spec : Dict, arrays) -> Any:
+    """Rebuild a value from its spec, the arrays are used as they are (no copy)."""
+    kind = spec['t']
+    if kind == 'value':
+        return spec['v']
+    if kind == 'array':
+        return arrays[spec['k']]
+    if kind == 'pc':
+        # Open3D copies the points in its own buffers
+        pc = o3d.geometry.PointCloud()
+        pc.points = o3d.utility.Vector3dVector(arrays[spec['points']])
+        if 'colors' in spec:
+            pc.colors = o3d.utility.Vector3dVector(arrays[spec['colors']])
+        if 'normals' in spec:
+            pc.normals = o3d.utility.Vector3dVector(arrays[spec['normals']])
+        return pc
+    if kind == 'dual':
+        return DualPointCloudPack(*[decode_value(x, arrays) for x in spec['v']])
+    if kind == 'mm':
+        return MultiModalPointCloud(**{k : arrays[v] for k, v in spec.items() if k != 't'})
+    if kind == 'rgbdnt':
+        return RGBDnT(arrays[spec['k']], decode_value(spec['fid'], arrays), spec.get('range'))
+    if kind == 'list':
+        return [decode_value(x, arrays) for x in spec['v']]
+    if kind == 'tuple':
+        return tuple(decode_value(x, arrays) for x in spec['v'])
+    if kind == 'dict':
+        return {k : decode_value(x, arrays) for k, x in spec['v'].items()}
+    raise ValueError(f'{kind} values are not supported!')
+
+def save_value(file : str, value, max_bytes : int = None) -> bool:
+    """Write a value in an uncompressed npz file (the arrays are written as they are), replaced atomically.
+
+    Returns False without writing if the arrays exceed max_bytes, raises TypeError if the value is not supported.
+    """
+    arrays = {}
+    spec = encode_value(value, arrays)
+    if max_bytes is not None and sum(a.nbytes for a in arrays.values()) > max_bytes:
+        return False
+    tmp_file = f'{file}.{threading.get_ident()}.tmp'
+    with open(tmp_file, 'wb') as fc:
+        np.savez(fc, __spec__=np.array(json.dumps(spec)), **arrays)
+    os.replace(tmp_file, file)
+    return True
+
+def load_value(file : str) -> Any:
+    with np.load(file, allow_pickle=False) as data:
+        return decode_value(json.loads(str(data['__spec__'])), data)
+
+def share_tracker():
+    """Start the resource tracker before the workers, so that they register their blocks in the same tracker.
+
+    Forked workers otherwise start their own tracker, which reports the blocks released by this process as leaked.
+    """
+    resource_tracker.ensure_running()
+
+def _unlink_block(name : str):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+def _close_block(shm : shared_memory.SharedMemory):
+    try:
+        shm.close()
+    except BufferError:
+        # Some views are still referenced, the mapping is released with them
+        pass
+
+class SharedBlock:
+    """Value whose arrays (RGBD&T data, point cloud buffers, ...) are stored in one shared memory block.
+
+    Only the descriptor (block name, array layout and value structure) is pickled between processes,
+    the receiver rebuilds zero-copy NumPy views on the block. The block belongs to one process at a time:
+    the owner unlinks it by release(), or when the descriptor is garbage collected. A worker returning
+    a block disowns it, and the receiving process adopts it.
+    """
+    def __init__(self, name : str, layout : List[Tuple], spec : Dict, nbytes : int) -> None:
+        self.name = name
+        # [(key, offset, shape, dtype)]
+        self.layout = layout
+        self.spec = spec
+        self.nbytes = nbytes
+        self._finalizer = None
+
+    @classmethod
+    def create(cls, value) -> 'SharedBlock':
+        arrays = {}
+        spec = encode_value(value, arrays)
+        layout = []
+        offset = 0
+        for key, arr in arrays.items():
+            layout.append((key, offset, arr.shape, arr.dtype.str))
+            offset += -(-arr.nbytes // __shm_alignment__) * __shm_alignment__
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        block = cls(shm.name, layout, spec, offset)
+        try:
+            for key, start, shape, dtype in layout:
+                np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = arrays[key]
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        shm.close()
+        return block.adopt()
+
+    @property
+    def owner(self) -> bool:
+        return self._finalizer is not None and self._finalizer.alive
+
+    def adopt(self) -> 'SharedBlock':
+        if not self.owner:
+            self._finalizer = weakref.finalize(self, _unlink_block, self.name)
+        return self
+
+    def disown(self) -> 'SharedBlock':
+        # The block is handed over to another process
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
+        return self
+
+    def release(self):
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+        else:
+            _unlink_block(self.name)
+
+    def __getstate__(self):
+        # The ownership is not transferred by pickling
+        state = self.__dict__.copy()
+        state['_finalizer'] = None
+        return state
+
+    @contextmanager
+    def open(self):
+        """Zero-copy value on the block, it should not be used after the context."""
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            arrays = {
+                key : np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+                for key, start, shape, dtype in self.layout
+            }
+            value = decode_value(self.spec, arrays)
+            del arrays
+            yield value
+        finally:
+            value = None
+            _close_block(shm)
+
+    def load(self) -> Any:
+        """Copy of the value, independent of the block."""
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            arrays = {
+                key : np.array(np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start))
+                for key, start, shape, dtype in self.layout
+            }
+            return decode_value(self.spec, arrays)
+        finally:
+            _close_block(shm)
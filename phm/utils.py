@@ -3,7 +3,12 @@ import numpy as np
 
 from phm.data import RGBDnT
 
-modal_to_image = lambda img : (((img - np.min(img)) / (np.max(img) - np.min(img))) * 255.0).astype(np.uint8)
+__compute_dtype__ = np.float32
+
+def modal_to_image(img : np.ndarray, dtype = __compute_dtype__) -> np.ndarray:
+    img = img.astype(dtype, copy=False)
+    low, high = np.min(img), np.max(img)
+    return (((img - low) / (high - low)) * dtype(255.0)).astype(np.uint8)
 
 gray_to_rgb = lambda img : img if len(img.shape) > 2 and img.shape[2] == 3 else np.stack((img, img, img), axis=2)
 
@@ -26,11 +31,11 @@ def show_modalities_grid(data : RGBDnT):
     
     plt.show()
 
-def blend_vt(data : RGBDnT, alpha : float = 0.6):
-    thermal_rgb = gray_to_rgb(data.thermal)
-    fused = (data.visible.copy()).astype(np.float64)
-    ttemp = thermal_rgb * alpha
-    vtemp = data.visible * (1 - alpha)
+def blend_vt(data : RGBDnT, alpha : float = 0.6, dtype = __compute_dtype__):
+    thermal_rgb = gray_to_rgb(data.thermal_image)
+    fused = data.visible_image.astype(dtype)
+    ttemp = thermal_rgb * dtype(alpha)
+    vtemp = fused * dtype(1 - alpha)
     fused[thermal_rgb > 0] = vtemp[thermal_rgb > 0] + ttemp[thermal_rgb > 0]
 
-    return modal_to_image(fused)
\ No newline at end of file
+    return modal_to_image(fused, dtype)
\ No newline at end of file
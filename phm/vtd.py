@@ -6,12 +6,14 @@ import json
 import numpy as np
 import open3d as o3d
 
-from typing import List
+from functools import lru_cache
+from typing import Dict, List
 from scipy.io import savemat, loadmat
 
-from phm.utils import gray_to_rgb, modal_to_image
-from phm.control_point import cpselect
+from phm.utils import __compute_dtype__, gray_to_rgb, modal_to_image
+from phm.calibration import estimate_homography, homography_shift, refine_homography_pyramid, save_calibration_report
 from phm.data import MMEContainer, RGBDnT
+from phm.normalization import ThermalNormalizer
 from phm.data.vtd import __depth_scale__
 
 __homography__ = 'homography'
@@ -48,6 +50,41 @@ def load_pinhole(file : str):
         cx = p_x, cy = p_y
     )
 
+def _camera_key(params : Dict):
+    # Hashable identity of a camera model, None if the camera has no distortion
+    if params is None or not any(params.get('D', [])):
+        return None
+    return tuple(params['K']), tuple(params['D'])
+
+@lru_cache(maxsize=8)
+def _undistort_maps(K : tuple, D : tuple, shape : tuple):
+    K = np.asarray(K, np.float64).reshape(3, 3)
+    # The undistorted image keeps the camera matrix, so the pinhole model remains valid
+    return cv2.initUndistortRectifyMap(K, np.asarray(D, np.float64), None, K, 
+        (shape[1], shape[0]), cv2.CV_16SC2)
+
+def undistort_image(img : np.ndarray, params : Dict, interpolation = cv2.INTER_LINEAR):
+    """Undistort an image given the camera parameters (K and D), the maps are cached per camera."""
+    key = _camera_key(params)
+    if key is None:
+        return img
+    map1, map2 = _undistort_maps(*key, tuple(img.shape[:2]))
+    return cv2.remap(img, map1, map2, interpolation)
+
+def distort_points(points : np.ndarray, params : Dict) -> np.ndarray:
+    # Projection of undistorted pixel coordinates into the distorted (raw) image
+    K = np.asarray(params['K'], np.float64).reshape(3, 3)
+    xn = (points[:, 0] - K[0, 2]) / K[0, 0]
+    yn = (points[:, 1] - K[1, 2]) / K[1, 1]
+    obj = np.stack((xn, yn, np.ones_like(xn)), axis=1).reshape(-1, 1, 3)
+    D = np.asarray(params['D'], np.float64)
+    img, _ = cv2.projectPoints(obj, np.zeros(3), np.zeros(3), K, D)
+    img = img.reshape(-1, 2)
+    # Far outside of the field of view the distortion polynomial folds back into the image
+    back = cv2.undistortPoints(img.reshape(-1, 1, 2), K, D, P=K).reshape(-1, 2)
+    img[np.abs(back - points).max(axis=1) > 0.5] = -1
+    return img
+
 def load_homography(file : str, silent : bool = False):
     if file is None or not os.path.isfile(file):
         if not silent:
@@ -70,10 +107,25 @@ class VTD_Alignment:
     __thermal__ = 'thermal'
     __visible__ = 'visible'
     __depth__ = 'depth'
+    __refine_defaults__ = {
+        'scale' : 0.5,
+        'levels' : 2,
+        'max_iterations' : 20,
+        'epsilon' : 1e-4,
+        'time_budget' : 0.05,
+        # Refinements moving the thermal image more than this (visible pixels) are rejected
+        'max_shift' : 10.0
+    }
 
     def __init__(self, 
         target_dir : str = None,
-        depth_param_file : str = None
+        depth_param_file : str = None,
+        refine : bool = False,
+        refine_params : Dict = None,
+        dtype = __compute_dtype__,
+        thermal_normalizer : ThermalNormalizer = None,
+        undistort : bool = False,
+        thermal_param_file : str = None
     ) -> None:
         self.target_dir = target_dir if target_dir is not None else os.getcwd()
         # Load Homography
@@ -86,6 +138,25 @@ class VTD_Alignment:
         self.depth_param_file = depth_param_file
         self._depth_params = load_depth_camera_params(self.depth_param_file)
         logging.info(f'Depth camera parameters are loaded ({self.depth_param_file})')
+        # Lens undistortion (the homography then relates the undistorted images)
+        self.undistort = undistort
+        self.thermal_param_file = thermal_param_file
+        self._thermal_params = None
+        if self.thermal_param_file is not None:
+            self._thermal_params = load_depth_camera_params(self.thermal_param_file)
+            logging.info(f'Thermal camera parameters are loaded ({self.thermal_param_file})')
+        # Dataset-wide thermal normalization (otherwise each frame is normalized by its own range)
+        self.thermal_normalizer = thermal_normalizer
+        # Millimetre depth does not need double precision
+        self.dtype = np.dtype(dtype).type
+        # The rig geometry is fixed, so the per-pixel tables are computed once
+        self._remap_tables = None
+        self._ray_grid = None
+        # Optional per-frame refinement of the homography
+        self.refine = refine
+        self.refine_params = {**self.__refine_defaults__, **(refine_params if refine_params is not None else {})}
+        self.refine_stats = {'frames' : 0, 'refined' : 0, 'fallbacks' : 0, 'over_budget' : 0, 'total_time' : 0.0, 'max_time' : 0.0}
+        self.last_refinement = None
 
     @property
     def homography(self):
@@ -95,6 +166,10 @@ class VTD_Alignment:
     def depth_camera_params(self):
         return self._depth_params
 
+    @property
+    def thermal_camera_params(self):
+        return self._thermal_params
+
     @property
     def pinhole_camera(self) -> o3d.camera.PinholeCameraIntrinsic:
         dparam = self.depth_camera_params
@@ -109,15 +184,33 @@ class VTD_Alignment:
             cx = p_x, cy = p_y
         )
 
-    def estimate_alignment_params(self, dt):
+    def estimate_alignment_params(self, dt, method : str = 'auto', **kwargs):
+        """Estimate the homography from a calibration frame or a list of frames.
+
+        Frames can be given as containers or as (fid, container) tuples. The 'auto' method runs
+        headless (see phm.calibration.estimate_homography), the 'manual' method runs the control
+        point selector on the first frame.
+        """
         if self.homography is not None:
             return
-        data = dt[1]
-        # STEP 01 : Run control point selector toolbox
-        cps = cpselect(data['thermal'].data, data['visible'].data)
-        source, dest = self.cp_to_opencv(cps)
-        # STEP 02 : estimate homography transformation
-        h, _ = cv2.findHomography(source, dest)
+        dt = dt if isinstance(dt, list) else [dt]
+        frames = [x[1] if isinstance(x, tuple) else x for x in dt]
+        if method == 'manual':
+            # Qt is only needed for interactive calibration
+            from phm.control_point import cpselect
+            data = frames[0]
+            # STEP 01 : Run control point selector toolbox
+            cps = cpselect(data[self.__thermal__].data, data[self.__visible__].data)
+            source, dest = self.cp_to_opencv(cps)
+            # STEP 02 : estimate homography transformation
+            h, _ = cv2.findHomography(source, dest)
+        elif method == 'auto':
+            h, report = estimate_homography(
+                [(data[self.__thermal__].data, data[self.__visible__].data) for data in frames], **kwargs)
+            report['fids'] = [x[0] for x in dt if isinstance(x, tuple)]
+            save_calibration_report(self.target_dir, report)
+        else:
+            raise ValueError(f'{method} alignment estimation is not supported!')
         self._homography = h
         # Save homography
         save_homography(self.homography_file, self.homography)
@@ -135,6 +228,7 @@ class VTD_Alignment:
 
     def reset(self):
         self._homography = None
+        self._remap_tables = None
 
     def __align(self, data : MMEContainer) -> RGBDnT:
         if not self.__thermal__ in data.modality_names or \
@@ -143,38 +237,117 @@ class VTD_Alignment:
             raise ValueError(f'Data container does not have {self._src_type} or {self._dsc_type}')
         # Check homography availability
         if self.homography is None:
-            # raise ValueError('Homography matrix is required for modality alignment. First, call estimate_alignment_param function!')
+            logging.warning('Homography is not available, it is estimated from the current frame!')
             self.estimate_alignment_params(data)
         # Corrent the thermal image
-        thermal = modal_to_image(data[self.__thermal__].data)
+        thermal = self.thermal_normalizer.apply(data[self.__thermal__].data) \
+            if self.thermal_normalizer is not None else \
+            modal_to_image(data[self.__thermal__].data, self.dtype)
+        thermal_range = self.thermal_range(data[self.__thermal__].data)
         visible = data[self.__visible__].data
         depth = data[self.__depth__].data
-        corrected_thermal = cv2.warpPerspective(thermal, self.homography, 
-            (visible.shape[1], visible.shape[0]))
+        if self.undistort:
+            visible = undistort_image(visible, self.depth_camera_params)
+            # Depth values are not interpolated across the object borders
+            depth = undistort_image(depth, self.depth_camera_params, cv2.INTER_NEAREST)
+        homography = None
+        if self.refine:
+            raw_thermal = data[self.__thermal__].data
+            if self.undistort:
+                raw_thermal = undistort_image(raw_thermal, self.thermal_camera_params)
+            homography = self.refine_homography(raw_thermal, visible)
+        if homography is None:
+            # Thermal undistortion and homography in a single remap
+            map1, map2 = self._get_remap_tables(visible.shape[:2])
+            corrected_thermal = cv2.remap(thermal, map1, map2, cv2.INTER_LINEAR)
+        else:
+            if self.undistort:
+                thermal = undistort_image(thermal, self.thermal_camera_params)
+            corrected_thermal = cv2.warpPerspective(thermal, homography, 
+                (visible.shape[1], visible.shape[0]))
         
-        return visible, corrected_thermal, depth
+        return visible, corrected_thermal, depth, thermal_range
+
+    def thermal_range(self, thermal : np.ndarray) -> List[float]:
+        # Raw thermal values of the intensities 0 and 255 in the aligned frames
+        if self.thermal_normalizer is not None:
+            return [float(self.thermal_normalizer.low), float(self.thermal_normalizer.high)]
+        return [float(np.min(thermal)), float(np.max(thermal))]
+
+    def refine_homography(self, thermal, visible):
+        """Refine the stored homography for a single frame, returns None if the global homography should be used."""
+        params = dict(self.refine_params)
+        max_shift = params.pop('max_shift')
+        try:
+            homography, info = refine_homography_pyramid(thermal, visible, self.homography, **params)
+            info['shift'] = homography_shift(self.homography, homography, thermal.shape)
+            # Nothing is refined if the budget does not allow any level
+            info['refined'] = info['levels'] > 0 and info['shift'] <= max_shift
+        except cv2.error:
+            # ECC has not converged
+            homography = None
+            info = {'levels' : 0, 'cc' : None, 'time' : 0.0, 'shift' : None, 'refined' : False}
+        # Per-frame cost
+        stats = self.refine_stats
+        stats['frames'] += 1
+        stats['total_time'] += info['time']
+        stats['max_time'] = max(stats['max_time'], info['time'])
+        if params['time_budget'] is not None and info['time'] > params['time_budget']:
+            stats['over_budget'] += 1
+        if info['refined']:
+            stats['refined'] += 1
+        else:
+            stats['fallbacks'] += 1
+        self.last_refinement = info
+        return homography if info['refined'] else None
+
+    def _get_remap_tables(self, shape):
+        # Thermal to visible remap tables of the homography (what cv2.warpPerspective computes per call)
+        # composed with the thermal lens undistortion
+        thermal_camera = _camera_key(self.thermal_camera_params) if self.undistort else None
+        key = (tuple(shape), self.homography.tobytes(), thermal_camera)
+        if self._remap_tables is None or self._remap_tables[0] != key:
+            height, width = shape
+            X, Y = np.meshgrid(np.arange(width), np.arange(height))
+            pts = np.stack((X.ravel(), Y.ravel(), np.ones(X.size)))
+            src = np.linalg.inv(self.homography) @ pts
+            src = np.stack((src[0] / src[2], src[1] / src[2]), axis=1)
+            if thermal_camera is not None:
+                # Undistorted thermal coordinates are mapped to the raw thermal image
+                src = distort_points(src, self.thermal_camera_params)
+            map_x = src[:, 0].reshape(height, width).astype(np.float32)
+            map_y = src[:, 1].reshape(height, width).astype(np.float32)
+            # Fixed-point tables are faster to apply
+            map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+            self._remap_tables = (key, (map1, map2))
+        return self._remap_tables[1]
+
+    def _get_ray_grid(self, shape):
+        # Per-pixel ray directions : (x - p_x) / f_x and (y - p_y) / f_y
+        K = self._depth_params['K']
+        key = (tuple(shape), K[0], K[2], K[4], K[5], self.dtype)
+        if self._ray_grid is None or self._ray_grid[0] != key:
+            height, width = shape
+            f_x, p_x, f_y, p_y = K[0], K[2], K[4], K[5]
+            ray_x = ((np.arange(width) - p_x) / f_x).astype(self.dtype).reshape(1, width)
+            ray_y = ((np.arange(height) - p_y) / f_y).astype(self.dtype).reshape(height, 1)
+            self._ray_grid = (key, (ray_x, ray_y))
+        return self._ray_grid[1]
 
     def compute(self, data : MMEContainer) -> RGBDnT:
-        visible, thermal, depth = self.__align(data)
-        return self._fuse(visible, thermal, depth)
+        visible, thermal, depth, thermal_range = self.__align(data)
+        res = self._fuse(visible, thermal, depth)
+        res.thermal_range = thermal_range
+        return res
 
     def _fuse(self, visible, thermal, depth):
         # Form the point cloud
         # P = d * [(x - p_x) / f_x , (y - p_y) / f_y, 1]^-1
-        height, width = depth.shape
-
-        X = np.linspace(0, width-1, width)
-        Y = np.linspace(0, height-1, height)
-        X, Y = np.meshgrid(X, Y)
-        # Form the Pinhole Camera parameters
-        f_x = self._depth_params['K'][0]
-        p_x = self._depth_params['K'][2]
-        f_y = self._depth_params['K'][4]
-        p_y = self._depth_params['K'][5]
+        ray_x, ray_y = self._get_ray_grid(depth.shape)
         # Correct the coordinates
-        Z = depth / __depth_scale__
-        X = np.multiply(Z, (X - p_x) / f_x)
-        Y = np.multiply(Z, (Y - p_y) / f_y)
+        Z = depth.astype(self.dtype) / self.dtype(__depth_scale__)
+        X = np.multiply(Z, ray_x)
+        Y = np.multiply(Z, ray_y)
         
-        data =  np.dstack((X,Y,Z, gray_to_rgb(visible), thermal))
+        data =  np.dstack((X,Y,Z, gray_to_rgb(visible), thermal)).astype(self.dtype, copy=False)
         return RGBDnT(data)
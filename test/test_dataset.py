@@ -1,14 +1,65 @@
 
 import os
 import sys
+import json
+import pickle
+import tempfile
 import unittest
 
+import numpy as np
+import open3d as o3d
+from PIL import Image
+
 sys.path.append(os.getcwd())
 sys.path.append(__file__)
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
+from phm.cache import FrameCache, get_frame_cache, sizeof_frame
+from phm.data import DualPointCloudPack, MultiModalPointCloud, RGBDnT
+from phm.normalization import ThermalNormalizer
+from phm.summary import FrameSummaryIndex
+from phm.transport import SharedBlock
+from phm.vtd import save_homography
 from phm.io import load_mme, load_point_cloud
-from phm.dataset import Dataset_LoadableFunc, VTD_Dataset, create_mme_dataset, create_point_cloud_dataset, create_vtd_dataset
+from phm.dataset import Dataset, Dataset_LoadableFunc, VTD_Dataset, build_summary_index, create_dual_point_cloud_stream, create_mme_dataset, create_thermal_normalizer, create_point_cloud_dataset, create_vtd_dataset, index_modalities, match_modalities
+
+class Range_Dataset(Dataset):
+    def __init__(self, count : int) -> None:
+        super().__init__()
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def get(self, index : int):
+        return range(self.count)[index]
+
+def create_modality_folders(root_dir : str, fids, height : int = 4, width : int = 6):
+    rng = np.random.default_rng(0)
+    for dtype, fids_list in fids.items():
+        dtype_dir = os.path.join(root_dir, dtype)
+        os.makedirs(dtype_dir, exist_ok=True)
+        for fid in fids_list:
+            if dtype == 'visible':
+                img = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+            elif dtype == 'depth':
+                img = rng.integers(500, 3000, (height, width), dtype=np.uint16)
+            else:
+                img = rng.integers(0, 255, (height, width), dtype=np.uint8)
+            Image.fromarray(img).save(os.path.join(dtype_dir, f'{dtype}_{fid}.png'))
+
+def create_calibration(root_dir : str, height : int = 4, width : int = 6):
+    depth_param_file = os.path.join(root_dir, 'camera_info.json')
+    with open(depth_param_file, 'w') as fdc:
+        json.dump({
+            'width' : width, 'height' : height,
+            'K' : [5.0, 0.0, width / 2, 0.0, 5.0, height / 2, 0.0, 0.0, 1.0],
+            'D' : [0.0, 0.0, 0.0, 0.0, 0.0]
+        }, fdc)
+    calib_dir = os.path.join(root_dir, 'calib')
+    os.makedirs(calib_dir, exist_ok=True)
+    save_homography(os.path.join(calib_dir, 'homography.mat'), np.identity(3))
+    return depth_param_file, calib_dir
 
 class Test_Dataset(unittest.TestCase):
     def test_load_mme_mat_dataset(self):
@@ -63,5 +114,290 @@ class Test_Dataset(unittest.TestCase):
             '/home/phm/GoogleDrive/Personal/Datasets/my-dataset/multi-modal/20210706_multi_modal/pc/pcs_1625604434719.ply', 
             'ply_txt')
 
+    def test_match_modalities(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            create_modality_folders(root_dir, {
+                'visible' : ['1625604430816', '1625604430916', '1625604431016'],
+                'thermal' : ['1625604430816', '1625604431016'],
+                'depth' : ['1625604430816', '1625604430916', '1625604431016']
+            })
+            matched = match_modalities(index_modalities({
+                dtype : os.path.join(root_dir, dtype) for dtype in ('visible', 'thermal', 'depth')
+            }))
+            self.assertEqual([x[0] for x in matched], ['1625604430816', '1625604431016'])
+            self.assertEqual(set(matched[0][1].keys()), {'visible', 'thermal', 'depth'})
+
+    def test_match_modalities_tolerance(self):
+        indexed = {
+            'visible' : {'1625604430816' : 'v1', '1625604430916' : 'v2', '1625604431016' : 'v3'},
+            'thermal' : {'1625604430818' : 't1', '1625604430913' : 't2', '1625604431050' : 't3'},
+            'depth' : {'1625604430815' : 'd1', '1625604430916' : 'd2', '1625604431019' : 'd3'}
+        }
+        self.assertEqual(match_modalities(indexed), [])
+        matched = match_modalities(indexed, tolerance=5)
+        self.assertEqual(matched, [
+            ('1625604430816', {'visible' : 'v1', 'thermal' : 't1', 'depth' : 'd1'}),
+            ('1625604430916', {'visible' : 'v2', 'thermal' : 't2', 'depth' : 'd2'})
+        ])
+        # A frame closer to the next timestamp is kept when the next timestamp has its own match
+        indexed = {
+            'visible' : {'1625604430100' : 'v1', '1625604430104' : 'v2'},
+            'thermal' : {'1625604430103' : 't1', '1625604430104' : 't2'}
+        }
+        self.assertEqual(match_modalities(indexed, tolerance=5), [
+            ('1625604430100', {'visible' : 'v1', 'thermal' : 't1'}),
+            ('1625604430104', {'visible' : 'v2', 'thermal' : 't2'})
+        ])
+        # Otherwise the current timestamp takes the closest of the earlier frames
+        indexed['thermal'] = {'1625604430099' : 't1', '1625604430103' : 't2'}
+        self.assertEqual(match_modalities(indexed, tolerance=5), [
+            ('1625604430100', {'visible' : 'v1', 'thermal' : 't1'}),
+            ('1625604430104', {'visible' : 'v2', 'thermal' : 't2'})
+        ])
+
+    def test_create_mme_dataset_parallel(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1625604430816', '1625604430916', '1625604431016']
+            create_modality_folders(root_dir, {'visible' : fids, 'thermal' : fids, 'depth' : fids})
+            res_dir = os.path.join(root_dir, 'rgbdt')
+            create_mme_dataset(root_dir=root_dir, res_dir=res_dir, file_type='mat', num_workers=2)
+            self.assertEqual(sorted(f for f in os.listdir(res_dir) if f.endswith('.mat')), [f'mme_{fid}.mat' for fid in fids])
+
+    def test_create_mme_dataset_incremental(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1625604430816', '1625604430916']
+            create_modality_folders(root_dir, {'visible' : fids, 'thermal' : fids, 'depth' : fids})
+            res_dir = os.path.join(root_dir, 'rgbdt')
+            create_mme_dataset(root_dir=root_dir, res_dir=res_dir, file_type='mat', num_workers=1)
+            mtimes = {f : os.stat(os.path.join(res_dir, f)).st_mtime_ns for f in os.listdir(res_dir) if f.endswith('.mat')}
+            # Add a new capture, only the new container should be generated
+            create_modality_folders(root_dir, {'visible' : ['1625604431016'], 'thermal' : ['1625604431016'], 'depth' : ['1625604431016']})
+            create_mme_dataset(root_dir=root_dir, res_dir=res_dir, file_type='mat', num_workers=1)
+            for f, mtime in mtimes.items():
+                self.assertEqual(os.stat(os.path.join(res_dir, f)).st_mtime_ns, mtime)
+            self.assertTrue(os.path.isfile(os.path.join(res_dir, 'mme_1625604431016.mat')))
+
+    def test_frame_cache_budget(self):
+        frame = np.zeros((10, 10), dtype=np.uint8) # 100 bytes
+        for policy in ('lru', 'lfu'):
+            cache = FrameCache(max_bytes=250, policy=policy)
+            cache.put('a', '1', frame)
+            cache.put('a', '2', frame)
+            cache.get('a', '1')
+            cache.put('b', '1', frame)
+            stats = cache.stats()
+            self.assertLessEqual(stats['bytes'], 250)
+            self.assertEqual(stats['evictions'], 1)
+            self.assertIsNotNone(cache.get('a', '1'))
+            self.assertIsNone(cache.get('a', '2'))
+            self.assertEqual(stats['namespaces']['b']['items'], 1)
+
+    def test_frame_cache_point_clouds(self):
+        with tempfile.TemporaryDirectory() as pc_dir:
+            fids = ['1625604430816', '1625604430916', '1625604431016']
+            for fid in fids:
+                pc = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.random.rand(100, 3)))
+                pc.colors = o3d.utility.Vector3dVector(np.random.rand(100, 3))
+                o3d.io.write_point_cloud(os.path.join(pc_dir, f'visible_{fid}.ply'), pc)
+            # Two point clouds (4800 bytes each) fit in the budget
+            cache = FrameCache(max_bytes=10000)
+            dataset = Dataset_LoadableFunc(pc_dir, 'ply', lambda f, t: o3d.io.read_point_cloud(f), cache=cache)
+            for _ in dataset:
+                pass
+            stats = cache.stats()
+            self.assertEqual(stats['bytes'], 9600)
+            self.assertEqual(stats['evictions'], 1)
+            pack = DualPointCloudPack(dataset.get(0)[1], dataset.get(1)[1])
+            self.assertEqual(sizeof_frame(pack), 9600)
+            self.assertEqual(sizeof_frame(MultiModalPointCloud.from_pair(pack.visible_pointcloud, o3d.geometry.PointCloud())), 5700)
+
+    def test_dataset_shared_cache(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1625604430816', '1625604430916']
+            create_modality_folders(root_dir, {'visible' : fids, 'thermal' : fids, 'depth' : fids})
+            res_dir = os.path.join(root_dir, 'mme')
+            create_mme_dataset(root_dir=root_dir, res_dir=res_dir, file_type='mat', num_workers=1)
+            cache = FrameCache()
+            dataset = Dataset_LoadableFunc(res_dir, 'mat', load_mme, cache=cache)
+            first = dataset.get(0)
+            self.assertIs(dataset.get_by_fid(fids[0])[1], first[1])
+            self.assertEqual(cache.stats()['items'], 1)
+            self.assertEqual(cache.stats()['hits'], 1)
+            # A rewritten file is loaded again
+            file = dataset.data[0][1]
+            st = os.stat(file)
+            os.utime(file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            self.assertIsNot(dataset.get(0)[1], first[1])
+            # The workers attach to their own process-wide cache, a private cache is sent empty
+            self.assertIs(pickle.loads(pickle.dumps(Dataset_LoadableFunc(res_dir, 'mat', load_mme))).cache, get_frame_cache())
+            uncached = pickle.loads(pickle.dumps(Dataset_LoadableFunc(res_dir, 'mat', load_mme, cache=FrameCache(max_bytes=0))))
+            uncached.get(0)
+            self.assertEqual((uncached.cache.max_bytes, len(uncached.cache)), (0, 0))
+            # Another loader of the same folder never shares the frames
+            self.assertNotEqual(VTD_Dataset(res_dir, cache=cache).namespace, dataset.namespace)
+
+    def test_dataset_views(self):
+        dataset = Range_Dataset(300)
+        # Independent iterators
+        it1, it2 = iter(dataset), iter(dataset)
+        next(it1)
+        self.assertEqual(next(it2), 0)
+        self.assertEqual(next(it1), 1)
+        # Datasets have no shared cursor
+        with self.assertRaises(TypeError):
+            next(dataset)
+        # Slicing
+        view = dataset[100:200:2]
+        self.assertEqual(len(view), 50)
+        self.assertEqual(list(view)[:3], [100, 102, 104])
+        self.assertEqual(list(view[::-10]), list(range(100, 200, 2))[::-10])
+        # Sharding
+        shards = [dataset.shard(k, 4) for k in range(4)]
+        self.assertEqual(sorted(x for shard in shards for x in shard), list(range(300)))
+        blocks = [view.shard(k, 3, contiguous=True) for k in range(3)]
+        self.assertEqual([x for block in blocks for x in block], list(view))
+
+    def test_create_dual_point_cloud_stream(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1625604430816', '1625604430916']
+            create_modality_folders(root_dir, {'visible' : fids, 'thermal' : fids, 'depth' : fids})
+            depth_param_file, calib_dir = create_calibration(root_dir)
+            target_dir = os.path.join(root_dir, 'dual_pcs')
+            vtd_dir = os.path.join(root_dir, 'vtd')
+            create_dual_point_cloud_stream(root_dir, target_dir, depth_param_file,
+                vtd_dir=vtd_dir, calib_dir=calib_dir, num_workers=2)
+            for fid in fids:
+                self.assertTrue(os.path.isfile(os.path.join(target_dir, f'visible_{fid}.ply')))
+                self.assertTrue(os.path.isfile(os.path.join(target_dir, f'thermal_{fid}.ply')))
+            self.assertEqual(len(VTD_Dataset(vtd_dir)), len(fids))
+            # Summary index of the streamed frames
+            summary = FrameSummaryIndex.open(target_dir)
+            self.assertEqual(summary.fids, fids)
+            self.assertEqual(summary.query_box([-10, -10, 0], [10, 10, 10]), fids)
+            self.assertEqual(summary.query_box([20, 20, 20], [30, 30, 30]), [])
+            self.assertEqual(summary.query_thermal_above(255), [])
+            # Rebuilding the index from the VTD files gives the same summaries
+            rebuilt = build_summary_index(vtd_dir)
+            for fid in fids:
+                self.assertEqual(rebuilt[fid], summary[fid])
+            self.assertEqual(len(VTD_Dataset(vtd_dir).select_fids(summary.query_thermal_above(0))), len(fids))
+
+    def test_summary_raw_thermal(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1625604430816', '1625604430916']
+            create_modality_folders(root_dir, {'visible' : fids, 'thermal' : fids, 'depth' : fids})
+            # Both frames have the full intensity range once normalized, only the second one has a hot spot
+            rng = np.random.default_rng(1)
+            for fid, high in zip(fids, (3100, 5000)):
+                thermal = rng.integers(3000, 3100, (4, 6)).astype(np.uint16)
+                thermal[0, :3] = high
+                Image.fromarray(thermal).save(os.path.join(root_dir, 'thermal', f'thermal_{fid}.png'))
+            depth_param_file, calib_dir = create_calibration(root_dir)
+            target_dir = os.path.join(root_dir, 'dual_pcs')
+            vtd_dir = os.path.join(root_dir, 'vtd')
+            create_dual_point_cloud_stream(root_dir, target_dir, depth_param_file,
+                vtd_dir=vtd_dir, calib_dir=calib_dir, num_workers=1)
+            summary = FrameSummaryIndex.open(target_dir)
+            for fid in fids:
+                self.assertGreaterEqual(summary[fid]['thermal_min'], 3000)
+                self.assertLessEqual(summary[fid]['thermal_max'], 5000)
+            self.assertEqual(summary.query_thermal_above(4000), [fids[1]])
+            self.assertEqual(summary.query_thermal_above(4000, min_points=2), [fids[1]])
+            self.assertEqual(summary.query_thermal_above(4000, min_points=10), [])
+            self.assertEqual(summary.query_thermal_above(2900, statistic='min'), fids)
+            # The raw range is kept in the VTD files
+            rebuilt = build_summary_index(vtd_dir, force=True)
+            for fid in fids:
+                self.assertEqual(rebuilt[fid], summary[fid])
+
+    def test_create_vtd_dataset_parallel(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1625604430816', '1625604430916', '1625604431016']
+            create_modality_folders(root_dir, {'visible' : fids, 'thermal' : fids, 'depth' : fids})
+            depth_param_file, _ = create_calibration(root_dir)
+            mme_dir = os.path.join(root_dir, 'mme')
+            create_mme_dataset(root_dir=root_dir, res_dir=mme_dir, file_type='mat', num_workers=1)
+            blocks = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+            outputs = {}
+            for num_workers in (1, 2):
+                target_dir = os.path.join(root_dir, f'vtd_{num_workers}')
+                os.makedirs(target_dir)
+                save_homography(os.path.join(target_dir, 'homography.mat'), np.identity(3))
+                create_vtd_dataset(mme_dir, target_dir, depth_param_file, 'mat', num_workers=num_workers)
+                outputs[num_workers] = VTD_Dataset(target_dir)
+                self.assertEqual(FrameSummaryIndex.open(target_dir).fids, fids)
+            self.assertEqual(len(outputs[2]), len(fids))
+            for (fid, ref), (pfid, frame) in zip(outputs[1], outputs[2]):
+                self.assertEqual(fid, pfid)
+                np.testing.assert_array_equal(frame.data, ref.data)
+            # The frames are handed over in shared memory blocks, all of them are released
+            if os.path.isdir('/dev/shm'):
+                self.assertEqual(set(os.listdir('/dev/shm')), blocks)
+
+    def test_shared_block(self):
+        frame = RGBDnT(np.random.default_rng(0).random((4, 6, 6)), '1625604430816')
+        block = SharedBlock.create([frame, {'scale' : 2.0}])
+        self.assertTrue(block.owner)
+        # Only the descriptor is pickled, the receiver does not own the block
+        received = pickle.loads(pickle.dumps(block))
+        self.assertFalse(received.owner)
+        self.assertLess(len(pickle.dumps(block)), frame.data.nbytes)
+        with received.open() as (view, params):
+            np.testing.assert_array_equal(view.data, frame.data)
+            self.assertEqual(view.fid, frame.fid)
+            self.assertEqual(params, {'scale' : 2.0})
+        copy = received.load()
+        block.release()
+        np.testing.assert_array_equal(copy[0].data, frame.data)
+        with self.assertRaises(FileNotFoundError):
+            received.load()
+        # A dropped owner unlinks its block
+        block = SharedBlock.create(np.zeros(10))
+        name = block.name
+        del block
+        with self.assertRaises(FileNotFoundError):
+            SharedBlock(name, [], {'t' : 'value', 'v' : None}, 0).load()
+
+    def test_thermal_normalizer(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1625604430816', '1625604430916']
+            sessions = [os.path.join(root_dir, 's1'), os.path.join(root_dir, 's2')]
+            for session in sessions:
+                create_modality_folders(session, {'visible' : fids, 'thermal' : fids, 'depth' : fids})
+            calib_dir = os.path.join(root_dir, 'calib')
+            normalizer = create_thermal_normalizer(sessions, calib_dir)
+            self.assertEqual(normalizer.frames, 4)
+            thermal = [np.asarray(Image.open(os.path.join(s, 'thermal', f'thermal_{fid}.png'))) for s in sessions for fid in fids]
+            low = min(x.min() for x in thermal)
+            high = max(x.max() for x in thermal)
+            self.assertEqual((normalizer.low, normalizer.high), (low, high))
+            # The same raw value is mapped to the same intensity in all frames
+            for x in thermal:
+                expected = ((x.astype(np.float64) - low) / (high - low) * 255.0).astype(np.uint8)
+                self.assertLessEqual(np.abs(normalizer.apply(x).astype(np.int32) - expected).max(), 1)
+            loaded = ThermalNormalizer.load(calib_dir)
+            np.testing.assert_array_equal(loaded.lut, normalizer.lut)
+            self.assertEqual(loaded.get_stats(), normalizer.get_stats())
+            # Streamed build of the session using the global statistics
+            depth_param_file, _ = create_calibration(sessions[0])
+            vtd_dir = os.path.join(sessions[0], 'vtd')
+            create_dual_point_cloud_stream(sessions[0], os.path.join(sessions[0], 'dual_pcs'), depth_param_file,
+                vtd_dir=vtd_dir, calib_dir=os.path.join(sessions[0], 'calib'), thermal_normalization=True)
+            session_normalizer = ThermalNormalizer.load(os.path.join(sessions[0], 'calib'))
+            self.assertEqual(session_normalizer.frames, 2)
+            for fid, data in VTD_Dataset(vtd_dir):
+                raw = np.asarray(Image.open(os.path.join(sessions[0], 'thermal', f'thermal_{fid}.png')))
+                np.testing.assert_array_equal(data.thermal_image, session_normalizer.apply(raw))
+            # The saved statistics are not applied unless they are requested
+            create_dual_point_cloud_stream(sessions[0], os.path.join(sessions[0], 'dual_pcs'), depth_param_file,
+                vtd_dir=vtd_dir, calib_dir=os.path.join(sessions[0], 'calib'))
+            for fid, data in VTD_Dataset(vtd_dir, cache=FrameCache()):
+                raw = np.asarray(Image.open(os.path.join(sessions[0], 'thermal', f'thermal_{fid}.png')))
+                self.assertEqual(data.thermal_range, [float(raw.min()), float(raw.max())])
+            # A new capture invalidates the statistics
+            create_modality_folders(sessions[0], {'visible' : ['1625604431016'], 'thermal' : ['1625604431016'], 'depth' : ['1625604431016']})
+            self.assertEqual(create_thermal_normalizer(sessions[0], os.path.join(sessions[0], 'calib')).frames, 3)
+            self.assertEqual(create_thermal_normalizer(sessions, calib_dir).frames, 5)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
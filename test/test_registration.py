@@ -1,8 +1,16 @@
 
 import os
 import sys
+import copy
+import shutil
+import tempfile
 import unittest
 
+from typing import List
+
+import json
+import pickle
+import threading
 import numpy as np
 import open3d as o3d
 import open3d.visualization.gui as gui
@@ -13,15 +21,632 @@ sys.path.append(__file__)
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 from phm.pipeline.probreg_pipeline import CPDRegistration_Step, FilterregRegistration_Step, GMMTreeRegistration_Step, SVRRegistration_Step
-from phm.data.vtd import DualPointCloudPack, O3DPointCloudWrapper
-from phm.pipeline.core import ConvertToPC_Step, FilterDepthRange_Step, Pipeline, PipelineStep, PointCloudSaver_Step, RGBDnTBatch
+from phm.data.vtd import DualPointCloudPack, MultiModalPointCloud, O3DPointCloudWrapper, filter_out_zero_thermal, fuse_point_clouds, pack_point_clouds
+from phm.pipeline.core import AbstractRegistration_Step, ConvertToPC_Step, DoublePointCloudBatch, FilterDepthRange_Step, FrameToPC_Step, LoadBatch_Step, Pipeline, PipelineStep, PointCloudSaver_Step, Preprocessing_Step, RGBDnTBatch, _LazyItem, match_points, SequenceWindowBatcher, WindowedRegistration
 from phm.pipeline.o3d_pipeline import ColoredICPRegistar_Step, O3DRegistrationMetrics_Step
 from phm.pipeline.manual_pipeline import ManualRegistration_Step
+from phm.pipeline.cache import StepCache
+from phm.pipeline.checkpoint import PipelineCheckpoint
+from phm.pipeline.profiling import PipelineProfiler
+from phm.transport import SharedBlock
 from phm.visualization import visualize_vtd
+from phm.data import RGBDnT
+from phm.io import save_RGBDnT
 from phm.vtd import load_pinhole
 
+def create_rgbdt_frames(target_dir : str, fids, height : int = 12, width : int = 16, seed : int = 0):
+    rng = np.random.default_rng(seed)
+    K = [12.0, 0.0, width / 2, 0.0, 12.0, height / 2, 0.0, 0.0, 1.0]
+    depth_param_file = os.path.join(target_dir, 'camera_info.json')
+    with open(depth_param_file, 'w') as fdc:
+        json.dump({'width' : width, 'height' : height, 'K' : K, 'D' : [0.0] * 5}, fdc)
+    for fid in fids:
+        # Some depth values are out of range or missing, some pixels are out of the thermal view
+        Z = rng.integers(0, 3500, (height, width)).astype(np.float32) / 1000
+        X = Z * ((np.arange(width) - K[2]) / K[0])
+        Y = Z * ((np.arange(height) - K[5]) / K[4])[:, np.newaxis]
+        visible = rng.integers(0, 255, (height, width, 3))
+        thermal = rng.integers(0, 255, (height, width)) * (rng.uniform(size=(height, width)) > 0.3)
+        save_RGBDnT(os.path.join(target_dir, f'vtd_{fid}.mat'), 
+            RGBDnT(np.dstack((X, Y, Z, visible, thermal)).astype(np.float32)))
+    return depth_param_file
+
+def random_rigid_transformation(rng):
+    rot, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    if np.linalg.det(rot) < 0:
+        rot[:, 0] = -rot[:, 0]
+    res = np.identity(4)
+    res[:3, :3] = rot
+    res[:3, 3] = rng.normal(size=3)
+    return res
+
+def create_dual_point_cloud_frames(target_dir : str, fids, num_points : int = 50, seed : int = 0):
+    # Every frame observes the same scene from a different pose
+    rng = np.random.default_rng(seed)
+    scene = rng.uniform(size=(num_points, 3))
+    for fid in fids:
+        pose = random_rigid_transformation(rng)
+        points = scene @ pose[:3, :3].T + pose[:3, 3]
+        for modality in ('visible', 'thermal'):
+            pc = o3d.geometry.PointCloud()
+            pc.points = o3d.utility.Vector3dVector(points)
+            pc.colors = o3d.utility.Vector3dVector(np.full((num_points, 3), 0.5))
+            o3d.io.write_point_cloud(os.path.join(target_dir, f'pc_{modality}_{fid}.ply'), pc)
+    return scene
+
+class Correspondence_Registration_Step(AbstractRegistration_Step):
+    # The first points of the target belong to the reference frame, in the same order as the source points
+    def _register(self, src, tgt):
+        corr = np.tile(np.arange(len(src.points)), (2, 1)).T
+        p2p = o3d.pipelines.registration.TransformationEstimationPointToPoint()
+        return p2p.compute_transformation(src, tgt, o3d.utility.Vector2iVector(corr))
+
+class Counting_Load_Step(LoadBatch_Step):
+    def __init__(self, data_batch_key : str = 'batch'):
+        super().__init__(data_batch_key)
+        self._calls = 0
+
+    def _impl_item(self, item, index : int):
+        self._calls += 1
+        return super()._impl_item(item, index)
+
+class Counting_Registration_Step(Correspondence_Registration_Step):
+    def __init__(self, data_pcs_key : str, scale : float = 1.0):
+        super().__init__(data_pcs_key)
+        self.scale = scale
+        self._calls = 0
+
+    def _impl_func(self, **kwargs):
+        self._calls += 1
+        return super()._impl_func(**kwargs)
+
+class Interrupted_Registration_Step(Correspondence_Registration_Step):
+    # The run is interrupted after fail_after registered frames
+    def __init__(self, data_pcs_key : str, fail_after : int = None):
+        super().__init__(data_pcs_key)
+        self._fail_after = fail_after
+        self._registered = 0
+
+    def _register(self, src, tgt):
+        if self._fail_after is not None and self._registered >= self._fail_after:
+            raise RuntimeError('Interrupted registration')
+        self._registered += 1
+        return super()._register(src, tgt)
+
+class Gated_Saver_Step(PointCloudSaver_Step):
+    # The point clouds are written once the gate is open
+    def __init__(self, data_pcs_key : str, result_dir : str, gate : threading.Event):
+        super().__init__(data_pcs_key, result_dir, None, async_write=True)
+        self._gate = gate
+
+    def _write(self, file : str, pc, print_progress : bool = True):
+        self._gate.wait(timeout=10)
+        super()._write(file, pc, print_progress)
+
+class Killing_Step(PipelineStep):
+    # Snapshot of the checkpoint directory while the previous steps are running, as left by a killed process
+    def __init__(self, data_key : str, checkpoint : PipelineCheckpoint, snapshot_dir : str, gate : threading.Event):
+        super().__init__({'items' : data_key})
+        self._checkpoint = checkpoint
+        self._snapshot_dir = snapshot_dir
+        self._gate = gate
+
+    def _impl_func(self, **kwargs):
+        shutil.copytree(self._checkpoint.checkpoint_dir, self._snapshot_dir)
+        self._gate.set()
+        raise RuntimeError('Killed')
+
+class Failing_Step(FrameToPC_Step):
+    def _impl_item(self, frame, index : int):
+        if index == 2:
+            raise ValueError('Failing frame')
+        return super()._impl_item(frame, index)
+
+class Counting_Batch:
+    def __init__(self, count : int) -> None:
+        self.count = count
+        self.produced = 0
+        self.in_flight = []
+
+    def __call__(self):
+        for index in range(self.count):
+            self.produced += 1
+            yield index
+
+class Scale_Step(PipelineStep):
+    per_item = True
+    item_arg = 'items'
+
+    def __init__(self, data_key : str, output_key : str, factor : int) -> None:
+        super().__init__({'items' : data_key})
+        self.item_output = output_key
+        self.factor = factor
+
+    def _impl_item(self, item, index : int):
+        return item * self.factor
+
+class Collect_Step(PipelineStep):
+    per_item = True
+    item_arg = 'items'
+
+    def __init__(self, data_key : str, batch : Counting_Batch) -> None:
+        super().__init__({'items' : data_key})
+        self.batch = batch
+        self.items = []
+
+    def _impl_item(self, item, index : int):
+        self.items.append(item)
+        # Items produced by the source but not yet collected
+        self.batch.in_flight.append(self.batch.produced - len(self.items))
+
+class Failing_Collect_Step(Collect_Step):
+    def _impl_item(self, item, index : int):
+        if index == 5:
+            raise ValueError('Failing item')
+        return super()._impl_item(item, index)
+
+class Rendezvous_Step(Scale_Step):
+    # Only completes if the other branch runs at the same time
+    def __init__(self, data_key : str, output_key : str, barrier : threading.Barrier) -> None:
+        super().__init__(data_key, output_key, 1)
+        self.barrier = barrier
+
+    def _impl_func(self, **kwargs):
+        self.barrier.wait(timeout=10)
+        return super()._impl_func(**kwargs)
+
+class Sum_Step(PipelineStep):
+    def __init__(self, data_keys : List[str]) -> None:
+        super().__init__({f'items_{i}' : key for i, key in enumerate(data_keys)})
+
+    @property
+    def produces(self):
+        return ['sum']
+
+    def _impl_func(self, **kwargs):
+        return {'sum' : sum(sum(x) for x in kwargs.values())}
+
 class Test_Registration(unittest.TestCase):
 
+    def test_frame_to_pc_kernel(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1626967963384', '1626967963484']
+            depth_param_file = create_rgbdt_frames(root_dir, fids)
+            batch = RGBDnTBatch(root_dir, [f'vtd_{fid}.mat' for fid in fids])
+            cwd = os.getcwd()
+            os.chdir(root_dir)
+            try:
+                reference = Pipeline([
+                    FilterDepthRange_Step(),
+                    ConvertToPC_Step(depth_params_file=depth_param_file, data_batch_key='prp_frames')
+                ])(batch)['pcs']
+            finally:
+                os.chdir(cwd)
+            pcs = Pipeline([FrameToPC_Step()])(batch)['pcs']
+            for (ref_v, ref_t), (v, t) in zip(reference, pcs):
+                np.testing.assert_allclose(np.asarray(v.points), np.asarray(ref_v.points), atol=1e-5)
+                np.testing.assert_allclose(np.asarray(v.colors), np.asarray(ref_v.colors), atol=1e-6)
+                ref_t = filter_out_zero_thermal(ref_t)
+                np.testing.assert_allclose(np.asarray(t.points), np.asarray(ref_t.points), atol=1e-5)
+                np.testing.assert_allclose(np.asarray(t.colors), np.asarray(ref_t.colors), atol=1e-6)
+
+    def test_shared_outlier_removal(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1626967963384', '1626967963484']
+            depth_param_file = create_rgbdt_frames(root_dir, fids, height=24, width=32)
+            batch = RGBDnTBatch(root_dir, [f'vtd_{fid}.mat' for fid in fids])
+            converted = Pipeline([
+                FilterDepthRange_Step(),
+                ConvertToPC_Step(depth_params_file=depth_param_file, data_batch_key='prp_frames')
+            ])(batch)['pcs']
+            for steps in (
+                [Preprocessing_Step('pcs')],
+                [FrameToPC_Step(), Preprocessing_Step('pcs', filter_thermal=False)]
+            ):
+                pcs = converted if len(steps) == 1 else Pipeline(steps[:1])(batch)['pcs']
+                res = [steps[-1]._impl_item((o3d.geometry.PointCloud(v), o3d.geometry.PointCloud(t)), i) for i, (v, t) in enumerate(pcs)]
+                for (v, t), (prp_v, prp_t) in zip(pcs, res):
+                    # The visible outliers are the ones of the separate removal
+                    ref_v,_ = v.remove_statistical_outlier(nb_neighbors=8, std_ratio=0.005)
+                    np.testing.assert_array_equal(np.asarray(prp_v.points), np.asarray(ref_v.points))
+                    # The thermal points are the inliers of the visible cloud
+                    if len(steps) == 1:
+                        # Same geometry, as the separate removal
+                        ref_t,_ = t.remove_statistical_outlier(nb_neighbors=8, std_ratio=0.005)
+                        ref_t = filter_out_zero_thermal(ref_t)
+                        np.testing.assert_array_equal(np.asarray(prp_t.points), np.asarray(ref_t.points))
+                        np.testing.assert_array_equal(np.asarray(prp_t.colors), np.asarray(ref_t.colors))
+                    else:
+                        inliers = {tuple(x) for x in np.asarray(ref_v.points)}
+                        expected = [x for x in np.asarray(t.points) if tuple(x) in inliers]
+                        np.testing.assert_array_equal(np.asarray(prp_t.points), np.array(expected))
+                    self.assertGreater(len(prp_t.points), 0)
+        # The thermal cloud is processed on its own when it is not a subset of the visible one
+        v, t = o3d.geometry.PointCloud(), o3d.geometry.PointCloud()
+        v.points = o3d.utility.Vector3dVector(np.random.default_rng(0).random((50, 3)))
+        t.points = o3d.utility.Vector3dVector(np.random.default_rng(1).random((40, 3)))
+        t.colors = o3d.utility.Vector3dVector(np.ones((40, 3)))
+        self.assertIsNone(match_points(np.asarray(v.points), np.asarray(t.points)))
+        prp_v, prp_t = Preprocessing_Step('pcs')._impl_item((v, t), 0)
+        ref_t,_ = t.remove_statistical_outlier(nb_neighbors=8, std_ratio=0.005)
+        np.testing.assert_array_equal(np.asarray(prp_t.points), np.asarray(ref_t.points))
+
+    def test_streaming_pipeline(self):
+        def _create_steps(batch):
+            return [
+                LoadBatch_Step(),
+                Scale_Step('pcs', 'double', 2),
+                Scale_Step('double', 'triple', 3),
+                Collect_Step('triple', batch),
+                # The sum is a barrier that needs the whole batch
+                Scale_Step('double', 'sum', 1)
+            ]
+        batch = Counting_Batch(200)
+        reference = Pipeline(_create_steps(batch))(batch)
+        batch = Counting_Batch(200)
+        steps = _create_steps(batch)
+        res = Pipeline(steps, streaming=True, queue_size=2)(batch)
+        self.assertEqual(steps[3].items, [6 * x for x in range(200)])
+        self.assertNotIn('triple', res)
+        # 'double' has two consumers, so it is gathered as in the batch mode
+        self.assertEqual(res['double'], reference['double'])
+        self.assertEqual(res['sum'], reference['sum'])
+
+        batch = Counting_Batch(200)
+        steps = _create_steps(batch)[:4]
+        Pipeline(steps, streaming=True, queue_size=2)(batch)
+        self.assertEqual(steps[3].items, [6 * x for x in range(200)])
+        # Memory is bounded by the queues, not by the batch size
+        self.assertLessEqual(max(batch.in_flight), 3 * (2 + 2))
+
+        # A failed stage cancels the others, no stage is left waiting for its consumer
+        threads = threading.active_count()
+        batch = Counting_Batch(1000)
+        steps = [LoadBatch_Step(), Scale_Step('pcs', 'double', 2), Failing_Collect_Step('double', batch)]
+        with self.assertRaises(ValueError):
+            Pipeline(steps, streaming=True, queue_size=2)(batch)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertLess(batch.produced, 1000)
+
+    def test_concurrent_pipeline(self):
+        barrier = threading.Barrier(2)
+        steps = [
+            LoadBatch_Step(),
+            Rendezvous_Step('pcs', 'left', barrier),
+            Rendezvous_Step('pcs', 'right', barrier),
+            Scale_Step('left', 'left_double', 2),
+            Sum_Step(['left_double', 'right'])
+        ]
+        deps = Pipeline(steps)._dependencies()
+        self.assertEqual(deps[1], {0})
+        self.assertEqual(deps[2], {0})
+        self.assertEqual(deps[4], {2, 3})
+        res = Pipeline(steps, concurrent=True, num_workers=2, keep=['sum'])(Counting_Batch(10))
+        # Only the requested results are kept
+        self.assertEqual(res, {'sum' : 3 * sum(range(10))})
+        with self.assertRaises(ValueError):
+            Pipeline(steps, streaming=True, concurrent=True)
+
+    def test_step_cache(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            data_dir = os.path.join(root_dir, 'data')
+            os.makedirs(data_dir)
+            fids = [str(1626967963384 + 100 * i) for i in range(3)]
+            create_dual_point_cloud_frames(data_dir, fids)
+            files = [(f'pc_visible_{fid}.ply', f'pc_thermal_{fid}.ply') for fid in fids]
+            cache = StepCache(os.path.join(root_dir, 'cache'))
+            def _run(scale : float = 1.0, **options):
+                steps = [Counting_Load_Step(), Counting_Registration_Step('pcs', scale)]
+                res = Pipeline(steps, cache=cache, **options)(DoublePointCloudBatch(data_dir, files))
+                return res, steps[0]._calls, steps[1]._calls
+
+            reference, loads, registrations = _run()
+            self.assertEqual((loads, registrations), (3, 1))
+            # Nothing is recomputed, even in the other execution modes
+            for options in ({}, {'streaming' : True}, {'concurrent' : True}):
+                res, loads, registrations = _run(**options)
+                self.assertEqual((loads, registrations), (0, 0))
+                for ref, pack in zip(reference['aligned_pcs'], res['aligned_pcs']):
+                    np.testing.assert_array_equal(np.asarray(pack.visible_pointcloud.points), np.asarray(ref.visible_pointcloud.points))
+                    np.testing.assert_array_equal(np.asarray(pack.thermal_pointcloud.colors), np.asarray(ref.thermal_pointcloud.colors))
+                for ref, trans in zip(reference['transformations'], res['transformations']):
+                    np.testing.assert_array_equal(trans, ref)
+            # A parameter change only invalidates the step
+            self.assertEqual(_run(scale=2.0)[1:], (0, 1))
+            # A changed file only invalidates its item and the steps depending on it
+            pc = o3d.io.read_point_cloud(os.path.join(data_dir, files[1][0]))
+            o3d.io.write_point_cloud(os.path.join(data_dir, files[1][0]), pc.translate((0.1, 0, 0)))
+            self.assertEqual(_run()[1:], (1, 1))
+            # The cache persists and honours its size limit
+            entries = len(cache)
+            self.assertEqual(len(StepCache(cache.cache_dir)), entries)
+            small = StepCache(cache.cache_dir, max_bytes=cache.current_bytes // 2)
+            small.store('extra', np.zeros(10))
+            self.assertLessEqual(small.current_bytes, small.max_bytes)
+            self.assertIn('extra', small)
+            self.assertGreater(small.stats()['evictions'], 0)
+            # The stores are saved on flush and the byte count matches the reloaded entries
+            small.flush()
+            reloaded = StepCache(cache.cache_dir)
+            self.assertIn('extra', reloaded)
+            self.assertEqual(reloaded.current_bytes, small.current_bytes)
+            # Entries that cannot be serialized are skipped
+            self.assertFalse(small.store('object', object()))
+
+    def test_pipeline_checkpoint(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            data_dir = os.path.join(root_dir, 'data')
+            os.makedirs(data_dir)
+            fids = [str(1626967963384 + 100 * i) for i in range(5)]
+            create_dual_point_cloud_frames(data_dir, fids)
+            batch = DoublePointCloudBatch(data_dir, [(f'pc_visible_{fid}.ply', f'pc_thermal_{fid}.ply') for fid in fids])
+            checkpoint = PipelineCheckpoint(os.path.join(root_dir, 'checkpoint'))
+            def _run(fail_after : int = None, **options):
+                steps = [Counting_Load_Step(), Interrupted_Registration_Step('pcs', fail_after)]
+                res = Pipeline(steps, checkpoint=checkpoint, **options)(batch)
+                return res, steps[0]._calls, steps[1]._registered
+
+            reference = Pipeline([LoadBatch_Step(), Correspondence_Registration_Step('pcs')])(batch)
+            # The run is interrupted at the third registered frame
+            with self.assertRaises(RuntimeError):
+                _run(fail_after=2)
+            self.assertEqual(PipelineCheckpoint(checkpoint.checkpoint_dir).begin(checkpoint.signature, resume=True), [0])
+            # The loaded frames and the registered frames are restored
+            res, loads, registered = _run(resume=True)
+            self.assertEqual((loads, registered), (0, len(fids) - 3))
+            for ref, pack in zip(reference['aligned_pcs'], res['aligned_pcs']):
+                np.testing.assert_array_equal(pack.points, ref.points)
+            for ref, trans in zip(reference['transformations'], res['transformations']):
+                np.testing.assert_array_equal(trans, ref)
+            np.testing.assert_array_equal(res['fused_pc'].points, reference['fused_pc'].points)
+            self.assertFalse(any('frame' in f for f in os.listdir(checkpoint.checkpoint_dir)))
+            # A completed run is entirely restored, in any mode
+            for options in ({}, {'concurrent' : True}):
+                res, loads, registered = _run(resume=True, **options)
+                self.assertEqual((loads, registered), (0, 0))
+                np.testing.assert_array_equal(res['fused_pc'].points, reference['fused_pc'].points)
+            # Without resume, or with another pipeline, the run starts over
+            self.assertEqual(_run()[1:], (len(fids), len(fids) - 1))
+            steps = [Counting_Load_Step(), Counting_Registration_Step('pcs', scale=2.0)]
+            Pipeline(steps, checkpoint=checkpoint, resume=True)(batch)
+            self.assertEqual((steps[0]._calls, steps[1]._calls), (len(fids), 1))
+            with self.assertRaises(ValueError):
+                Pipeline(steps, streaming=True, checkpoint=checkpoint)
+
+    def test_checkpoint_async_saver(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            data_dir = os.path.join(root_dir, 'data')
+            os.makedirs(data_dir)
+            fids = [str(1626967963384 + 100 * i) for i in range(3)]
+            create_dual_point_cloud_frames(data_dir, fids)
+            batch = DoublePointCloudBatch(data_dir, [(f'pc_visible_{fid}.ply', f'pc_thermal_{fid}.ply') for fid in fids])
+            checkpoint_dir = os.path.join(root_dir, 'checkpoint')
+            save_dir = os.path.join(root_dir, 'saved')
+            snapshot_dir = os.path.join(root_dir, 'snapshot')
+            def _steps(checkpoint):
+                gate = threading.Event()
+                return [
+                    Counting_Load_Step(), 
+                    Gated_Saver_Step('pcs', save_dir, gate), 
+                    Killing_Step('pcs', checkpoint, snapshot_dir, gate)
+                ]
+            checkpoint = PipelineCheckpoint(checkpoint_dir)
+            with self.assertRaises(RuntimeError):
+                Pipeline(_steps(checkpoint), checkpoint=checkpoint)(batch)
+            # The process is killed before the queued point clouds are written
+            shutil.rmtree(checkpoint_dir)
+            shutil.rmtree(save_dir)
+            shutil.copytree(snapshot_dir, checkpoint_dir)
+            shutil.rmtree(snapshot_dir)
+            checkpoint = PipelineCheckpoint(checkpoint_dir)
+            steps = _steps(checkpoint)
+            with self.assertRaises(RuntimeError):
+                Pipeline(steps, checkpoint=checkpoint, resume=True)(batch)
+            # The loaded frames are restored, the point clouds are saved again
+            self.assertEqual(steps[0]._calls, 0)
+            self.assertEqual(len(os.listdir(save_dir)), 2 * len(fids))
+            # Once the writes are joined, the saver is restored as well
+            self.assertEqual(checkpoint.completed(), [0, 1])
+
+    def test_process_pool_pipeline(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = [str(1626967963384 + 100 * i) for i in range(5)]
+            depth_param_file = create_rgbdt_frames(root_dir, fids)
+            batch = RGBDnTBatch(root_dir, [f'vtd_{fid}.mat' for fid in fids])
+            def _create_steps():
+                return [
+                    FilterDepthRange_Step(),
+                    ConvertToPC_Step(depth_params_file=depth_param_file, data_batch_key='prp_frames'),
+                    FrameToPC_Step(data_batch_key='prp_frames')
+                ]
+            reference = Pipeline(_create_steps())(batch)
+            blocks = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+            for options in ({}, {'streaming' : True}, {'cache' : StepCache(os.path.join(root_dir, 'cache'))}):
+                profiler = PipelineProfiler()
+                steps = _create_steps()
+                res = Pipeline(steps, num_processes=2, profiler=profiler, **options)(batch)
+                self.assertIsNone(steps[0].item_pool)
+                # The items keep their order
+                for key in ('prp_frames', 'pcs'):
+                    self.assertEqual(len(res[key]), len(fids))
+                for ref, frame in zip(reference['prp_frames'], res['prp_frames']):
+                    np.testing.assert_array_equal(frame.data, ref.data)
+                for (ref_v, ref_t), (v, t) in zip(reference['pcs'], res['pcs']):
+                    np.testing.assert_array_equal(np.asarray(v.points), np.asarray(ref_v.points))
+                    np.testing.assert_array_equal(np.asarray(t.colors), np.asarray(ref_t.colors))
+                self.assertEqual(len(profiler.summary()[1]['frames']), len(fids))
+            # The workers only receive the file of their item, not the whole batch
+            single = RGBDnTBatch(root_dir, [f'vtd_{fids[0]}.mat'])
+            self.assertEqual(len(pickle.dumps(_LazyItem(batch, 0))), len(pickle.dumps(_LazyItem(single, 0))))
+            np.testing.assert_array_equal(pickle.loads(pickle.dumps(_LazyItem(batch, 1))).load().data, batch.get(1).data)
+            # The errors of the workers are raised
+            with self.assertRaises(ValueError):
+                Pipeline([FilterDepthRange_Step(), Failing_Step(data_batch_key='prp_frames')], num_processes=2)(batch)
+            # All the shared memory blocks are released
+            if os.path.isdir('/dev/shm'):
+                self.assertEqual(set(os.listdir('/dev/shm')), blocks)
+
+    def test_async_point_cloud_saver(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            data_dir = os.path.join(root_dir, 'data')
+            os.makedirs(data_dir)
+            fids = [str(1626967963384 + 100 * i) for i in range(5)]
+            create_dual_point_cloud_frames(data_dir, fids)
+            batch = DoublePointCloudBatch(data_dir, [(f'pc_visible_{fid}.ply', f'pc_thermal_{fid}.ply') for fid in fids])
+            sync_dir = os.path.join(root_dir, 'sync')
+            Pipeline([LoadBatch_Step(), PointCloudSaver_Step('pcs', sync_dir, None)])(batch)
+            for options in ({}, {'streaming' : True}, {'concurrent' : True}):
+                async_dir = os.path.join(root_dir, 'async')
+                saver = PointCloudSaver_Step('pcs', async_dir, None, async_write=True, num_writers=2, max_pending=1)
+                # The registration transforms the point clouds after they are saved
+                Pipeline([LoadBatch_Step(), saver, Correspondence_Registration_Step('pcs')], **options)(batch)
+                self.assertIsNone(saver._executor)
+                for fname in os.listdir(sync_dir):
+                    with open(os.path.join(sync_dir, fname), 'rb') as fs, open(os.path.join(async_dir, fname), 'rb') as fa:
+                        self.assertEqual(fs.read(), fa.read())
+            # A single pack is saved as a batch of one, in any mode
+            for options in ({}, {'streaming' : True}):
+                fused_dir = os.path.join(root_dir, 'fused', str(len(options)))
+                Pipeline([LoadBatch_Step(), Correspondence_Registration_Step('pcs'), 
+                    PointCloudSaver_Step('fused_pc', fused_dir, None, async_write=True)], **options)(batch)
+                self.assertEqual(sorted(os.listdir(fused_dir)), ['pc_thermal_1.ply', 'pc_visible_1.ply'])
+            # The errors of the writers are raised at the end of the pipeline
+            saver = PointCloudSaver_Step('pcs', os.path.join(root_dir, 'failed'), None, async_write=True)
+            saver.result_dir = os.path.join(root_dir, 'missing', 'failed')
+            with self.assertRaises(IOError):
+                Pipeline([LoadBatch_Step(), saver])(batch)
+            self.assertIsNone(saver._executor)
+
+    def test_pipeline_profiling(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = ['1626967963384', '1626967963484']
+            create_rgbdt_frames(root_dir, fids)
+            batch = RGBDnTBatch(root_dir, [f'vtd_{fid}.mat' for fid in fids])
+            for options in ({}, {'streaming' : True}, {'concurrent' : True}):
+                profiler = PipelineProfiler(root_dir, name='test', cprofile=['FrameToPC_Step'])
+                steps = [FrameToPC_Step(), Correspondence_Registration_Step('pcs')]
+                res = Pipeline(steps, profiler=profiler, **options)(batch)
+                points = sum(len(v.points) + len(t.points) for v, t in res['pcs'])
+                summary = profiler.summary()
+                self.assertEqual([s['step'] for s in summary], ['FrameToPC_Step', 'Correspondence_Registration_Step'])
+                # Per frame records of the per-item step
+                self.assertEqual([f['index'] for f in summary[0]['frames']], [0, 1])
+                self.assertEqual(summary[0]['points_out'], points)
+                self.assertEqual(summary[1]['items'], len(fids))
+                self.assertEqual(summary[1]['points_in'], points)
+                self.assertTrue(all(s['wall_time'] > 0 for s in summary))
+                self.assertIsNone(steps[0].item_observer)
+                with open(os.path.join(root_dir, 'test_profile.json'), 'r') as fp:
+                    self.assertEqual(len(json.load(fp)['steps']), 2)
+                self.assertTrue(os.path.isfile(os.path.join(root_dir, 'test_profile.csv')))
+                self.assertTrue(os.path.isfile(os.path.join(root_dir, 'test_0_FrameToPC_Step.prof')))
+
+    def test_windowed_registration(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = [str(1626967963384 + 100 * i) for i in range(11)]
+            create_dual_point_cloud_frames(root_dir, fids)
+            # Other files of the directory are ignored
+            for fname in ('pc_visible_backup.ply', 'pc_thermal_backup.ply', 'notes.txt'):
+                open(os.path.join(root_dir, fname), 'w').close()
+            windows = SequenceWindowBatcher(root_dir, window_size=4, stride=3)
+            self.assertEqual([w[0] for w in windows.windows], [fids[0], fids[3], fids[6], fids[7]])
+            for num_workers in (1, 2):
+                res = WindowedRegistration(
+                    lambda: Pipeline([LoadBatch_Step('batch'), Correspondence_Registration_Step('pcs')]),
+                    num_workers=num_workers, keep_aligned=True)(windows)
+                reference = np.asarray(res['aligned_pcs'][0].visible_pointcloud.points)
+                self.assertEqual(len(res['aligned_pcs']), len(fids))
+                for pack in res['aligned_pcs']:
+                    np.testing.assert_allclose(np.asarray(pack.visible_pointcloud.points), reference, atol=1e-6)
+                    np.testing.assert_allclose(np.asarray(pack.thermal_pointcloud.points), reference, atol=1e-6)
+            # Every window contributes its own down-sampled frames, the previous ones are not averaged again
+            res = WindowedRegistration(
+                lambda: Pipeline([LoadBatch_Step('batch'), Correspondence_Registration_Step('pcs')]),
+                voxel_size=0.25, keep_aligned=True)(windows)
+            voxels = res['aligned_pcs'][0].voxel_down_sample(voxel_size=0.25)
+            self.assertEqual(len(res['fused_pc'].get_visible_point_cloud().points), 
+                len(windows) * len(voxels.get_visible_point_cloud().points))
+
+    def test_multimodal_point_cloud(self):
+        rng = np.random.default_rng(0)
+        def _pair(count : int = 40):
+            visible = o3d.geometry.PointCloud()
+            visible.points = o3d.utility.Vector3dVector(rng.uniform(size=(count, 3)))
+            visible.colors = o3d.utility.Vector3dVector(rng.uniform(size=(count, 3)))
+            visible.normals = o3d.utility.Vector3dVector(rng.normal(size=(count, 3)))
+            # The thermal points are a subset of the visible points
+            thermal = visible.select_by_index(np.flatnonzero(rng.uniform(size=count) > 0.3))
+            thermal.colors = o3d.utility.Vector3dVector(np.repeat(rng.uniform(0.1, 1, size=(len(thermal.points), 1)), 3, axis=1))
+            return visible, thermal
+        def _assert_pair(pack, visible, thermal):
+            for pc, ref in ((pack[0], visible), (pack.get_thermal_point_cloud(), thermal)):
+                np.testing.assert_allclose(np.asarray(pc.points), np.asarray(ref.points), atol=1e-12)
+                np.testing.assert_array_equal(np.asarray(pc.colors), np.asarray(ref.colors))
+                np.testing.assert_allclose(np.asarray(pc.normals), np.asarray(ref.normals), atol=1e-12)
+
+        pairs = [_pair() for _ in range(3)]
+        packs = pack_point_clouds(pairs)
+        self.assertTrue(all(isinstance(p, MultiModalPointCloud) for p in packs))
+        # The pair is rebuilt on demand
+        _assert_pair(packs[0], *pairs[0])
+        # One transformation of the shared geometry
+        trans = random_rigid_transformation(rng)
+        packs[1].transform(trans)
+        _assert_pair(packs[1], pairs[1][0].transform(trans), pairs[1][1].transform(trans))
+        # Accumulation
+        fused = copy.deepcopy(packs[0])
+        fused += packs[1]
+        visible, thermal = copy.deepcopy(pairs[0][0]), copy.deepcopy(pairs[0][1])
+        visible += pairs[1][0]
+        thermal += pairs[1][1]
+        _assert_pair(fused, visible, thermal)
+        self.assertEqual(fused.point_count, len(visible.points))
+        # The packs are fused at once, without changing them
+        _assert_pair(fuse_point_clouds(packs[:2]), visible, thermal)
+        _assert_pair(packs[0], *pairs[0])
+        # The shared memory transport keeps the representation
+        block = SharedBlock.create(fused)
+        try:
+            _assert_pair(block.load(), visible, thermal)
+        finally:
+            block.release()
+        # The voxels keep the thermal values of the thermal points only
+        down = fused.voxel_down_sample(voxel_size=10.0)
+        self.assertEqual(down.point_count, 1)
+        np.testing.assert_allclose(down.points[0], np.asarray(visible.points).mean(axis=0))
+        np.testing.assert_allclose(down.thermal[0], np.asarray(thermal.colors)[:, 0].mean())
+        # Same voxel grid as o3d for the visible point cloud
+        down = fused.voxel_down_sample(voxel_size=0.3).get_visible_point_cloud()
+        ref = visible.voxel_down_sample(voxel_size=0.3)
+        order, ref_order = np.lexsort(np.asarray(down.points).T), np.lexsort(np.asarray(ref.points).T)
+        for attr in ('points', 'colors', 'normals'):
+            np.testing.assert_allclose(np.asarray(getattr(down, attr))[order], np.asarray(getattr(ref, attr))[ref_order], atol=1e-12)
+        # The pairs that cannot share their geometry are kept as they are
+        other = o3d.geometry.PointCloud(pairs[2][1])
+        other.translate([1, 0, 0])
+        packs = pack_point_clouds([pairs[0], (pairs[2][0], other)])
+        self.assertTrue(all(isinstance(p, DualPointCloudPack) for p in packs))
+
+    def test_multimodal_registration(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            fids = [str(1626967963384 + 100 * i) for i in range(4)]
+            create_dual_point_cloud_frames(root_dir, fids)
+            batch = DoublePointCloudBatch(root_dir, [(f'pc_visible_{fid}.ply', f'pc_thermal_{fid}.ply') for fid in fids])
+            res = Pipeline([LoadBatch_Step(), Correspondence_Registration_Step('pcs')])(batch)
+            fused = res['fused_pc']
+            self.assertIsInstance(fused, MultiModalPointCloud)
+            # The frames are aligned on the first one, both modalities at once
+            reference = np.asarray(res['aligned_pcs'][0].visible_pointcloud.points)
+            for pack in res['aligned_pcs']:
+                np.testing.assert_allclose(np.asarray(pack.thermal_pointcloud.points), reference, atol=1e-6)
+            self.assertEqual(len(fused.visible_pointcloud.points), len(fids) * len(reference))
+            self.assertEqual(len(fused.thermal_pointcloud.points), len(fids) * len(reference))
+            # The savers use the pair accessors
+            result_dir = os.path.join(root_dir, 'results')
+            Pipeline([LoadBatch_Step(), Correspondence_Registration_Step('pcs'),
+                PointCloudSaver_Step('fused_pc', result_dir, None)])(batch)
+            self.assertEqual(len(o3d.io.read_point_cloud(os.path.join(result_dir, 'pc_thermal_1.ply')).points), len(fids) * len(reference))
+
     def test_filterreg_registration(self):
         batch = RGBDnTBatch(
             root_dir='/home/phm/GoogleDrive/Personal/Datasets/my-dataset/multi-modal/20210722_pipe_heating/vtd',
@@ -1,6 +1,10 @@
 
 import unittest
 import sys,os
+import json
+import tempfile
+import cv2
+import numpy as np
 import open3d as o3d
 
 from PIL import Image
@@ -9,9 +13,59 @@ sys.path.append(os.getcwd())
 sys.path.append(__file__)
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-from phm.utils import blend_vt, show_modalities_grid
+from phm.utils import blend_vt, modal_to_image, show_modalities_grid
 from phm.io import load_mme, load_point_cloud, save_point_cloud
-from phm.vtd import VTD_Alignment
+from phm.data import MMEContainer, MMERecord
+from phm.calibration import homography_shift, load_calibration_report
+from phm.vtd import VTD_Alignment, load_homography, save_homography
+
+def create_alignment(target_dir : str, height : int = 48, width : int = 64, homography = None):
+    depth_param_file = os.path.join(target_dir, 'camera_info.json')
+    with open(depth_param_file, 'w') as fdc:
+        json.dump({
+            'width' : width, 'height' : height,
+            'K' : [60.0, 0.0, width / 2 - 0.5, 0.0, 58.0, height / 2 + 0.5, 0.0, 0.0, 1.0],
+            'D' : [0.0, 0.0, 0.0, 0.0, 0.0]
+        }, fdc)
+    homography = homography if homography is not None else np.array([
+        [1.05, 0.02, -3.0],
+        [-0.01, 0.98, 2.0],
+        [1e-4, -2e-4, 1.0]
+    ])
+    save_homography(os.path.join(target_dir, 'homography.mat'), homography)
+    return VTD_Alignment(target_dir=target_dir, depth_param_file=depth_param_file)
+
+def create_container(height : int = 48, width : int = 64, seed : int = 0):
+    rng = np.random.default_rng(seed)
+    # Smooth thermal pattern so that the interpolation is comparable
+    X, Y = np.meshgrid(np.arange(width), np.arange(height))
+    thermal = (3000 + 500 * np.sin(X / 7.0) * np.cos(Y / 5.0)).astype(np.uint16)
+    container = MMEContainer(cid='1625604430816')
+    container.add_entity(MMERecord(type='thermal', file='thermal.png', data=thermal))
+    container.add_entity(MMERecord(type='visible', file='visible.png', 
+        data=rng.integers(0, 255, (height, width, 3), dtype=np.uint8)))
+    container.add_entity(MMERecord(type='depth', file='depth.png', 
+        data=rng.integers(500, 3000, (height, width), dtype=np.uint16)))
+    return container
+
+def create_calibration_pair(homography, height : int = 240, width : int = 320, seed : int = 0):
+    # Textured scene with reversed contrast in the thermal modality
+    rng = np.random.default_rng(seed)
+    scene = np.zeros((height, width), np.uint8)
+    for _ in range(60):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        cv2.rectangle(scene, (int(x), int(y)), (int(x + rng.integers(8, 40)), int(y + rng.integers(8, 40))), 
+            int(rng.integers(40, 255)), -1)
+        cv2.circle(scene, (int(rng.integers(0, width)), int(rng.integers(0, height))), 
+            int(rng.integers(4, 20)), int(rng.integers(40, 255)), 2)
+    visible = np.dstack((scene, scene, scene))
+    thermal = cv2.warpPerspective(scene, np.linalg.inv(homography), (width // 2, height // 2))
+    thermal = (20000 - 30 * thermal.astype(np.uint16)).astype(np.uint16)
+    container = MMEContainer(cid='1625604430816')
+    container.add_entity(MMERecord(type='thermal', file='thermal.png', data=thermal))
+    container.add_entity(MMERecord(type='visible', file='visible.png', data=visible))
+    container.add_entity(MMERecord(type='depth', file='depth.png', data=np.full((height, width), 1000, np.uint16)))
+    return container
 
 class Test_VTD(unittest.TestCase):
 
@@ -43,5 +97,145 @@ class Test_VTD(unittest.TestCase):
         save_point_cloud('/home/phm/GoogleDrive/Personal/Datasets/my-dataset/multi-modal/20210706_multi_modal/test.ply', rgbdt, 'ply_txt')
         load_point_cloud('/home/phm/GoogleDrive/Personal/Datasets/my-dataset/multi-modal/20210706_multi_modal/test.ply', file_type='ply_txt')
 
+    def test_cached_alignment_tables(self):
+        with tempfile.TemporaryDirectory() as target_dir:
+            vtd = create_alignment(target_dir)
+            data = create_container()
+            rgbdt = vtd.compute(data)
+            # Reference : per-frame warp and pixel grid
+            thermal = data['thermal'].data
+            thermal = (((thermal - np.min(thermal)) / (np.max(thermal) - np.min(thermal))) * 255.0).astype(np.uint8)
+            warped = cv2.warpPerspective(thermal, vtd.homography, (thermal.shape[1], thermal.shape[0]))
+            # The pixels interpolated across the field of view border are not compared
+            inside = cv2.warpPerspective(np.full_like(thermal, 255), vtd.homography, 
+                (thermal.shape[1], thermal.shape[0])) == 255
+            inside = cv2.erode(inside.astype(np.uint8), np.ones((3,3), np.uint8)) > 0
+            diff = np.abs(rgbdt.data[:,:,-1].astype(np.int32) - warped.astype(np.int32))
+            self.assertLessEqual(diff[inside].max(), 1)
+            height, width = thermal.shape
+            X, Y = np.meshgrid(np.linspace(0, width-1, width), np.linspace(0, height-1, height))
+            K = vtd.depth_camera_params['K']
+            Z = data['depth'].data / 1000
+            np.testing.assert_allclose(rgbdt.data[:,:,0], Z * (X - K[2]) / K[0], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(rgbdt.data[:,:,1], Z * (Y - K[5]) / K[4], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(rgbdt.data[:,:,2], Z, rtol=1e-5, atol=1e-6)
+
+    def test_estimate_alignment_params(self):
+        homography = np.array([
+            [1.9, 0.05, 12.0],
+            [-0.03, 1.95, 8.0],
+            [0.0, 0.0, 1.0]
+        ])
+        with tempfile.TemporaryDirectory() as target_dir:
+            vtd = create_alignment(target_dir, 240, 320)
+            vtd.reset()
+            frames = [('f1', create_calibration_pair(homography, seed=0)), ('f2', create_calibration_pair(homography, seed=1))]
+            vtd.estimate_alignment_params(frames)
+            # Corners of the thermal image are mapped within a pixel
+            corners = np.float32([[0, 0], [159, 0], [159, 119], [0, 119]]).reshape(-1, 1, 2)
+            err = cv2.perspectiveTransform(corners, vtd.homography) - cv2.perspectiveTransform(corners, homography)
+            self.assertLess(np.abs(err).max(), 1.5)
+            report = load_calibration_report(target_dir)
+            self.assertEqual(report['frames'], 2)
+            self.assertEqual(report['fids'], ['f1', 'f2'])
+            self.assertGreater(report['inlier_ratio'], 0.5)
+            self.assertGreater(report['edge_correlation'], 0.5)
+            # The figures describe the saved homography, RANSAC ones are kept aside
+            self.assertGreater(report['ransac_inliers'], 0)
+            self.assertLessEqual(report['rmse'], 3.0)
+            np.testing.assert_allclose(load_homography(vtd.homography_file), vtd.homography)
+
+    def test_refine_homography_per_frame(self):
+        homography = np.array([
+            [1.9, 0.05, 12.0],
+            [-0.03, 1.95, 8.0],
+            [0.0, 0.0, 1.0]
+        ])
+        # The stored homography is a few pixels off
+        stored = homography.copy()
+        stored[0, 2] += 3.0
+        stored[1, 2] -= 2.0
+        with tempfile.TemporaryDirectory() as target_dir:
+            create_alignment(target_dir, 240, 320, homography=stored)
+            vtd = VTD_Alignment(
+                target_dir=target_dir, 
+                depth_param_file=os.path.join(target_dir, 'camera_info.json'),
+                refine=True,
+                refine_params={'scale' : 1.0, 'time_budget' : None})
+            data = create_calibration_pair(homography)
+            refined = vtd.refine_homography(data['thermal'].data, data['visible'].data)
+            self.assertIsNotNone(refined)
+            self.assertLess(homography_shift(refined, homography, (120, 160)), 
+                homography_shift(stored, homography, (120, 160)) / 2)
+            vtd.compute(data)
+            self.assertEqual(vtd.refine_stats['frames'], 2)
+            self.assertEqual(vtd.refine_stats['refined'], 2)
+            self.assertGreater(vtd.refine_stats['max_time'], 0)
+            # A refinement beyond the allowed shift falls back to the global homography
+            vtd.refine_params['max_shift'] = 0.01
+            self.assertIsNone(vtd.refine_homography(data['thermal'].data, data['visible'].data))
+            self.assertEqual(vtd.refine_stats['fallbacks'], 1)
+            # Without budget, not even the coarsest level is run
+            vtd.refine_params.update({'max_shift' : 10.0, 'time_budget' : 0.0})
+            self.assertIsNone(vtd.refine_homography(data['thermal'].data, data['visible'].data))
+            self.assertEqual(vtd.last_refinement['levels'], 0)
+            self.assertEqual(vtd.refine_stats['fallbacks'], 2)
+
+    def test_float32_matches_float64(self):
+        with tempfile.TemporaryDirectory() as target_dir:
+            create_alignment(target_dir)
+            depth_param_file = os.path.join(target_dir, 'camera_info.json')
+            data = create_container()
+            rgbdt64 = VTD_Alignment(target_dir=target_dir, depth_param_file=depth_param_file, dtype=np.float64).compute(data)
+            rgbdt32 = VTD_Alignment(target_dir=target_dir, depth_param_file=depth_param_file).compute(data)
+            self.assertEqual(rgbdt64.data.dtype, np.float64)
+            self.assertEqual(rgbdt32.data.dtype, np.float32)
+            np.testing.assert_allclose(rgbdt32.data[:,:,:3], rgbdt64.data[:,:,:3], rtol=1e-6, atol=1e-6)
+            np.testing.assert_array_equal(rgbdt32.visible_image, rgbdt64.visible_image)
+            # Normalized intensities may only differ by the rounding of the last level
+            self.assertLessEqual(np.abs(rgbdt32.thermal_image.astype(np.int32) - rgbdt64.thermal_image.astype(np.int32)).max(), 1)
+            self.assertLessEqual(np.abs(blend_vt(rgbdt32).astype(np.int32) - 
+                blend_vt(rgbdt64, dtype=np.float64).astype(np.int32)).max(), 1)
+            np.testing.assert_array_equal(rgbdt32.depth_image, data['depth'].data)
+
+    def test_undistortion_single_remap(self):
+        with tempfile.TemporaryDirectory() as target_dir:
+            create_alignment(target_dir)
+            depth_param_file = os.path.join(target_dir, 'camera_info.json')
+            thermal_param_file = os.path.join(target_dir, 'thermal_info.json')
+            with open(depth_param_file) as fdc:
+                depth_params = json.load(fdc)
+            depth_params['D'] = [-0.15, 0.05, 0.001, -0.001, 0.0]
+            with open(depth_param_file, 'w') as fdc:
+                json.dump(depth_params, fdc)
+            thermal_params = {'width' : 64, 'height' : 48, 
+                'K' : [55.0, 0.0, 31.5, 0.0, 55.0, 23.5, 0.0, 0.0, 1.0], 'D' : [-0.25, 0.08, 0.0, 0.0, 0.0]}
+            with open(thermal_param_file, 'w') as fdc:
+                json.dump(thermal_params, fdc)
+            vtd = VTD_Alignment(target_dir=target_dir, depth_param_file=depth_param_file, 
+                undistort=True, thermal_param_file=thermal_param_file, dtype=np.float64)
+            data = create_container()
+            rgbdt = vtd.compute(data)
+            # Reference : undistortion followed by a separate warp
+            K = np.array(depth_params['K']).reshape(3, 3)
+            visible = cv2.undistort(data['visible'].data, K, np.array(depth_params['D']))
+            Kt = np.array(thermal_params['K']).reshape(3, 3)
+            thermal = modal_to_image(data['thermal'].data)
+            thermal = cv2.undistort(thermal, Kt, np.array(thermal_params['D']))
+            warped = cv2.warpPerspective(thermal, vtd.homography, (thermal.shape[1], thermal.shape[0]))
+            inside = cv2.warpPerspective(np.full_like(thermal, 255), vtd.homography, 
+                (thermal.shape[1], thermal.shape[0])) == 255
+            inside = cv2.erode(inside.astype(np.uint8), np.ones((5,5), np.uint8)) > 0
+            inside[:4], inside[-4:], inside[:, :4], inside[:, -4:] = False, False, False, False
+            diff = np.abs(rgbdt.thermal_image.astype(np.int32) - warped.astype(np.int32))
+            self.assertLessEqual(diff[inside].max(), 2)
+            diff = np.abs(rgbdt.visible_image.astype(np.int32) - visible.astype(np.int32))
+            self.assertLessEqual(diff[4:-4, 4:-4].max(), 2)
+            # Depth is resampled without interpolation
+            depth = rgbdt.depth_image
+            self.assertTrue(np.isin(depth[depth > 0], data['depth'].data).all())
+            # The tables are cached per camera
+            self.assertIs(vtd._get_remap_tables((48, 64)), vtd._get_remap_tables((48, 64)))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file